@@ -1,19 +1,32 @@
+import hmac
+import json
 import os
 from functools import wraps
 from typing import Iterator
 from uuid import uuid4
 
+import httpx
 import tomli
+from attr import dataclass
 from dotenv import load_dotenv
 from flask import Flask, jsonify, request, render_template, stream_with_context, redirect, url_for, current_app, \
     Blueprint, session
+from flask.typing import ResponseReturnValue
 from flask_cors import CORS
 from pydantic.v1.utils import deep_update
 from sqlalchemy import create_engine
 from typing_extensions import Optional
 
 import chat
-from chat.messages import stream_messages, Message
+import chat.utils.json
+import idigbio_util
+import local_occurrences
+import metrics
+import occurrence_maps
+from cancellation import CancelScope, cancel_on_close
+from chat.conversation import Conversation
+from chat.messages import stream_messages, Message, stream_message_events, with_heartbeats, format_event, \
+    STREAM_FORMATS, JSON_ARRAY
 from extensions.flask_redis import FlaskRedis
 from extensions.user_auth import UserAuth, AuthenticationError
 from extensions.user_data import UserData, User
@@ -25,14 +38,25 @@ redis = FlaskRedis()
 user_auth = UserAuth()
 user_data = UserData()
 ai = AI()
+tile_cache = occurrence_maps.TileDiskCache()
 
 plan = Blueprint("blueprint", __name__)
 
+# The iDigBio API returns at most this many records per request
+MAX_RECORDS_PAGE_SIZE = 5000
+
+# Parameters of iDigBio searches that /records passes on besides rq. Paging is done by /records itself.
+RECORDS_SEARCH_PARAMETERS = ["fields", "fields_exclude", "sort"]
+
 
 def handle_error(e: Exception):
     return jsonify(message="Something went wrong.", error=str(e)), 500
 
 
+def idigbio_unavailable(e: Exception):
+    return jsonify(message="The iDigBio API failed to respond.", error=str(e)), 502
+
+
 def create_app(config_dict: Optional[dict], database: DatabaseEngine):
     app = Flask(__name__, template_folder="templates")
     app.register_blueprint(plan)
@@ -46,7 +70,13 @@ def create_app(config_dict: Optional[dict], database: DatabaseEngine):
         app.config = deep_update(app.config, config_dict)
 
     redis.init_app(app)
+    ai.init_app(app, redis.inst)
+    idigbio_util.client.init_app(app, redis.inst)
+    tile_cache.init_app(app)
+    local_occurrences.stores.init_app(app)
+
     user_auth.init_app(app)
+    database.init_app(app)
     user_data.init_app(app, database)
 
     CORS(app, supports_credentials=True)
@@ -67,30 +97,46 @@ def get_conversation_id(f):
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth_header = request.headers.get("Authorization", None)
-        if not auth_header:
-            return f(user=None, *args, **kwargs)
-
-        try:
-            token = auth_header.split(" ")[1]
-            user = user_auth.authenticate(token)
-            return f(user=user, *args, **kwargs)
-        except AuthenticationError as e:
-            print(e)
-            return f(user=None, *args, **kwargs)
+        return f(user=authenticate_request(), *args, **kwargs)
 
     return decorated
 
 
+def authenticate_request() -> Optional[User]:
+    """
+    :return: The user identified by the request's Authorization header, if any
+    """
+    auth_header = request.headers.get("Authorization", None)
+    if not auth_header:
+        return None
+
+    try:
+        token = auth_header.split(" ")[1]
+        return user_auth.authenticate(token)
+    except AuthenticationError as e:
+        print(e)
+        return None
+
+
+def identify_temp_user(user_message: str) -> Optional[User]:
+    """
+    :return: The temporary user tracked by the session, or None if they have yet to pass the robot check
+    """
+    user = user_data.get_temp_user()
+
+    if user_message and "not a robot" in user_message.lower():
+        user = user_data.make_temp_user()
+
+    return user
+
+
 @plan.route("/", methods=["GET"])
 def home():
     return redirect(url_for("chat"))
 
 
 @plan.route("/chat-protected", methods=["POST"])
-@requires_auth
-@get_conversation_id
-def chat_api(user: User, conversation_id: str):
+def chat_api():
     """
     Expects
     { "type" str, "value": str | dict }
@@ -100,6 +146,10 @@ def chat_api(user: User, conversation_id: str):
     See chat.conversation.MessageType
     The whole response is streamed. For each message, "type" is always sent before "value".
 
+    Clients that send "Accept: application/x-ndjson" or "Accept: text/event-stream" instead receive one complete JSON
+    event per message or piece of generated text, as newline-delimited JSON or server-sent events. See
+    chat.messages.stream_message_events.
+
     Example:
         Request:
         {
@@ -126,48 +176,259 @@ def chat_api(user: User, conversation_id: str):
             }
         ]
     """
-    user_message = request.json["value"]
-    print(user)
+    return _respond_to_chat(protected=True)
 
-    if user is None:
-        return jsonify(error="Unauthorized"), 401
 
-    if not user_data.user_exists(user.user_id, temp=False):
-        return jsonify({"message": "Something went wrong. Try logging in again."}), 500
+@plan.route("/chat", methods=["POST"])
+def chat_unprotected():
+    return _respond_to_chat(protected=False)
 
-    message_stream = _build_chat_response(user, conversation_id, user_message)
-    text_stream = stream_messages(message_stream)
 
-    return current_app.response_class(stream_with_context(text_stream), mimetype="application/json")
+@dataclass
+class ChatTurn:
+    user: Optional[User]
+    user_message: str
+    conversation: Optional[Conversation]  # None if there is no user or no message to respond to
+    stream_format: str = JSON_ARRAY
 
 
-@plan.route("/chat", methods=["POST"])
-@get_conversation_id
-def chat_unprotected(conversation_id: str):
-    user_message = request.json.get("value", "")
-    user = user_data.get_temp_user()
+def start_chat_turn(protected: bool) -> ChatTurn | ResponseReturnValue:
+    """
+    Identifies the user of a chat request and loads the conversation to continue, for the chat routes and the ASGI
+    server in asgi.py alike.
 
-    if user_message and "not a robot" in user_message.lower():
-        user = user_data.make_temp_user()
+    :param protected: Whether the user must be logged in, as for /chat-protected, rather than a temporary user
+    :return: The turn to respond to, or an error response if the user may not chat
+    """
+    conversation_id = request.json.get("conversation_id", str(uuid4()))
+
+    if protected:
+        user_message = request.json["value"]
+        user = authenticate_request()
+        print(user)
 
-    message_stream = _build_chat_response(user, conversation_id, user_message)
-    text_stream = stream_messages(message_stream)
+        if user is None:
+            return jsonify(error="Unauthorized"), 401
+
+        if not user_data.user_exists(user.user_id, temp=False):
+            return jsonify({"message": "Something went wrong. Try logging in again."}), 500
+    else:
+        user_message = request.json.get("value", "")
+        user = identify_temp_user(user_message)
+
+    conversation = None
+    if user is not None and user_message:
+        conversation = user_data.get_or_create_conversation(conversation_id, user.user_id)
+
+    return ChatTurn(user=user, user_message=user_message, conversation=conversation,
+                    stream_format=request.accept_mimetypes.best_match(STREAM_FORMATS, default=JSON_ARRAY))
+
+
+def _respond_to_chat(protected: bool):
+    turn = start_chat_turn(protected)
+    if not isinstance(turn, ChatTurn):
+        return turn
+
+    cancel_scope = CancelScope()
+    return _stream_chat_response(_build_chat_response(turn, cancel_scope), turn.stream_format, cancel_scope)
+
+
+def _stream_chat_response(message_stream: Iterator[Message], stream_format: str, cancel_scope: CancelScope):
+    """
+    :param cancel_scope: Cancelled if the client disconnects before the response was sent in full
+    """
+    if stream_format == JSON_ARRAY:
+        chunk_size = current_app.config["CHAT"].get("STREAM_CHUNK_SIZE", chat.utils.json.DEFAULT_CHUNK_SIZE)
+        text_stream = cancel_on_close(stream_messages(message_stream, chunk_size), cancel_scope)
+        return current_app.response_class(stream_with_context(text_stream), mimetype=JSON_ARRAY)
 
-    return current_app.response_class(stream_with_context(text_stream), mimetype="application/json")
+    # Events are generated in another thread, which only notices that the response was closed once the next event is
+    # ready, so the scope is also cancelled right away to stop waiting on the LLM and iDigBio
+    events = with_heartbeats(stream_message_events(message_stream), current_app.config["CHAT"].get("HEARTBEAT", 0))
+    text_stream = cancel_on_close((format_event(event, stream_format) for event in events), cancel_scope)
 
+    response = current_app.response_class(stream_with_context(text_stream), mimetype=stream_format)
+    # Ask proxies, like nginx, to pass each event on as soon as it is sent
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
-def _build_chat_response(user: User, conversation_id: str, user_message: Optional[str]) -> Iterator[
-    Message]:
-    if not user_message and current_app.config["CHAT"]["SHOW_INTRO_MESSAGE"]:
+
+def _build_chat_response(turn: ChatTurn, cancel_scope: CancelScope) -> Iterator[Message]:
+    if not turn.user_message and current_app.config["CHAT"]["SHOW_INTRO_MESSAGE"]:
         yield from chat.api.intro()
 
-    if user is None:
+    if turn.user is None:
         yield from chat.api.are_you_a_robot()
         return
 
-    if user_message:
-        conversation = user_data.get_or_create_conversation(conversation_id, user.user_id)
-        yield from chat.api.chat(ai, conversation, user_message)
+    if turn.user_message:
+        yield from chat.api.chat(ai, turn.conversation, turn.user_message, current_app.config["CHAT"], cancel_scope)
+
+
+@plan.route("/records", methods=["POST"])
+def stream_records():
+    """
+    Streams the records matched by an iDigBio search as newline-delimited JSON, one page per line, so that clients can
+    show the first records while later ones are still being fetched.
+
+    Expects
+    { "rq": dict, "page_size": int (optional), "max_records": int (optional) }
+    where rq is like the value of an "ai_map_message", optionally along with the iDigBio search parameters in
+    RECORDS_SEARCH_PARAMETERS. Other keys are ignored.
+
+    Returns
+    { "itemCount": int, "offset": int, "items": [dict] }
+    for each page, or
+    { "error": str }
+    if a page could not be fetched. Returns status 400 if the body isn't a JSON object, rq is invalid, or page_size or
+    max_records isn't a positive integer.
+    """
+    if not isinstance(request.json, dict):
+        return jsonify(error="Expected a JSON object"), 400
+
+    rq = request.json.get("rq", {})
+    if not _is_valid_rq(rq):
+        return jsonify(error="rq must be an object, like the value of an ai_map_message"), 400
+    params = {"rq": rq} | {k: request.json[k] for k in RECORDS_SEARCH_PARAMETERS if k in request.json}
+
+    config = current_app.config.get("IDIGBIO", {})
+    limits = dict(request.json)
+    page_size = _pop_int(limits, "page_size", config.get("RECORDS_PAGE_SIZE", 100))
+    max_records = _pop_int(limits, "max_records", config.get("RECORDS_MAX", 10000))
+    if page_size is None or max_records is None:
+        return jsonify(error="page_size and max_records must be positive integers"), 400
+
+    page_size = min(page_size, MAX_RECORDS_PAGE_SIZE)
+    max_records = min(max_records, config.get("RECORDS_MAX", 10000))
+
+    def stream_pages() -> Iterator[str]:
+        pages = idigbio_util.paginate_idigbio_search("/v2/search/records", params, page_size, max_records,
+                                                     prefetch=config.get("RECORDS_PREFETCH_PAGES", 2))
+        try:
+            for page in pages:
+                yield json.dumps({"itemCount": page.item_count, "offset": page.offset, "items": page.items}) + "\n"
+        except (idigbio_util.IDigBioError, httpx.HTTPError) as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            pages.close()
+
+    return current_app.response_class(stream_with_context(stream_pages()), mimetype="application/x-ndjson")
+
+
+def _pop_int(params: dict, name: str, default: int, minimum: int = 1) -> Optional[int]:
+    """
+    :return: The parameter, removed from params, or None if it isn't an integer of at least minimum
+    """
+    value = params.pop(name, default)
+    if isinstance(value, bool):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value >= minimum else None
+
+
+@plan.route("/map/geohash", methods=["POST"])
+def get_geohash_grid():
+    """
+    Counts the records matched by an iDigBio search in geohash grid cells, so that maps can show where millions of
+    records are without downloading them.
+
+    Expects
+    { "rq": dict, "zoom": int }
+    where rq is like the value of an "ai_map_message".
+
+    Returns
+    { "precision": int, "itemCount": int, "truncated": bool, "source": str,
+      "buckets": [{ "geohash": str, "count": int, "lat": float, "lon": float }] }
+    or, with status 400,
+    { "error": str }
+    if rq or zoom is invalid, or, with status 502,
+    { "message": str, "error": str }
+    if the iDigBio API failed to respond.
+    """
+    if not isinstance(request.json, dict):
+        return jsonify(error="Expected a JSON object"), 400
+
+    rq = request.json.get("rq", {})
+    if not _is_valid_rq(rq):
+        return jsonify(error="rq must be an object, like the value of an ai_map_message"), 400
+
+    # Zoom levels out of range are clamped by occurrence_maps.precision_for_zoom
+    zoom = _pop_int(dict(request.json), "zoom", 0, minimum=0)
+    if zoom is None:
+        return jsonify(error="zoom must be a non-negative integer"), 400
+
+    config = current_app.config.get("IDIGBIO", {})
+    cache = occurrence_maps.GeohashGridCache(redis.inst, config.get("MAP_GRID_CACHE_TTL", 3600))
+    try:
+        grid = occurrence_maps.get_geohash_grid(rq, zoom, cache,
+                                                max_records=config.get("MAP_GRID_MAX_RECORDS", 10000))
+    except (idigbio_util.IDigBioError, httpx.HTTPError) as e:
+        return idigbio_unavailable(e)
+
+    return jsonify({
+        "precision": grid.precision,
+        "itemCount": grid.item_count,
+        "truncated": grid.truncated,
+        "source": grid.source,
+        "buckets": [{"geohash": b.geohash, "count": b.count, "lat": b.lat, "lon": b.lon} for b in grid.buckets]
+    })
+
+
+@plan.route("/map/tiles/<int:z>/<int:x>/<int:y>.mvt", methods=["GET"])
+def get_occurrence_tile(z: int, x: int, y: int):
+    """
+    Serves the records matched by an iDigBio search as a Mapbox vector tile with an "occurrences" layer of points, so
+    that zoomed-in maps only load the records in view.
+
+    Expects the query parameter
+    rq: JSON like the value of an "ai_map_message"
+
+    Returns status 400 if rq is invalid, and 502 if the iDigBio API failed to respond.
+    """
+    if not (0 <= z <= 24 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify(message=f"No tile {z}/{x}/{y}."), 404
+
+    try:
+        rq = json.loads(request.args.get("rq", "{}"))
+    except ValueError:
+        return jsonify(error="rq is not valid JSON"), 400
+    if not _is_valid_rq(rq):
+        return jsonify(error="rq must be an object, like the value of an ai_map_message"), 400
+
+    config = current_app.config.get("IDIGBIO", {})
+    try:
+        tile = occurrence_maps.get_occurrence_tile(rq, z, x, y, tile_cache,
+                                                   max_points=config.get("TILE_MAX_POINTS", 5000))
+    except (idigbio_util.IDigBioError, httpx.HTTPError) as e:
+        return idigbio_unavailable(e)
+
+    response = current_app.response_class(tile, mimetype="application/vnd.mapbox-vector-tile")
+    response.cache_control.max_age = config.get("MAP_GRID_CACHE_TTL", 3600)
+    return response
+
+
+def _is_valid_rq(rq) -> bool:
+    # Maps of records add their own filters on geopoint, which must be objects
+    return isinstance(rq, dict) and isinstance(rq.get("geopoint", {}), dict)
+
+
+@plan.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Returns the counters and histograms of metrics.snapshot to clients that send the configured METRICS_TOKEN as a
+    bearer token. Returns status 404 if no token is configured, and 401 if the request doesn't have it.
+    """
+    token = current_app.config.get("METRICS_TOKEN")
+    if not token:
+        return jsonify(message="Not found."), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return jsonify(message="Unauthorized."), 401
+
+    return jsonify(metrics.snapshot())
 
 
 @plan.route("/login", methods=["POST"])
@@ -240,7 +501,10 @@ def get_conversation(user: User, conversation_id: str):
     })
 
 
-if __name__ == "__main__":
+def create_app_from_config_file() -> Flask:
+    """
+    Creates the app with settings from ../config.toml and a Postgres database configured by environment variables.
+    """
     load_dotenv()
 
     with open("../config.toml", "rb") as f:
@@ -252,5 +516,9 @@ if __name__ == "__main__":
     engine = create_engine(database_url, echo=True)
     db = DatabaseEngine(engine)
 
-    app = create_app(config, database=db)
+    return create_app(config, database=db)
+
+
+if __name__ == "__main__":
+    app = create_app_from_config_file()
     app.run(debug=True, port=app.config["PORT"], host=app.config["HOST"])  # , ssl_context="adhoc"
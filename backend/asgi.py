@@ -0,0 +1,197 @@
+"""
+ASGI entry point that generates chat responses asynchronously, so that a single worker process can stream many
+conversations at once instead of holding a thread for each one while it waits on the LLM and iDigBio. From the backend
+directory, run
+
+    uvicorn asgi:create_asgi_app --factory --port 8989
+
+Chat routes are served natively. All other routes, as well as the synchronous parts of chat requests like identifying
+users and loading conversations, are handled by the Flask app.
+"""
+import asyncio
+from contextlib import aclosing
+from typing import AsyncIterator, Optional
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import Flask, Response, request
+from flask.typing import ResponseReturnValue
+from werkzeug.test import EnvironBuilder
+
+import chat.api
+from app import ai, ChatTurn, start_chat_turn, create_app_from_config_file
+from chat.messages import Message, astream_messages, astream_message_events, awith_heartbeats, format_event, \
+    JSON_ARRAY
+from chat.utils.json import DEFAULT_CHUNK_SIZE
+
+CHAT_ROUTES = ["/chat", "/chat-protected"]
+
+
+class ChatServer:
+    def __init__(self, flask_app: Flask):
+        self.flask_app = flask_app
+        self.wsgi_app = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await _handle_lifespan(receive, send)
+        elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in CHAT_ROUTES:
+            await self.__chat(scope, receive, send)
+        else:
+            await self.wsgi_app(scope, receive, send)
+
+    async def __chat(self, scope, receive, send):
+        environ = _make_environ(scope, await _read_body(receive))
+        response, turn = await asyncio.to_thread(_start_turn, self.flask_app, environ)
+
+        if turn is None:
+            await _send_response(send, response)
+            return
+
+        # The response is streamed, so its length is unknown
+        response.headers.remove("Content-Length")
+        await send({"type": "http.response.start", "status": response.status_code,
+                    "headers": _encode_headers(response)})
+
+        message_stream = _build_chat_response(turn, self.flask_app.config["CHAT"])
+        if turn.stream_format == JSON_ARRAY:
+            text_stream = astream_messages(message_stream, self.flask_app.config["CHAT"].get("STREAM_CHUNK_SIZE",
+                                                                                              DEFAULT_CHUNK_SIZE))
+        else:
+            text_stream = _aformat_events(awith_heartbeats(astream_message_events(message_stream),
+                                                           self.flask_app.config["CHAT"].get("HEARTBEAT", 0)),
+                                          turn.stream_format)
+
+        sending = asyncio.ensure_future(_send_body(send, text_stream))
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            await asyncio.wait({sending, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnected.cancel()
+
+        if not sending.done():
+            # The client went away, so stop generating the rest of the response, which cancels the turn
+            sending.cancel()
+            try:
+                await sending
+            except asyncio.CancelledError:
+                pass
+            await message_stream.aclose()
+            return
+
+        await sending
+        await send({"type": "http.response.body", "body": b""})
+
+
+def create_asgi_app() -> ChatServer:
+    return ChatServer(create_app_from_config_file())
+
+
+def _start_turn(flask_app: Flask, environ: dict) -> (Response, Optional[ChatTurn]):
+    """
+    Does the synchronous part of handling a chat request in a Flask request context.
+
+    :return: A response with headers set by the Flask app, like session cookies, and the turn to respond to. If the
+    turn is None, the response should be sent as is.
+    """
+    with flask_app.request_context(environ):
+        try:
+            turn = start_chat_turn(protected=request.path == "/chat-protected")
+        except Exception as e:
+            return _finish_response(flask_app, flask_app.handle_user_exception(e)), None
+
+        if isinstance(turn, ChatTurn):
+            response = flask_app.response_class(mimetype=turn.stream_format)
+            if turn.stream_format != JSON_ARRAY:
+                response.headers["Cache-Control"] = "no-cache"
+                response.headers["X-Accel-Buffering"] = "no"
+            return _finish_response(flask_app, response), turn
+        else:
+            return _finish_response(flask_app, turn), None
+
+
+def _finish_response(flask_app: Flask, rv: ResponseReturnValue) -> Response:
+    # Applies after-request handlers, like CORS, and saves the session
+    return flask_app.process_response(flask_app.make_response(rv))
+
+
+async def _build_chat_response(turn: ChatTurn, config: dict) -> AsyncIterator[Message]:
+    if not turn.user_message and config["SHOW_INTRO_MESSAGE"]:
+        for message in chat.api.intro():
+            yield message
+
+    if turn.user is None:
+        for message in chat.api.are_you_a_robot():
+            yield message
+        return
+
+    if turn.user_message:
+        # Close the turn along with this stream, so that it is recorded as cancelled right away
+        async with aclosing(chat.api.achat(ai, turn.conversation, turn.user_message, config)) as messages:
+            async for message in messages:
+                yield message
+
+
+async def _send_body(send, text_stream: AsyncIterator[str]):
+    async for fragment in text_stream:
+        await send({"type": "http.response.body", "body": fragment.encode("utf-8"), "more_body": True})
+
+
+async def _wait_for_disconnect(receive):
+    """
+    Returns once the client disconnects. Only call this once the request body has been read.
+    """
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _aformat_events(events: AsyncIterator[dict], stream_format: str) -> AsyncIterator[str]:
+    async for event in events:
+        yield format_event(event, stream_format)
+
+
+def _make_environ(scope: dict, body: bytes) -> dict:
+    headers = [(k.decode("latin1"), v.decode("latin1")) for k, v in scope["headers"]]
+    host = next((v for k, v in headers if k.lower() == "host"), "localhost")
+
+    environ = EnvironBuilder(
+        path=scope["path"],
+        base_url=f"{scope.get('scheme', 'http')}://{host}{scope.get('root_path', '')}",
+        query_string=scope["query_string"].decode("latin1"),
+        method=scope["method"],
+        headers=headers,
+        data=body
+    ).get_environ()
+
+    if scope.get("client") is not None:
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    return environ
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+def _encode_headers(response: Response) -> list[tuple[bytes, bytes]]:
+    return [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in response.headers.to_wsgi_list()]
+
+
+async def _send_response(send, response: Response):
+    await send({"type": "http.response.start", "status": response.status_code, "headers": _encode_headers(response)})
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+
+async def _handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,197 @@
+"""
+Stops the work done for a chat turn once its response is no longer being sent, e.g. because the user closed the page.
+Work running on behalf of a turn checks the current CancelScope between steps, and open streams, like LLM responses,
+are registered with it so that they can be closed as soon as the turn is cancelled.
+"""
+import inspect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Iterator, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+
+
+class Cancelled(Exception):
+    """
+    Raised by work that was started for a turn that has since been cancelled.
+    """
+
+
+class CancelScope:
+    """
+    Tracks whether a turn was cancelled. Can be cancelled from any thread.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__cancelled = threading.Event()
+        self.__resources: list = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__cancelled.is_set()
+
+    def cancel(self):
+        """
+        Marks the turn as cancelled and closes the resources registered with it.
+        """
+        for resource in self.__cancel():
+            _close(resource)
+
+    async def acancel(self):
+        """
+        Like cancel, but also closes resources that are closed asynchronously, like AsyncOpenAI response streams.
+        """
+        for resource in self.__cancel():
+            result = _close(resource)
+            if inspect.isawaitable(result):
+                await result
+
+    def close(self):
+        """
+        Same as cancel, so that scopes can be registered as resources of other scopes, see child.
+        """
+        self.cancel()
+
+    def child(self) -> "CancelScope":
+        """
+        :return: A scope that is cancelled along with this one, but that can also be cancelled on its own, e.g. to
+        stop work done for one part of a turn. Discard it from this scope once that work is done.
+        """
+        child = CancelScope()
+        self.add(child)
+        return child
+
+    def check(self, skipped: str = None):
+        """
+        :param skipped: A counter to increment if the turn was cancelled, to measure the work that cancelling saved
+        :raises Cancelled: If the turn was cancelled
+        """
+        if self.cancelled:
+            if skipped is not None:
+                metrics.increment(skipped)
+            raise Cancelled()
+
+    def add(self, resource):
+        """
+        Registers a resource, like a response stream, to close when the turn is cancelled. Resources that are added
+        after the turn was cancelled are closed right away.
+        """
+        with self.__lock:
+            if not self.cancelled:
+                self.__resources.append(resource)
+                return
+        _close(resource)
+
+    def discard(self, resource):
+        """
+        Unregisters a resource, e.g. because it was closed by its owner.
+        """
+        with self.__lock:
+            self.__resources = [r for r in self.__resources if r is not resource]
+
+    def __cancel(self) -> list:
+        with self.__lock:
+            self.__cancelled.set()
+            resources, self.__resources = self.__resources, []
+        return resources
+
+
+_current_scope: ContextVar[CancelScope | None] = ContextVar("current_cancel_scope", default=None)
+
+
+def current_scope() -> CancelScope | None:
+    return _current_scope.get()
+
+
+@contextmanager
+def activate(scope: CancelScope) -> Iterator[CancelScope]:
+    """
+    Makes scope the current scope within the block, including in threads started with a copy of its context.
+    """
+    previous = _current_scope.get()
+    _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        # Restore rather than reset with a token, see metrics.track_turn
+        _current_scope.set(previous)
+
+
+def check_cancelled(skipped: str = None):
+    """
+    :param skipped: See CancelScope.check
+    :raises Cancelled: If the current turn was cancelled
+    """
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.check(skipped)
+
+
+def cancellable(items: Iterator[T], skipped: str = None) -> Iterator[T]:
+    """
+    Iterates over items until the current turn is cancelled, then raises Cancelled. The scope is looked up right away,
+    so the returned iterator can be consumed from any context. items is closed when the returned iterator is.
+
+    :param skipped: See CancelScope.check, incremented for the first item that is skipped
+    """
+    return _cancellable(items, _current_scope.get(), skipped)
+
+
+def _cancellable(items: Iterator[T], scope: CancelScope | None, skipped: str | None) -> Iterator[T]:
+    iterator = iter(items)
+    try:
+        while True:
+            if scope is not None:
+                scope.check(skipped)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        _close(iterator)
+
+
+def acancellable(items: AsyncIterator[T], skipped: str = None) -> AsyncIterator[T]:
+    """
+    Asynchronous version of cancellable.
+    """
+    return _acancellable(items, _current_scope.get(), skipped)
+
+
+async def _acancellable(items: AsyncIterator[T], scope: CancelScope | None, skipped: str | None) -> AsyncIterator[T]:
+    iterator = aiter(items)
+    try:
+        while True:
+            if scope is not None:
+                scope.check(skipped)
+            try:
+                item = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+def cancel_on_close(stream: Iterator[T], scope: CancelScope) -> Iterator[T]:
+    """
+    Cancels scope if stream is closed before it is exhausted, which is how WSGI servers signal that the client
+    disconnected.
+    """
+    try:
+        yield from stream
+    except GeneratorExit:
+        scope.cancel()
+        raise
+
+
+def _close(resource):
+    close = getattr(resource, "close", None)
+    if close is not None:
+        return close()
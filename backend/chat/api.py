@@ -1,14 +1,37 @@
-from typing import List, Iterator
+import asyncio
+import contextvars
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Iterator, Literal, Optional, AsyncIterator
 
 from pydantic import BaseModel, Field
 
+import cancellation
+import metrics
+from cancellation import CancelScope, cancellable, acancellable
+from chat import fast_path
 from chat.conversation import Conversation
-from chat.messages import UserMessage, ErrorMessage, Message, AiChatMessage
+from chat.messages import UserMessage, ErrorMessage, Message, AiChatMessage, CancelledMessage
 from chat.tools.tool import all_tools
+from chat.utils.summary import summarize_messages
 from nlp.ai import AI
 
 tool_lookup = {t.name: t for t in all_tools}
 
+# "fused" breaks down the user's message and picks a tool for each request in a single LLM call. "two_stage" breaks
+# down the message first and then makes one more call per request to pick a tool.
+ROUTING_MODES = ["fused", "two_stage"]
+DEFAULT_ROUTING = "fused"
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+
+# Messages that the fast path matches with at least this confidence skip the routing LLM calls
+DEFAULT_FAST_PATH_THRESHOLD = 0.9
+
+# Bucket upper bounds for histograms of bytes downloaded from iDigBio per turn
+TURN_BYTES_BUCKETS = (0, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+
 
 def are_you_a_robot() -> Iterator[Message]:
     yield AiChatMessage("Before we can chat, please confirm you are a real person by telling me \"I am not a robot\".")
@@ -18,19 +41,179 @@ def intro() -> Iterator[Message]:
     yield AiChatMessage(HELP_MESSAGE)
 
 
-def chat(ai: AI, conversation: Conversation, user_text_message: str) -> Iterator[Message]:
+def chat(ai: AI, conversation: Conversation, user_text_message: str, config: dict = None,
+         cancel_scope: CancelScope = None) -> Iterator[Message]:
+    """
+    :param config: Chat settings, see the [CHAT] section of config.toml.template
+    :param cancel_scope: Cancelled when the response is no longer being sent, e.g. because the client disconnected.
+    The turn is also cancelled if the returned iterator is closed before it is exhausted. Either way, the work left for
+    the turn is stopped and what was generated until then is recorded, followed by a CancelledMessage.
+    """
+    if config is None:
+        config = {}
+    routing = config.get("ROUTING", DEFAULT_ROUTING)
+    max_concurrent_requests = config.get("MAX_CONCURRENT_REQUESTS", DEFAULT_MAX_CONCURRENT_REQUESTS)
+    fast_path_threshold = _get_fast_path_threshold(config)
+    if cancel_scope is None:
+        cancel_scope = CancelScope()
+
     conversation.append(UserMessage(user_text_message))
 
-    response = _make_response(ai, conversation, user_text_message)
+    with metrics.track_turn() as turn, cancellation.activate(cancel_scope):
+        response = _make_response(ai, conversation, user_text_message, routing, max_concurrent_requests,
+                                  fast_path_threshold)
+
+        # The message being sent, which is only recorded once it has been sent in full
+        unrecorded = None
+        try:
+            for unrecorded in response:
+                yield unrecorded
+                conversation.append(unrecorded)
+                unrecorded = None
+        except GeneratorExit:
+            _cancel_turn(cancel_scope, response, conversation, unrecorded)
+            _record_turn(turn, routing, cancelled=True)
+            raise
+        except Exception:
+            # Work that was cancelled may also fail in other ways, e.g. when its response stream was closed
+            if not cancel_scope.cancelled:
+                raise
+            _cancel_turn(cancel_scope, response, conversation, unrecorded)
+            _record_turn(turn, routing, cancelled=True)
+            return
+
+        # Messages may be recorded in the background, so make sure that they are stored before the turn ends
+        conversation.flush()
+
+    _record_turn(turn, routing)
+    _update_summary_in_background(ai, conversation)
 
-    for message in response:
-        yield message
-        conversation.append(message)
 
+async def achat(ai: AI, conversation: Conversation, user_text_message: str, config: dict = None,
+                cancel_scope: CancelScope = None) -> AsyncIterator[Message]:
+    """
+    Asynchronous version of chat. Messages are recorded from worker threads so that database writes don't block the
+    event loop. The turn is also cancelled if the task consuming it is.
+
+    :param config: Chat settings, see the [CHAT] section of config.toml.template
+    :param cancel_scope: See chat
+    """
+    if config is None:
+        config = {}
+    routing = config.get("ROUTING", DEFAULT_ROUTING)
+    max_concurrent_requests = config.get("MAX_CONCURRENT_REQUESTS", DEFAULT_MAX_CONCURRENT_REQUESTS)
+    fast_path_threshold = _get_fast_path_threshold(config)
+    if cancel_scope is None:
+        cancel_scope = CancelScope()
+
+    await asyncio.to_thread(conversation.append, UserMessage(user_text_message))
+
+    with metrics.track_turn() as turn, cancellation.activate(cancel_scope):
+        response = _amake_response(ai, conversation, user_text_message, routing, max_concurrent_requests,
+                                   fast_path_threshold)
+
+        unrecorded = None
+        try:
+            async for unrecorded in response:
+                yield unrecorded
+                await unrecorded.complete()
+                await asyncio.to_thread(conversation.append, unrecorded)
+                unrecorded = None
+        except (GeneratorExit, asyncio.CancelledError):
+            await _acancel_turn(cancel_scope, response, conversation, unrecorded)
+            _record_turn(turn, routing, cancelled=True)
+            raise
+        except Exception:
+            if not cancel_scope.cancelled:
+                raise
+            await _acancel_turn(cancel_scope, response, conversation, unrecorded)
+            _record_turn(turn, routing, cancelled=True)
+            return
+
+        await asyncio.to_thread(conversation.flush)
 
-def _handle_individual_request(ai: AI, conversation: Conversation, request: str) -> Iterator[Message]:
-    plan = create_plan(ai, conversation, request)
-    tool_name = plan
+    _record_turn(turn, routing)
+    _update_summary_in_background(ai, conversation)
+
+
+def _get_fast_path_threshold(config: dict) -> Optional[float]:
+    """
+    :return: The confidence needed to take the fast path, or None if it is disabled
+    """
+    if not config.get("FAST_PATH", True):
+        return None
+    return config.get("FAST_PATH_THRESHOLD", DEFAULT_FAST_PATH_THRESHOLD)
+
+
+def _record_turn(turn: metrics.TurnStats, routing: str, cancelled: bool = False):
+    llm_calls = turn.get("llm.calls")
+    print(f"LLM CALLS: {llm_calls}, CACHED PROMPT TOKENS: {turn.get('llm.cached_prompt_tokens')}/"
+          f"{turn.get('llm.prompt_tokens')}")
+    print(f"IDIGBIO: {turn.get('idigbio.downloaded_bytes'):.0f} bytes downloaded, "
+          f"{turn.get('idigbio.parse_seconds') * 1000:.1f} ms parsing")
+    if cancelled:
+        # Counters for the work that was skipped are incremented where it would have been done
+        print(f"CANCELLED: {turn.get('llm.cancelled_calls'):.0f} LLM calls skipped, "
+              f"{turn.get('llm.cancelled_streams'):.0f} LLM streams closed, "
+              f"{turn.get('idigbio.cancelled_requests'):.0f} iDigBio requests skipped")
+        metrics.increment(f"chat.cancelled_turns.{routing}")
+    metrics.observe("chat.turn_idigbio_bytes", turn.get("idigbio.downloaded_bytes"), TURN_BYTES_BUCKETS)
+    metrics.increment(f"chat.turns.{routing}")
+    metrics.increment(f"chat.turn_llm_calls.{routing}", llm_calls)
+
+
+def _cancel_turn(scope: CancelScope, response: Iterator[Message], conversation: Conversation,
+                 unrecorded: Optional[Message]):
+    """
+    Stops the work left for a cancelled turn and records what was generated until then.
+
+    :param unrecorded: The message that was being sent when the turn was cancelled, if any
+    """
+    scope.cancel()
+    response.close()
+    if unrecorded is not None:
+        unrecorded.close()
+        conversation.append(unrecorded)
+    conversation.append(CancelledMessage())
+    conversation.flush()
+
+
+async def _acancel_turn(scope: CancelScope, response: AsyncIterator[Message], conversation: Conversation,
+                        unrecorded: Optional[Message]):
+    """
+    Asynchronous version of _cancel_turn.
+    """
+    await scope.acancel()
+    await response.aclose()
+    if unrecorded is not None:
+        await unrecorded.aclose()
+        await unrecorded.complete()
+        await asyncio.to_thread(conversation.append, unrecorded)
+    await asyncio.to_thread(conversation.append, CancelledMessage())
+    await asyncio.to_thread(conversation.flush)
+
+
+def _update_summary_in_background(ai: AI, conversation: Conversation):
+    """
+    Summarizes messages that fell out of the conversation's rendering window. This is done after responding so that
+    users don't have to wait for it; until the summary is ready, those messages are still rendered verbatim.
+    """
+    if not conversation.needs_summary_update():
+        return
+
+    summarize = partial(summarize_messages, ai)
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(conversation.update_summary, summarize),
+                              name="summary", daemon=True)
+    thread.start()
+
+
+def _handle_individual_request(ai: AI, conversation: Conversation, request: str, tool_name: str = None) -> \
+        Iterator[Message]:
+    """
+    :param tool_name: The tool to address the request with. If not specified, asks the LLM to pick one.
+    """
+    if tool_name is None:
+        tool_name = create_plan(ai, conversation, request)
 
     if tool_name in tool_lookup:
         tool = tool_lookup[tool_name]()
@@ -42,14 +225,133 @@ def _handle_individual_request(ai: AI, conversation: Conversation, request: str)
             state={}
         )
 
-        for message in response:
+        for message in cancellable(response):
+            message.tool_name = tool_name
+            yield message
+    else:
+        yield ErrorMessage(f"Tried to use undefined tool \"{tool_name}\"")
+
+
+async def _ahandle_individual_request(ai: AI, conversation: Conversation, request: str, tool_name: str = None) -> \
+        AsyncIterator[Message]:
+    if tool_name is None:
+        tool_name = await acreate_plan(ai, conversation, request)
+
+    if tool_name in tool_lookup:
+        tool = tool_lookup[tool_name]()
+
+        response = tool.acall(
+            ai=ai,
+            request=request,
+            conversation=conversation,
+            state={}
+        )
+
+        async for message in acancellable(response):
             message.tool_name = tool_name
             yield message
     else:
         yield ErrorMessage(f"Tried to use undefined tool \"{tool_name}\"")
 
 
-def _make_response(ai: AI, conversation: Conversation, user_message: str) -> Iterator[Message]:
+def _run_individual_request(scope: CancelScope, ai: AI, conversation: Conversation, request: str,
+                            tool_name: str = None) -> list[Message]:
+    """
+    Fully addresses a request, e.g. in a background thread. Messages are appended to the conversation as they are made
+    so that later steps of the request can see them, just like when the request is streamed.
+
+    :param scope: Stops the request when cancelled
+    """
+    messages = []
+    with cancellation.activate(scope):
+        for message in _handle_individual_request(ai, conversation, request, tool_name):
+            conversation.append(message)
+            messages.append(message)
+    return messages
+
+
+def _handle_requests(ai: AI, conversation: Conversation, requests: list[tuple[str, Optional[str]]],
+                     max_concurrent_requests: int) -> Iterator[Message]:
+    """
+    Addresses each request, yielding their messages in the same order as the requests. The first request is streamed
+    while the others run in the background, with at most max_concurrent_requests running at once. Background requests
+    see the conversation as it was at the start of the turn.
+    """
+    if max_concurrent_requests <= 1 or len(requests) <= 1:
+        for request, tool_name in requests:
+            yield from _handle_individual_request(ai, conversation, request, tool_name)
+        return
+
+    # Background requests are cancelled along with the turn, and also once the turn stops waiting for them, e.g.
+    # because the first request failed
+    turn_scope = cancellation.current_scope()
+    scopes = [CancelScope() if turn_scope is None else turn_scope.child() for _ in requests[1:]]
+    executor = ThreadPoolExecutor(max_workers=max_concurrent_requests - 1, thread_name_prefix="request")
+    try:
+        background = [
+            # Copy the context so that background work is counted towards the current turn
+            executor.submit(contextvars.copy_context().run, _run_individual_request, scope, ai, conversation.fork(),
+                            request, tool_name)
+            for scope, (request, tool_name) in zip(scopes, requests[1:])
+        ]
+
+        request, tool_name = requests[0]
+        yield from _handle_individual_request(ai, conversation, request, tool_name)
+
+        for future in background:
+            yield from future.result()
+    finally:
+        for scope in scopes:
+            scope.cancel()
+            if turn_scope is not None:
+                turn_scope.discard(scope)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def _arun_individual_request(ai: AI, conversation: Conversation, request: str, tool_name: str = None) -> \
+        list[Message]:
+    messages = []
+    async for message in _ahandle_individual_request(ai, conversation, request, tool_name):
+        await message.complete()
+        conversation.append(message)
+        messages.append(message)
+    return messages
+
+
+async def _ahandle_requests(ai: AI, conversation: Conversation, requests: list[tuple[str, Optional[str]]],
+                            max_concurrent_requests: int) -> AsyncIterator[Message]:
+    """
+    Asynchronous version of _handle_requests.
+    """
+    if max_concurrent_requests <= 1 or len(requests) <= 1:
+        for request, tool_name in requests:
+            async for message in _ahandle_individual_request(ai, conversation, request, tool_name):
+                yield message
+        return
+
+    limit = asyncio.Semaphore(max_concurrent_requests - 1)
+
+    async def run_in_background(fork: Conversation, request: str, tool_name: Optional[str]) -> list[Message]:
+        async with limit:
+            return await _arun_individual_request(ai, fork, request, tool_name)
+
+    background = [asyncio.create_task(run_in_background(conversation.fork(), request, tool_name))
+                  for request, tool_name in requests[1:]]
+    try:
+        request, tool_name = requests[0]
+        async for message in _ahandle_individual_request(ai, conversation, request, tool_name):
+            yield message
+
+        for task in background:
+            for message in await task:
+                yield message
+    finally:
+        for task in background:
+            task.cancel()
+
+
+def _make_response(ai: AI, conversation: Conversation, user_message: str, routing: str = DEFAULT_ROUTING,
+                   max_concurrent_requests: int = 1, fast_path_threshold: float = None) -> Iterator[Message]:
     baked_response = _get_baked_response(user_message)
     if baked_response is not None:
         i = 0
@@ -59,14 +361,94 @@ def _make_response(ai: AI, conversation: Conversation, user_message: str) -> Ite
         if i > 0:
             return
 
-    requests = _break_down_message_into_smaller_requests(ai, conversation, user_message)
+    requests = _plan_requests(ai, conversation, user_message, routing, fast_path_threshold)
 
     if len(requests) == 0:
         request = user_message
         yield from _respond_conversationally(ai, conversation, request)
     else:
-        for request in requests:
-            yield from _handle_individual_request(ai, conversation, request)
+        yield from _handle_requests(ai, conversation, requests, max_concurrent_requests)
+
+
+async def _amake_response(ai: AI, conversation: Conversation, user_message: str, routing: str = DEFAULT_ROUTING,
+                          max_concurrent_requests: int = 1, fast_path_threshold: float = None) -> \
+        AsyncIterator[Message]:
+    baked_response = list(_get_baked_response(user_message))
+    if len(baked_response) > 0:
+        for message in baked_response:
+            yield message
+        return
+
+    requests = await _aplan_requests(ai, conversation, user_message, routing, fast_path_threshold)
+
+    if len(requests) == 0:
+        async for message in tool_lookup["converse"]().acall(ai, conversation, user_message, {}):
+            yield message
+    else:
+        async for message in _ahandle_requests(ai, conversation, requests, max_concurrent_requests):
+            yield message
+
+
+def _plan_requests(ai: AI, conversation: Conversation, user_message: str, routing: str,
+                   fast_path_threshold: float = None) -> list[tuple[str, Optional[str]]]:
+    """
+    :param fast_path_threshold: The confidence needed to route the message without the LLM, or None to always use it
+    :return: Pairs of individual requests and the names of the tools to address them with. Tool names are None if they
+    have yet to be picked.
+    """
+    fast_path_requests = _take_fast_path(user_message, fast_path_threshold)
+    if fast_path_requests is not None:
+        return fast_path_requests
+
+    match routing:
+        case "fused":
+            routed = _route_message(ai, conversation, user_message)
+            _log_routed_tool_choices(ai, routed)
+            return [(r.request, r.tool_name) for r in routed]
+        case "two_stage":
+            return [(r, None) for r in _break_down_message_into_smaller_requests(ai, conversation, user_message)]
+        case _:
+            raise ValueError(f"Unknown routing mode \"{routing}\", expected one of {ROUTING_MODES}")
+
+
+async def _aplan_requests(ai: AI, conversation: Conversation, user_message: str, routing: str,
+                          fast_path_threshold: float = None) -> list[tuple[str, Optional[str]]]:
+    fast_path_requests = _take_fast_path(user_message, fast_path_threshold)
+    if fast_path_requests is not None:
+        return fast_path_requests
+
+    match routing:
+        case "fused":
+            routed = await _aroute_message(ai, conversation, user_message)
+            await asyncio.to_thread(_log_routed_tool_choices, ai, routed)
+            return [(r.request, r.tool_name) for r in routed]
+        case "two_stage":
+            return [(r, None) for r in await _abreak_down_message_into_smaller_requests(ai, conversation, user_message)]
+        case _:
+            raise ValueError(f"Unknown routing mode \"{routing}\", expected one of {ROUTING_MODES}")
+
+
+def _take_fast_path(user_message: str, threshold: Optional[float]) -> Optional[list[tuple[str, Optional[str]]]]:
+    """
+    :return: The user's message as a single request routed by chat.fast_path, or None if the LLM should route it
+    """
+    if threshold is None:
+        return None
+
+    match = fast_path.classify(user_message)
+    if match is None:
+        metrics.increment("fast_path.misses")
+        return None
+
+    if match.confidence < threshold:
+        metrics.increment("fast_path.fallbacks")
+        print(f"FAST PATH FALLBACK: {match.tool_name} ({match.rule}, {match.confidence})")
+        return None
+
+    metrics.increment("fast_path.hits")
+    metrics.increment(f"fast_path.hits.{match.tool_name}")
+    print(f"FAST PATH: {match.tool_name} ({match.rule}, {match.confidence})")
+    return [(user_message, match.tool_name)]
 
 
 HELP_MESSAGE = """\
@@ -147,25 +529,151 @@ class RequestBreakdown(BaseModel):
 
 
 def _break_down_message_into_smaller_requests(ai: AI, conversation: Conversation, user_message: str) -> [str]:
-    response = ai.client.chat.completions.create(
+    response = ai.client.chat.completions.create(**_break_down_request(conversation))
+    print(F"REQUESTS: {response.requests}")
+    return response.requests
+
+
+async def _abreak_down_message_into_smaller_requests(ai: AI, conversation: Conversation, user_message: str) -> \
+        [str]:
+    response = await ai.async_client.chat.completions.create(**_break_down_request(conversation))
+    print(F"REQUESTS: {response.requests}")
+    return response.requests
+
+
+def _break_down_request(conversation: Conversation) -> dict:
+    return dict(
         model="gpt-4o",
         temperature=0,
         max_retries=5,
         response_model=RequestBreakdown,
         messages=conversation.render_to_openai(BREAK_DOWN_PROMPT),
     )
-    print(F"REQUESTS: {response.requests}")
+
+
+_TOOL_LIST = "\n".join(f"- {t.name}: {t.description.strip()}" for t in all_tools)
+
+ROUTING_PROMPT = f"""\
+{BREAK_DOWN_PROMPT}
+
+For each individual request, also pick the tool that should be used to address it. If the user is not requesting 
+information or if no tool addresses the request, pick the tool named "converse". Do not answer requests yourself.
+
+Here are the tools you can pick from:
+
+{_TOOL_LIST}
+
+Here is an example of picking tools for individual requests.
+
+- User: I want to know what plant species are present in Florida and to see them on a map
+- Assistant: [
+    {{"request": "what plant species are present in Florida", "tool_name": "count_species_occurrence_records"}}, 
+    {{"request": "show plant species in Florida on a map", "tool_name": "show_map_of_species_occurrences"}}
+]\
+"""
+
+ToolName = Literal[tuple(tool_lookup)]
+
+
+class RoutedRequest(BaseModel):
+    """
+    This schema represents an individual request extracted from a user message and the tool picked to address it.
+    """
+    request: str = Field(...,
+                         description="An individual request like \"show a map of Homo sapiens\" or \"count the number "
+                                     "of records for Homo Sapiens in iDigBio\".")
+    tool_name: ToolName = Field(..., description="The name of the tool to use to address the request.")
+
+
+class RequestRouting(BaseModel):
+    """
+    This schema represents a list of individual requests extracted from a user message, each paired with a tool.
+    """
+    requests: List[RoutedRequest] = Field(...,
+                                          description="This is an array of individual requests and the tools to "
+                                                      "address them with.")
+
+
+def _route_message(ai: AI, conversation: Conversation, user_message: str) -> list[RoutedRequest]:
+    """
+    Breaks down the user's message into individual requests and picks a tool for each, all in one LLM call.
+    """
+    response = ai.client.chat.completions.create(**_routing_request(conversation))
+    print(F"ROUTED REQUESTS: {[(r.request, r.tool_name) for r in response.requests]}")
     return response.requests
 
 
+async def _aroute_message(ai: AI, conversation: Conversation, user_message: str) -> list[RoutedRequest]:
+    response = await ai.async_client.chat.completions.create(**_routing_request(conversation))
+    print(F"ROUTED REQUESTS: {[(r.request, r.tool_name) for r in response.requests]}")
+    return response.requests
+
+
+def _routing_request(conversation: Conversation) -> dict:
+    return dict(
+        model="gpt-4o",
+        temperature=0,
+        max_retries=5,
+        response_model=RequestRouting,
+        messages=conversation.render_to_openai(ROUTING_PROMPT),
+    )
+
+
 function_definitions = [{"name": t.name, "description": t.description} for t in all_tools]
 
 
 def create_plan(ai: AI, conversation: Conversation, request: str) -> str:
-    tool_name = _pick_a_tool(ai, conversation, request)
+    tool_name = _classify_tool(ai, request)
+    if tool_name is None:
+        tool_name = _pick_a_tool(ai, conversation, request)
+        _log_tool_choice(ai, request, tool_name)
+    return tool_name
+
+
+async def acreate_plan(ai: AI, conversation: Conversation, request: str) -> str:
+    tool_name = _classify_tool(ai, request)
+    if tool_name is None:
+        tool_name = await _apick_a_tool(ai, conversation, request)
+        await asyncio.to_thread(_log_tool_choice, ai, request, tool_name)
+    return tool_name
+
+
+def _classify_tool(ai: AI, request: str) -> Optional[str]:
+    """
+    :return: The tool picked by the local classifier, or None if it isn't confident enough and the LLM should pick
+    """
+    if ai.tool_classifier is None:
+        return None
+
+    tool_name, confidence = ai.tool_classifier.predict(request)
+    if confidence < ai.tool_classifier_threshold or tool_name not in tool_lookup:
+        metrics.increment("tool_classifier.fallbacks")
+        return None
+
+    metrics.increment("tool_classifier.hits")
+    print(f"CLASSIFIED TOOL: {tool_name} ({confidence:.2f})")
     return tool_name
 
 
+_tool_choice_log_lock = threading.Lock()
+
+
+def _log_tool_choice(ai: AI, request: str, tool_name: str):
+    """
+    Records the LLM's choice of tool as a training example for the local classifier, see nlp.intent_classifier.
+    """
+    if ai.tool_choice_log is None:
+        return
+
+    with _tool_choice_log_lock, open(ai.tool_choice_log, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"request": request, "tool_name": tool_name}) + "\n")
+
+
+def _log_routed_tool_choices(ai: AI, routed: list[RoutedRequest]):
+    for r in routed:
+        _log_tool_choice(ai, r.request, r.tool_name)
+
+
 _PICK_A_TOOL_PROMPT = """
 You call functions to retrieve information that may help answer the user's biodiversity-related queries. You do not 
 answer queries yourself. If the user is not requesting information or if no function addresses the user's query, 
@@ -194,7 +702,17 @@ You: converse
 
 
 def _pick_a_tool(ai: AI, conversation: Conversation, request: str) -> str:
-    result = ai.client.chat.completions.create(
+    result = ai.client.chat.completions.create(**_pick_a_tool_request(conversation, request))
+    return _get_picked_tool(result)
+
+
+async def _apick_a_tool(ai: AI, conversation: Conversation, request: str) -> str:
+    result = await ai.async_client.chat.completions.create(**_pick_a_tool_request(conversation, request))
+    return _get_picked_tool(result)
+
+
+def _pick_a_tool_request(conversation: Conversation, request: str) -> dict:
+    return dict(
         model="gpt-4o",
         temperature=0,
         response_model=None,
@@ -203,6 +721,8 @@ def _pick_a_tool(ai: AI, conversation: Conversation, request: str) -> str:
         messages=conversation.render_to_openai(_PICK_A_TOOL_PROMPT, request)
     )
 
+
+def _get_picked_tool(result) -> str:
     fn_call = result.choices[0].message.function_call
     if fn_call is None:
         return "converse"
@@ -1,52 +1,201 @@
 import itertools
-from typing import Iterator, Callable
+from typing import AsyncIterator, Iterator
 
 Content = str | dict
 
 
+class Accumulator:
+    """
+    Collects the deltas of streamed content.
+    """
+
+    def add(self, delta: Content) -> None:
+        pass
+
+    def get(self) -> Content:
+        pass
+
+
+class TextAccumulator(Accumulator):
+    """
+    Collects text deltas in a list and only joins them when the text is read, so that a text streamed in n deltas is
+    built in O(n) instead of copied once per delta.
+    """
+
+    def __init__(self):
+        self.__parts: list[str] = []
+
+    def add(self, delta: str) -> None:
+        self.__parts.append(delta)
+
+    def get(self) -> str:
+        if len(self.__parts) > 1:
+            self.__parts = ["".join(self.__parts)]
+        return self.__parts[0] if self.__parts else ""
+
+
+class LastAccumulator(Accumulator):
+    """
+    Keeps only the latest delta.
+    """
+
+    def __init__(self):
+        self.__content: Content = ""
+
+    def add(self, delta: Content) -> None:
+        self.__content = delta
+
+    def get(self) -> Content:
+        return self.__content
+
+
+class DictAccumulator(Accumulator):
+    """
+    Merges dict deltas, like the partial JSON objects generated by an LLM: text values are appended to the text
+    already received for the same key, dicts are merged recursively and other values replace earlier ones.
+    """
+
+    def __init__(self):
+        self.__fields: dict[str, Accumulator] = {}
+
+    def add(self, delta: dict) -> None:
+        for key, value in delta.items():
+            field = self.__fields.get(key)
+            if field is None or not isinstance(field, _accumulator_type(value)):
+                field = self.__fields[key] = _accumulator_type(value)()
+            field.add(value)
+
+    def get(self) -> dict:
+        return {key: field.get() for key, field in self.__fields.items()}
+
+
+def _accumulator_type(value: Content) -> type[Accumulator]:
+    if isinstance(value, str):
+        return TextAccumulator
+    if isinstance(value, dict):
+        return DictAccumulator
+    return LastAccumulator
+
+
 class StreamedContent:
-    __content: Content
+    __accumulator: Accumulator
+    __source: Iterator[Content]
     __stream: Iterator[Content]
-    __reducer: Callable[[Content, Content], Content]
 
-    def __init__(self, stream: Iterator[Content], reducer):
-        self.__content = ""
+    def __init__(self, stream: Iterator[Content], accumulator: Accumulator):
+        self.__accumulator = accumulator
+        self.__source = stream
         self.__stream = self.__cache_content(stream)
-        self.__reducer = reducer
 
     def __iter__(self) -> Iterator[Content]:
-        return itertools.chain(iter([self.__content]), self.__stream)
+        return itertools.chain(iter([self.__accumulator.get()]), self.__stream)
 
     def __cache_content(self, stream) -> Iterator[Content]:
         for delta in stream:
-            self.__content = self.__reducer(self.__content, delta)
+            self.__accumulator.add(delta)
             yield delta
 
     def gobble(self) -> None:
         for _ in self.__stream:
             pass
 
+    def close(self) -> None:
+        """
+        Stops streaming, e.g. because the turn was cancelled. The content streamed so far is kept.
+        """
+        self.__stream.close()
+        if hasattr(self.__source, "close"):
+            self.__source.close()
+
     def get(self) -> Content:
         self.gobble()
-        return self.__content
+        return self.__accumulator.get()
 
 
-def _add_strings(a: str, b: str) -> str:
-    return a + b
+class StreamedString(StreamedContent):
+    def __init__(self, stream: Iterator[Content]):
+        super().__init__(stream, TextAccumulator())
 
 
-class StreamedString(StreamedContent):
+class StreamedLast(StreamedContent):
     def __init__(self, stream: Iterator[Content]):
-        super().__init__(stream, _add_strings)
+        super().__init__(stream, LastAccumulator())
 
+    def __iter__(self) -> Iterator[Content]:
+        return iter([self.get()])
 
-def _take_last(old, new):
-    return new
 
+class StreamedDict(StreamedContent):
+    """
+    A dict streamed in partial dicts, see DictAccumulator.
+    """
 
-class StreamedLast(StreamedContent):
-    def __init__(self, stream: Iterator[Content]):
-        super().__init__(stream, _take_last)
+    def __init__(self, stream: Iterator[dict]):
+        super().__init__(stream, DictAccumulator())
 
     def __iter__(self) -> Iterator[Content]:
         return iter([self.get()])
+
+
+class AsyncStreamedContent:
+    """
+    Like StreamedContent, but for content that is generated asynchronously, e.g. by an AsyncOpenAI response stream.
+    Once fully consumed, it can also be iterated synchronously, e.g. to freeze the message that contains it.
+    """
+    __accumulator: Accumulator
+    __source: AsyncIterator[Content]
+    __stream: AsyncIterator[Content]
+
+    def __init__(self, stream: AsyncIterator[Content], accumulator: Accumulator):
+        self.__accumulator = accumulator
+        self.__source = stream
+        self.__stream = self.__cache_content(stream)
+        self.__done = False
+
+    async def __aiter__(self) -> AsyncIterator[Content]:
+        yield self.__accumulator.get()
+        async for delta in self.__stream:
+            yield delta
+
+    def __iter__(self) -> Iterator[Content]:
+        if not self.__done:
+            raise RuntimeError("Asynchronously streamed content must be consumed before it can be read synchronously")
+        return iter([self.__accumulator.get()])
+
+    async def __cache_content(self, stream) -> AsyncIterator[Content]:
+        async for delta in stream:
+            self.__accumulator.add(delta)
+            yield delta
+        self.__done = True
+
+    async def gobble(self) -> None:
+        async for _ in self.__stream:
+            pass
+
+    async def aclose(self) -> None:
+        """
+        Asynchronous version of StreamedContent.close. Afterwards, the content streamed so far can also be read
+        synchronously.
+        """
+        await self.__stream.aclose()
+        if hasattr(self.__source, "aclose"):
+            await self.__source.aclose()
+        self.__done = True
+
+    async def get(self) -> Content:
+        await self.gobble()
+        return self.__accumulator.get()
+
+
+class AsyncStreamedString(AsyncStreamedContent):
+    def __init__(self, stream: AsyncIterator[Content]):
+        super().__init__(stream, TextAccumulator())
+
+
+class AsyncStreamedDict(AsyncStreamedContent):
+    """
+    Asynchronous version of StreamedDict.
+    """
+
+    def __init__(self, stream: AsyncIterator[dict]):
+        super().__init__(stream, DictAccumulator())
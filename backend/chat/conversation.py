@@ -1,29 +1,82 @@
 from datetime import datetime, timezone
 from typing import Callable, Optional
 
-from chat.messages import ColdMessage, Message, UserMessage
+from attr import dataclass
+
+import metrics
+from chat.messages import ColdMessage, Message, UserMessage, MessageType
+from nlp.tokens import count_message_tokens
 
 SYSTEM_HEADER = """\
-Today's date is {datetime}
+Today's date is {date}
+
+"""
+
+SUMMARY_HEADER = """\
+Here is a summary of the earlier part of the conversation:
 
 """
 
+# Bucket upper bounds for histograms of rendered token counts
+TOKEN_BUCKETS = (500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+
+@dataclass
+class ConversationSummary:
+    message_count: int  # The number of messages, from the start of the conversation history, that were summarized
+    content: str
+
+
+Summarizer = Callable[[Optional[str], list[ColdMessage]], str]
+
 
 class Conversation:
     history: list[ColdMessage]
     recorder: Callable[[ColdMessage, Optional[str]], None]
     conversation_id: str | None
+    summary: ConversationSummary | None
+    summary_recorder: Callable[[ConversationSummary, Optional[str]], None]
+    flush_recorder: Callable[[], None]
+
+    # Put the system header after the system message rather than before it. Rendered messages then start with a long,
+    # unchanging prefix that the LLM provider can serve from its prompt cache. See the CHAT.PREFIX_STABLE_PROMPTS
+    # setting.
+    prefix_stable_prompts: bool
+
+    # Limits on the history rendered verbatim. Older messages are rendered as a summary once one is available. None
+    # means no limit. See the CHAT.HISTORY_TURNS and CHAT.HISTORY_TOKEN_BUDGET settings.
+    max_verbatim_turns: int | None
+    history_token_budget: int | None
 
     def __init__(self, history: list[ColdMessage] = None,
-                 recorder: Callable[[ColdMessage, Optional[str]], None] = None, conversation_id: str = None):
+                 recorder: Callable[[ColdMessage, Optional[str]], None] = None, conversation_id: str = None,
+                 summary: ConversationSummary = None,
+                 summary_recorder: Callable[[ConversationSummary, Optional[str]], None] = None,
+                 flush_recorder: Callable[[], None] = None, prefix_stable_prompts: bool = False,
+                 max_verbatim_turns: int = None, history_token_budget: int = None):
+        """
+        :param flush_recorder: Waits until the messages passed to recorder have been stored, for recorders that store
+        them in the background
+        """
         if history is None:
             history = []
         if recorder is None:
             recorder = lambda x, y: (x, y)
+        if summary_recorder is None:
+            summary_recorder = lambda x, y: (x, y)
+        if flush_recorder is None:
+            flush_recorder = lambda: None
 
         self.history = history
         self.recorder = recorder
         self.conversation_id = conversation_id
+        self.summary = summary
+        self.summary_recorder = summary_recorder
+        self.flush_recorder = flush_recorder
+        self.prefix_stable_prompts = prefix_stable_prompts
+        self.max_verbatim_turns = max_verbatim_turns
+        self.history_token_budget = history_token_budget
+        self.__token_counts: list[int] = []
 
     def append(self, messages: Message | list[Message]):
         if not isinstance(messages, list):
@@ -33,22 +86,127 @@ class Conversation:
             self.recorder(cold_message, self.conversation_id)
             self.history.append(cold_message)
 
-    def render_to_openai(self, system_message: str = None, request: str = None, system_header: str = None) -> list[
-        dict]:
+    def flush(self):
+        """
+        Waits until all appended messages have been recorded.
+        """
+        self.flush_recorder()
+
+    def fork(self) -> "Conversation":
+        """
+        :return: A copy of the conversation that can be appended to without affecting or recording to this one.
+        """
+        return Conversation(history=list(self.history), conversation_id=self.conversation_id, summary=self.summary,
+                            prefix_stable_prompts=self.prefix_stable_prompts,
+                            max_verbatim_turns=self.max_verbatim_turns,
+                            history_token_budget=self.history_token_budget)
+
+    def render_to_openai(self, system_message: str = None, request: str = None, system_header: str = None,
+                         prefix_stable: bool = None) -> list[dict]:
+        """
+        :param prefix_stable: Whether to place static content before volatile content. Defaults to the
+        conversation's prefix_stable_prompts.
+        """
         if system_message is None:
             system_message = ""
 
         if system_header is None:
-            system_header = SYSTEM_HEADER.format(datetime=datetime.now(tz=timezone.utc))
+            # Only the date, so that identical requests made on the same day render identically
+            system_header = SYSTEM_HEADER.format(date=datetime.now(tz=timezone.utc).date())
+
+        if prefix_stable is None:
+            prefix_stable = self.prefix_stable_prompts
 
-        return [m for m in self.__message_renderer(system_header + system_message, request)]
+        if prefix_stable:
+            system_message = f"{system_message.rstrip()}\n\n{system_header.strip()}".lstrip()
+        else:
+            system_message = system_header + system_message
+
+        rendered = [m for m in self.__message_renderer(system_message, request)]
+        self.__log_render_stats(rendered)
+        return rendered
 
     def __message_renderer(self, system_message: str, request: str):
         yield {"role": "system", "content": system_message}
 
-        for message in self.history:
+        start = self.__verbatim_start()
+        if start > 0:
+            yield {"role": "system", "content": SUMMARY_HEADER + self.summary.content}
+
+        for message in self.history[start:]:
             yield from message.read("openai_messages")
 
         if request is not None:
             atomized_request = UserMessage(f"First address the following request: {request}")
             yield from atomized_request.to_openai()
+
+    def needs_summary_update(self) -> bool:
+        return self.__window_start() > self.__summarized_count()
+
+    def update_summary(self, summarize: Summarizer):
+        """
+        Folds messages that no longer fit in the rendering window into the conversation summary, which is recorded
+        for use in later turns.
+
+        :param summarize: Makes a new summary out of the previous summary, if any, and the messages to add to it
+        """
+        start = self.__window_start()
+        summarized = self.__summarized_count()
+        if start <= summarized:
+            return
+
+        previous = self.summary.content if self.summary is not None else None
+        content = summarize(previous, self.history[summarized:start])
+
+        self.summary = ConversationSummary(message_count=start, content=content)
+        self.summary_recorder(self.summary, self.conversation_id)
+
+    def __summarized_count(self) -> int:
+        return 0 if self.summary is None else min(self.summary.message_count, len(self.history))
+
+    def __verbatim_start(self) -> int:
+        """
+        :return: The index of the first history message to render verbatim. Messages that fell out of the window but
+        have not been summarized yet are still rendered verbatim.
+        """
+        return min(self.__window_start(), self.__summarized_count())
+
+    def __window_start(self) -> int:
+        """
+        :return: The index of the first history message in the window of recent turns that fit the configured limits.
+        The latest turn is always in the window.
+        """
+        if self.max_verbatim_turns is None and self.history_token_budget is None:
+            return 0
+
+        turn_starts = [i for i, m in enumerate(self.history) if m.read("type") == MessageType.user_text_message.value]
+        if len(turn_starts) == 0:
+            return 0
+
+        if self.max_verbatim_turns is not None:
+            turn_starts = turn_starts[-max(self.max_verbatim_turns, 1):]
+
+        if self.history_token_budget is None:
+            return turn_starts[0]
+
+        token_counts = self.__count_history_tokens()
+        start = turn_starts[-1]
+        for turn_start in reversed(turn_starts[:-1]):
+            if sum(token_counts[turn_start:]) > self.history_token_budget:
+                break
+            start = turn_start
+
+        return start
+
+    def __count_history_tokens(self) -> list[int]:
+        # History is only ever appended to, so counts for earlier messages can be reused
+        for message in self.history[len(self.__token_counts):]:
+            self.__token_counts.append(count_message_tokens(message.read("openai_messages")))
+        return self.__token_counts
+
+    def __log_render_stats(self, rendered: list[dict]):
+        tokens = count_message_tokens(rendered)
+        verbatim = len(self.history) - self.__verbatim_start()
+        metrics.observe("conversation.render_tokens", tokens, TOKEN_BUCKETS)
+        print(f"RENDERED: {len(rendered)} messages, {tokens} tokens, {verbatim} of {len(self.history)} history "
+              f"messages verbatim")
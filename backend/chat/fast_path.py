@@ -0,0 +1,131 @@
+"""
+Routes unambiguous user messages, like "show a map of Quercus alba", straight to a tool using keyword and pattern
+rules, skipping the LLM calls otherwise needed to break down the message and pick tools.
+"""
+import re
+from typing import Optional
+
+from attr import dataclass
+
+# Messages longer than this are left to the LLM, since they likely contain several requests or subtle constraints
+MAX_MESSAGE_LENGTH = 200
+
+# Confidence in a match whose subject does not look like a taxon name, e.g. a common name like "polar bears"
+UNRECOGNIZED_SUBJECT_CONFIDENCE = 0.75
+
+
+@dataclass
+class FastPathMatch:
+    tool_name: str
+    rule: str
+    confidence: float
+
+
+@dataclass
+class Rule:
+    name: str
+    tool_name: str
+    pattern: re.Pattern
+    confidence: float
+    requires_taxon: bool = True  # Whether the pattern's "subject" group should name a taxon
+
+
+_POLITE_PREFIX = r"^(?:(?:can|could|would) you |please |i want to |i'd like to )*"
+
+RULES = [
+    Rule("map", "show_map_of_species_occurrences", re.compile(
+        _POLITE_PREFIX + r"(?:show|display|plot|draw|make|create|generate|give)(?: me)?(?: a| an| the)?(?: \w+)? map "
+                         r"(?:of|for|showing) (?P<subject>.+)$", re.I), 0.95),
+    Rule("map_noun", "show_map_of_species_occurrences", re.compile(
+        r"^map (?:of |for )?(?P<subject>.+)$", re.I), 0.95),
+    Rule("count", "count_species_occurrence_records", re.compile(
+        _POLITE_PREFIX + r"how many (?:\w+ )?(?:records|occurrences|specimens|observations) "
+                         r"(?:(?:are there|does idigbio have|do you have|exist) )?(?:of|for) (?P<subject>.+)$",
+        re.I), 0.95),
+    Rule("count_verb", "count_species_occurrence_records", re.compile(
+        _POLITE_PREFIX + r"count (?:the )?(?:number of )?(?:\w+ )?(?:records|occurrences|specimens|observations) "
+                         r"(?:of|for) (?P<subject>.+)$", re.I), 0.95),
+    Rule("search", "search_species_occurrence_records", re.compile(
+        _POLITE_PREFIX + r"(?:find|search for|look up|get|list|retrieve|fetch)(?: me)?(?: all| some| the)? "
+                         r"(?:\w+ )?(?:records|occurrences|specimens) (?:of|for) (?P<subject>.+)$", re.I), 0.9),
+    Rule("media", "search_media_records", re.compile(
+        _POLITE_PREFIX + r"(?:find|search for|show|get|display|look up)(?: me)?(?: some| all| the)? "
+                         r"(?:images|photos|pictures|photographs|media)(?: records)? (?:of|for) (?P<subject>.+)$",
+        re.I), 0.95),
+    Rule("download", "download_species_occurrence_records", re.compile(
+        r"\bdownload\b.*\b[\w.+-]+@[\w-]+\.[\w.-]+", re.I), 0.95, requires_taxon=False),
+]
+
+# Messages that ask for more than one thing, e.g. "count X and show them on a map", need to be broken down
+_COMPOUND = re.compile(
+    r"\b(?:and|then|also|plus)\b.*\b(?:show|map|count|how many|find|search|download|list|images?|photos?)\b|"
+    r"[.?!;]\s+\S", re.I)
+
+# Where the subject of a request stops and its other constraints, like locations and dates, start
+_SUBJECT_END = re.compile(
+    r"\s+(?:in|from|at|within|since|before|after|between|during|near|collected|with|that|which|on|by|to|"
+    r"around|across|found|recorded|observed)\b.*$", re.I)
+
+_LEADING_ARTICLE = re.compile(r"^(?:the|all|some|any)\s+", re.I)
+
+_LIST_SEPARATOR = re.compile(r"\s*(?:,|\band\b|\bor\b)\s*")
+
+_RANK_NAME = re.compile(
+    r"^(?:kingdom|phylum|class|order|family|subfamily|tribe|genus|species|subspecies)\s+[A-Z]?[a-z]+(?:\s[a-z]+)*$",
+    re.I)
+
+# A genus optionally followed by a specific epithet and an infraspecific epithet, e.g. "Quercus alba"
+_SCIENTIFIC_NAME = re.compile(r"^[A-Z][a-z]{2,}(?:\s(?:x\s)?[a-z-]{3,}){0,2}$")
+
+# Higher taxa often have telltale endings, e.g. Asteraceae or Ursidae, and are sometimes written in lower case
+_HIGHER_TAXON = re.compile(r"^[A-Za-z][a-z]+(?:aceae|idae|inae|ales|oidea|phyta|mycota|opsida|ina|ini)$")
+
+
+def classify(message: str) -> Optional[FastPathMatch]:
+    """
+    :return: The tool that addresses the message and how confident the match is, or None if no rule matches the
+    message unambiguously.
+    """
+    text = message.strip().rstrip("?.! ")
+    if len(text) == 0 or len(text) > MAX_MESSAGE_LENGTH or _COMPOUND.search(text):
+        return None
+
+    matches = []
+    for rule in RULES:
+        m = rule.pattern.search(text)
+        if m is None:
+            continue
+
+        confidence = rule.confidence
+        if rule.requires_taxon and not _names_taxa(get_subject(m.group("subject"))):
+            confidence = min(confidence, UNRECOGNIZED_SUBJECT_CONFIDENCE)
+
+        matches.append(FastPathMatch(tool_name=rule.tool_name, rule=rule.name, confidence=confidence))
+
+    if len({m.tool_name for m in matches}) != 1:
+        return None
+
+    return max(matches, key=lambda m: m.confidence)
+
+
+def get_subject(text: str) -> str:
+    """
+    :return: The part of a request's subject that names what to look for, e.g. "Carex" for "Carex in Florida since
+    2000"
+    """
+    subject = _SUBJECT_END.sub("", text.strip())
+    subject = subject.strip(" *_\"'")
+    return _LEADING_ARTICLE.sub("", subject)
+
+
+def looks_like_taxon(text: str) -> bool:
+    """
+    Detects scientific names, like "Ursus arctos" or "Asteraceae", and names qualified by their rank, like "genus
+    Carex". Common names, like "polar bears", are not detected.
+    """
+    return bool(_RANK_NAME.match(text) or _SCIENTIFIC_NAME.match(text) or _HIGHER_TAXON.match(text))
+
+
+def _names_taxa(subject: str) -> bool:
+    names = [n for n in _LIST_SEPARATOR.split(subject) if n]
+    return len(names) > 0 and all(looks_like_taxon(_LEADING_ARTICLE.sub("", n)) for n in names)
@@ -1,10 +1,14 @@
+import asyncio
+import contextvars
 import json
+import queue
+import threading
 from enum import Enum
-from typing import Any, Iterator
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Iterator
 from uuid import uuid4
 
-from chat.content_streams import StreamedContent
-from chat.utils.json import stream_as_json
+from chat.content_streams import StreamedContent, AsyncStreamedContent
+from chat.utils.json import stream_as_json, astream_as_json, to_json_value, join_fragments, DEFAULT_CHUNK_SIZE
 
 
 class MessageType(Enum):
@@ -13,9 +17,10 @@ class MessageType(Enum):
     ai_map_message = "ai_map_message"
     ai_processing_message = "ai_processing_message"
     error = "error"
+    cancelled = "cancelled"
 
 
-MessageValue = str | dict | list | StreamedContent
+MessageValue = str | dict | list | StreamedContent | AsyncStreamedContent
 
 
 class ColdMessage:
@@ -56,18 +61,90 @@ class Message:
         """
         pass
 
-    def stream_to_frontend(self) -> Iterator[str]:
+    def stream_to_frontend(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
         """
         Stream to the frontend.
+
+        :param chunk_size: See stream_as_json
         """
         return stream_as_json({
             "id": self.message_id,
             "type": self.get_type().value,
             "value": self.value
-        })
+        }, chunk_size)
+
+    async def astream_to_frontend(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> AsyncIterator[str]:
+        """
+        Stream to the frontend, including content that is generated asynchronously.
+        """
+        async for fragment in astream_as_json({
+            "id": self.message_id,
+            "type": self.get_type().value,
+            "value": self.value
+        }, chunk_size):
+            yield fragment
+
+    def stream_events(self) -> Iterator[dict]:
+        """
+        Stream to the frontend as events, see stream_message_events.
+        """
+        value, streams = _split_streams(self.value)
+        if len(streams) == 0:
+            yield {"event": "message", "id": self.message_id, "type": self.get_type().value, "value": value}
+            return
+
+        yield {"event": "message_start", "id": self.message_id, "type": self.get_type().value, "value": value}
+        for path, stream in streams:
+            for fragment in stream:
+                yield from _make_delta_events(self.message_id, path, fragment)
+        yield {"event": "message_end", "id": self.message_id}
+
+    async def astream_events(self) -> AsyncIterator[dict]:
+        """
+        Stream to the frontend as events, including content that is generated asynchronously.
+        """
+        value, streams = _split_streams(self.value)
+        if len(streams) == 0:
+            yield {"event": "message", "id": self.message_id, "type": self.get_type().value, "value": value}
+            return
+
+        yield {"event": "message_start", "id": self.message_id, "type": self.get_type().value, "value": value}
+        for path, stream in streams:
+            if isinstance(stream, AsyncIterable):
+                async for fragment in stream:
+                    for event in _make_delta_events(self.message_id, path, fragment):
+                        yield event
+            else:
+                for fragment in stream:
+                    for event in _make_delta_events(self.message_id, path, fragment):
+                        yield event
+        yield {"event": "message_end", "id": self.message_id}
+
+    async def complete(self):
+        """
+        Finishes generating any asynchronously streamed content, so that the message can be frozen.
+        """
+        await _complete(self.value)
+
+    def close(self):
+        """
+        Stops generating streamed content, e.g. because the turn was cancelled. The message can still be frozen with
+        the content generated so far.
+        """
+        _close(self.value)
+
+    async def aclose(self):
+        """
+        Asynchronous version of close, which also stops content that is generated asynchronously.
+        """
+        await _aclose(self.value)
 
     def to_frontend(self) -> dict:
-        return json.loads("".join(self.stream_to_frontend()))
+        return {
+            "id": self.message_id,
+            "type": self.get_type().value,
+            "value": to_json_value(self.value)
+        }
 
     def freeze(self) -> ColdMessage:
         """
@@ -103,7 +180,7 @@ class AiChatMessage(Message):
         return [
             {
                 "role": "assistant",
-                "content": "".join(self.value)
+                "content": join_fragments(self.value)
             }
         ]
 
@@ -141,16 +218,39 @@ class AiProcessingMessage(Message):
             {
                 "role": "function",
                 "name": self.tool_name,
-                "content": "".join(self.thoughts)
+                "content": join_fragments(self.thoughts)
             }
         ]
 
-    def stream_to_frontend(self) -> Iterator[str]:
+    def stream_to_frontend(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+        if self.show_user:
+            yield from super().stream_to_frontend(chunk_size)
+        else:
+            yield "[]"
+
+    async def astream_to_frontend(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> AsyncIterator[str]:
         if self.show_user:
-            yield from super().stream_to_frontend()
+            async for fragment in super().astream_to_frontend(chunk_size):
+                yield fragment
         else:
             yield "[]"
 
+    def to_frontend(self) -> dict | list:
+        return super().to_frontend() if self.show_user else []
+
+    def stream_events(self) -> Iterator[dict]:
+        if self.show_user:
+            yield from super().stream_events()
+
+    async def astream_events(self) -> AsyncIterator[dict]:
+        if self.show_user:
+            async for event in super().astream_events():
+                yield event
+
+    async def complete(self):
+        await super().complete()
+        await _complete(self.thoughts)
+
 
 class ErrorMessage(Message):
     def get_type(self) -> MessageType:
@@ -165,12 +265,276 @@ class ErrorMessage(Message):
         ]
 
 
-def stream_messages(message_stream: Iterator[Message]) -> Iterator[str]:
-    streamed_previous_message = False
+class CancelledMessage(Message):
+    """
+    Ends a turn that was cancelled before the response was finished, e.g. because the user closed the page.
+    """
+
+    def __init__(self, value: str = "The response was cancelled before it was finished."):
+        super().__init__(value)
+
+    def get_type(self) -> MessageType:
+        return MessageType.cancelled
+
+    def to_openai(self) -> list[dict]:
+        return [
+            {
+                "role": "system",
+                "content": "The user stopped receiving the previous response before it was finished, so it may be "
+                           "incomplete."
+            }
+        ]
+
+
+def _close(value: MessageValue):
+    if isinstance(value, StreamedContent):
+        value.close()
+    elif isinstance(value, dict):
+        for v in value.values():
+            _close(v)
+    elif isinstance(value, list):
+        for v in value:
+            _close(v)
+
+
+async def _aclose(value: MessageValue):
+    if isinstance(value, AsyncStreamedContent):
+        await value.aclose()
+    elif isinstance(value, StreamedContent):
+        value.close()
+    elif isinstance(value, dict):
+        for v in value.values():
+            await _aclose(v)
+    elif isinstance(value, list):
+        for v in value:
+            await _aclose(v)
+
+
+async def _complete(value: MessageValue):
+    if isinstance(value, AsyncStreamedContent):
+        await value.gobble()
+    elif isinstance(value, dict):
+        for v in value.values():
+            await _complete(v)
+    elif isinstance(value, list):
+        for v in value:
+            await _complete(v)
+
+
+def stream_messages(message_stream: Iterator[Message], chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+    """
+    :param chunk_size: Characters of JSON to gather into each chunk, see stream_as_json
+    """
+    yield "["
+    separator = ""
+    for message in message_stream:
+        # Send separators with the next chunk instead of on their own
+        for chunk in message.stream_to_frontend(chunk_size):
+            yield separator + chunk
+            separator = ""
+        separator = ","
+    yield "]"
+
+
+async def astream_messages(message_stream: AsyncIterator[Message], chunk_size: int = DEFAULT_CHUNK_SIZE) -> \
+        AsyncIterator[str]:
     yield "["
-    for i, message in enumerate(message_stream):
-        if streamed_previous_message:
-            yield ","
-        yield from message.stream_to_frontend()
-        streamed_previous_message = True
+    separator = ""
+    async for message in message_stream:
+        async for chunk in message.astream_to_frontend(chunk_size):
+            yield separator + chunk
+            separator = ""
+        separator = ","
     yield "]"
+
+
+# Formats that chat responses can be streamed in, picked with the Accept header. The first is the default.
+JSON_ARRAY = "application/json"
+NDJSON = "application/x-ndjson"
+SSE = "text/event-stream"
+STREAM_FORMATS = [JSON_ARRAY, NDJSON, SSE]
+
+_HEARTBEAT = {"event": "heartbeat"}
+_END = object()
+
+
+def stream_message_events(message_stream: Iterator[Message]) -> Iterator[dict]:
+    """
+    Streams messages as a series of complete JSON events, so that clients can handle each one as soon as it arrives
+    instead of parsing a partial JSON array:
+
+    { "event": "message", "id": str, "type": str, "value": ... } for a message that is already complete
+    { "event": "message_start", "id": str, "type": str, "value": ... } for a message whose value is still being
+    generated, with "" in place of the parts that are still being generated
+    { "event": "delta", "id": str, "path": [str | int], "text": str } for text to append to the part of the message's
+    value at path, or "value" instead of "text" for a part that is replaced
+    { "event": "message_end", "id": str } once the message is complete
+    { "event": "done" } after the last message
+    """
+    for message in message_stream:
+        yield from message.stream_events()
+    yield {"event": "done"}
+
+
+async def astream_message_events(message_stream: AsyncIterator[Message]) -> AsyncIterator[dict]:
+    """
+    Asynchronous version of stream_message_events.
+    """
+    async for message in message_stream:
+        async for event in message.astream_events():
+            yield event
+    yield {"event": "done"}
+
+
+def format_event(event: dict, stream_format: str) -> str:
+    """
+    :return: The event as a line of NDJSON or a server-sent event. Heartbeats are sent as SSE comments, which browsers
+    ignore.
+    """
+    if stream_format == SSE:
+        if event is _HEARTBEAT:
+            return ": heartbeat\n\n"
+        return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+
+def with_heartbeats(events: Iterator[dict], interval: float) -> Iterator[dict]:
+    """
+    Sends heartbeat events whenever the next event takes longer than interval seconds, e.g. while waiting on the LLM,
+    so that proxies don't time out or buffer the response. Events are generated in a background thread, in a copy of
+    the caller's context so that Flask's request context is still available.
+    """
+    if not interval:
+        yield from events
+        return
+
+    pending = queue.Queue(maxsize=1)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        """
+        :return: Whether the item was handed over, i.e. the response is still being sent
+        """
+        while not stopped.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for event in events:
+                if not put(event):
+                    return
+            put(_END)
+        except Exception as e:
+            put(e)
+        finally:
+            if stopped.is_set() and hasattr(events, "close"):
+                events.close()
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(produce,), daemon=True).start()
+
+    try:
+        while True:
+            try:
+                event = pending.get(timeout=interval)
+            except queue.Empty:
+                yield _HEARTBEAT
+                continue
+
+            if event is _END:
+                return
+            if isinstance(event, Exception):
+                raise event
+            yield event
+    finally:
+        stopped.set()
+
+
+async def awith_heartbeats(events: AsyncIterator[dict], interval: float) -> AsyncIterator[dict]:
+    """
+    Asynchronous version of with_heartbeats. Events are generated by a single background task, so that context
+    variables set while generating them, like the turn's metrics and cancel scope, carry over from one event to the
+    next.
+    """
+    if not interval:
+        async for event in events:
+            yield event
+        return
+
+    pending = asyncio.Queue(maxsize=1)
+
+    async def produce():
+        try:
+            async for event in events:
+                await pending.put(event)
+            await pending.put(_END)
+        except Exception as e:
+            await pending.put(e)
+        finally:
+            # Close the events from the task that generates them, so that callers can close the streams they were
+            # generated from once this generator is closed
+            if hasattr(events, "aclose"):
+                await events.aclose()
+
+    producer = asyncio.ensure_future(produce())
+    getting = None
+    try:
+        while True:
+            # Wait for the same get across heartbeats, so that no event is lost to a cancelled get
+            getting = asyncio.ensure_future(pending.get())
+            while not (await asyncio.wait({getting}, timeout=interval))[0]:
+                yield _HEARTBEAT
+
+            event = getting.result()
+            if event is _END:
+                return
+            if isinstance(event, Exception):
+                raise event
+            yield event
+    finally:
+        if getting is not None:
+            getting.cancel()
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass
+
+
+def _split_streams(value: MessageValue, path: tuple = ()) -> (Any, list[tuple[list, Iterable | AsyncIterable]]):
+    """
+    :return: The value with "" in place of content that is still being generated, and the path to and stream of each
+    such content, in the order stream_as_json would render them
+    """
+    if isinstance(value, str):
+        return value, []
+    elif isinstance(value, dict):
+        result, streams = {}, []
+        for k, v in value.items():
+            result[k], inner = _split_streams(v, path + (k,))
+            streams += inner
+        return result, streams
+    elif isinstance(value, list):
+        result, streams = [], []
+        for i, v in enumerate(value):
+            item, inner = _split_streams(v, path + (i,))
+            result.append(item)
+            streams += inner
+        return result, streams
+    elif isinstance(value, Iterable | AsyncIterable):
+        return "", [(list(path), value)]
+    else:
+        return str(value), []
+
+
+def _make_delta_events(message_id: str, path: list, fragment) -> Iterator[dict]:
+    if isinstance(fragment, str):
+        if fragment:
+            yield {"event": "delta", "id": message_id, "path": path, "text": fragment}
+    elif fragment is not None:
+        yield {"event": "delta", "id": message_id, "path": path, "value": fragment}
@@ -6,7 +6,7 @@ from chat.content_streams import StreamedString
 from chat.conversation import Conversation
 from chat.processes.process import Process
 from chat.utils.json import make_pretty_json_string
-from idigbio_util import make_idigbio_api_url, query_idigbio_api
+from idigbio_util import make_idigbio_api_url, count_idigbio_records
 from nlp.ai import AI, StopOnTerminalErrorOrMaxAttempts, AIGenerationException
 from schema.idigbio.api import IDigBioMediaApiParameters
 
@@ -30,11 +30,10 @@ class IDigBioMediaSearch(Process):
 
         yield self.note(f"Generated search parameters:\n```json\n{make_pretty_json_string(params)}\n```")
 
-        media_api_url = make_idigbio_api_url("/v2/search/media")
-        self.note(f"Sending a POST request to the iDigBio media API at {media_api_url}")
+        count_api_url = make_idigbio_api_url("/v2/summary/count/media")
+        self.note(f"Counting matching media records with the iDigBio summary API at {count_api_url}")
 
-        response_code, success, response_data = query_idigbio_api("/v2/search/media", params)
-        record_count = response_data.get("itemCount", 0)
+        response_code, success, record_count = count_idigbio_records("/v2/search/media", params)
 
         if success:
             self.note(f"Response code: {response_code}")
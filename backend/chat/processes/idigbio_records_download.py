@@ -41,7 +41,8 @@ class IDigBioRecordsDownload(Process):
         download_api_query_url = make_idigbio_api_url("/v2/download", params)
 
         if live:
-            response_code, success, _ = query_idigbio_api("/v2/download", params)
+            # Each request sends the user an email, so don't risk sending a request twice
+            response_code, success, _ = query_idigbio_api("/v2/download", params, idempotent=False)
         else:
             response_code, success = "200 OK", True
 
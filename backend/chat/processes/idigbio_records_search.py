@@ -1,12 +1,15 @@
+from typing import AsyncIterator, Iterator
+
 from attr import dataclass
 from instructor.exceptions import InstructorRetryException
-from tenacity import Retrying
+from tenacity import Retrying, AsyncRetrying
 
 from chat.content_streams import StreamedString
 from chat.conversation import Conversation
-from chat.processes.process import Process
+from chat.processes.process import Process, AsyncProcess
 from chat.utils.json import make_pretty_json_string
-from idigbio_util import query_idigbio_api, make_idigbio_api_url, make_idigbio_portal_url
+from idigbio_util import count_idigbio_records, count_idigbio_records_async, make_idigbio_api_url, \
+    make_idigbio_portal_url
 from nlp.ai import AI, StopOnTerminalErrorOrMaxAttempts, AIGenerationException
 from schema.idigbio.api import IDigBioRecordsApiParameters
 from schema.idigbio.fields import fields
@@ -30,48 +33,67 @@ class IDigBioRecordsSearch(Process):
             yield self.note(e.message)
             return
 
-        yield self.note(f"Generated search parameters:\n```json\n{make_pretty_json_string(params)}\n```")
+        yield from _report_parameters(self, params)
+        response_code, success, record_count = count_idigbio_records("/v2/search/records", params)
+        yield from _report_search(self, params, response_code, success, record_count)
 
-        records_api_url = make_idigbio_api_url("/v2/search/records")
-        self.note(f"Sending a POST request to the iDigBio records API at {records_api_url}")
 
-        response_code, success, response_data = query_idigbio_api("/v2/search/records", params)
-        record_count = response_data.get("itemCount", 0)
+class AsyncIDigBioRecordsSearch(AsyncProcess):
+    process_summary = IDigBioRecordsSearch.process_summary
 
-        if success:
-            self.note(f"Response code: {response_code}")
-        else:
-            yield self.note(f"\n\nResponse code: {response_code} - something went wrong!")
+    async def __arun__(self, ai: AI, conversation, request: str) -> AsyncIterator[str]:
+        try:
+            params = await _agenerate_records_search_parameters(ai, conversation, request)
+        except AIGenerationException as e:
+            yield self.note(e.message)
             return
 
-        api_query_url = make_idigbio_api_url("/v2/search/records", params)
-        yield f"\n\n[View {record_count} matching records]({api_query_url})"
-        self.note(f"The API query matched {record_count} records in iDigBio using the URL {api_query_url}")
+        for text in _report_parameters(self, params):
+            yield text
+        response_code, success, record_count = await count_idigbio_records_async("/v2/search/records", params)
+        for text in _report_search(self, params, response_code, success, record_count):
+            yield text
 
-        portal_url = make_idigbio_portal_url(params)
-        yield f" | [Show in iDigBio portal]({portal_url})"
-        self.note(
-            f"The records can be viewed in the iDigBio portal at {portal_url}. The portal shows the records in an "
-            f"interactive list and plots them on a map. The raw records returned returned by the API can be found at "
-            f"{api_query_url}"
-        )
 
-        self.set_results(Results(
-            params=params,
-            record_count=record_count,
-            api_query_url=api_query_url,
-            portal_url=portal_url
-        ))
+def _report_parameters(process: Process | AsyncProcess, params: dict) -> Iterator[str]:
+    yield process.note(f"Generated search parameters:\n```json\n{make_pretty_json_string(params)}\n```")
+
+    count_api_url = make_idigbio_api_url("/v2/summary/count/records")
+    process.note(f"Counting matching records with the iDigBio summary API at {count_api_url}")
+
+
+def _report_search(process: Process | AsyncProcess, params: dict, response_code: str, success: bool,
+                   record_count: int) -> Iterator[str]:
+    if success:
+        process.note(f"Response code: {response_code}")
+    else:
+        yield process.note(f"\n\nResponse code: {response_code} - something went wrong!")
+        return
+
+    api_query_url = make_idigbio_api_url("/v2/search/records", params)
+    yield f"\n\n[View {record_count} matching records]({api_query_url})"
+    process.note(f"The API query matched {record_count} records in iDigBio using the URL {api_query_url}")
+
+    portal_url = make_idigbio_portal_url(params)
+    yield f" | [Show in iDigBio portal]({portal_url})"
+    process.note(
+        f"The records can be viewed in the iDigBio portal at {portal_url}. The portal shows the records in an "
+        f"interactive list and plots them on a map. The raw records returned returned by the API can be found at "
+        f"{api_query_url}"
+    )
+
+    process.set_results(Results(
+        params=params,
+        record_count=record_count,
+        api_query_url=api_query_url,
+        portal_url=portal_url
+    ))
 
 
 def _generate_records_search_parameters(ai: AI, conversation: Conversation, request: str) -> dict:
     try:
         result = ai.client.chat.completions.create(
-            model="gpt-4o",
-            temperature=0,
-            response_model=IDigBioRecordsApiParameters,
-            messages=conversation.render_to_openai(system_message=SYSTEM_PROMPT,
-                                                   request=request),
+            **_records_search_parameters_request(conversation, request),
             max_retries=Retrying(stop=StopOnTerminalErrorOrMaxAttempts(3))
         )
     except InstructorRetryException as e:
@@ -81,6 +103,29 @@ def _generate_records_search_parameters(ai: AI, conversation: Conversation, requ
     return params
 
 
+async def _agenerate_records_search_parameters(ai: AI, conversation: Conversation, request: str) -> dict:
+    try:
+        result = await ai.async_client.chat.completions.create(
+            **_records_search_parameters_request(conversation, request),
+            max_retries=AsyncRetrying(stop=StopOnTerminalErrorOrMaxAttempts(3))
+        )
+    except InstructorRetryException as e:
+        raise AIGenerationException(e)
+
+    params = result.model_dump(exclude_none=True, by_alias=True)
+    return params
+
+
+def _records_search_parameters_request(conversation: Conversation, request: str) -> dict:
+    return dict(
+        model="gpt-4o",
+        temperature=0,
+        response_model=IDigBioRecordsApiParameters,
+        messages=conversation.render_to_openai(system_message=SYSTEM_PROMPT,
+                                               request=request),
+    )
+
+
 FIELDS_DOC = "\n".join(f"{f['field_name']}: {f['field_type']}" for f in fields)
 
 IDIGBIO_QUERY_FORMAT_DOC = """
@@ -1,21 +1,23 @@
-from typing import Iterator
+import asyncio
+from typing import AsyncIterator, Iterator, Optional
 
-import requests
 from attr import dataclass
 from instructor.exceptions import InstructorRetryException
-from tenacity import Retrying
+from tenacity import Retrying, AsyncRetrying
 
 import idigbio_util
+import local_occurrences
 from chat.content_streams import StreamedString
 from chat.conversation import Conversation
 from chat.processes import idigbio_records_search
-from chat.processes.process import Process
+from chat.processes.process import Process, AsyncProcess
 from chat.utils.json import make_pretty_json_string
 from nlp.ai import AI, StopOnTerminalErrorOrMaxAttempts, AIGenerationException
 from schema.idigbio.api import IDigBioSummaryApiParameters
 
 DEFAULT_NUM_TOP_COUNTS = 10
 MAX_NUM_TOP_COUNTS = 100
+SUMMARY_API_ENDPOINT = "/v2/summary/top/records"
 
 
 @dataclass
@@ -39,55 +41,114 @@ class IDigBioRecordsSummary(Process):
 
         if "top_fields" not in params:
             params |= {"top_fields": "scientificname"}
-        top_fields = params["top_fields"]
 
         yield self.note(f"Generated search parameters:\n```json\n{make_pretty_json_string(params)}\n```")
 
-        url_params = idigbio_util.url_encode_params(params)
-        full_summary_api_url = f"https://search.idigbio.org/v2/summary/top/records?{url_params}"
+        full_summary_api_url, limited_summary_api_url = _prepare_summary_query(self, params)
+        total_count, top_counts = _query_local_store(self, params) or _query_summary_api(params)
+        yield from _report_summary(self, params, full_summary_api_url, limited_summary_api_url, total_count,
+                                   top_counts)
 
-        test_params = params.copy()
-        if "count" not in test_params:
-            test_params |= {"count": DEFAULT_NUM_TOP_COUNTS}
-        elif test_params["count"] > MAX_NUM_TOP_COUNTS:
-            test_params["count"] = MAX_NUM_TOP_COUNTS
-        limited_summary_api_url = f"https://search.idigbio.org/v2/summary/top/records?{url_params}"
 
-        self.note(f"Querying the iDigBio summary API with URL {full_summary_api_url}")
-        if "count" not in params:
-            self.note(f"Warning: count not specified, only checking the top {DEFAULT_NUM_TOP_COUNTS} counts.")
-        elif params["count"] > MAX_NUM_TOP_COUNTS:
-            self.note(f"\nWarning: only checking the top {MAX_NUM_TOP_COUNTS} counts.")
+class AsyncIDigBioRecordsSummary(AsyncProcess):
+    process_summary = IDigBioRecordsSummary.process_summary
 
-        total_count, top_counts = _query_summary_api(limited_summary_api_url)
-        yield f"\n\n[View summary of {total_count} records]({full_summary_api_url})"
-        self.note(f"The API query matched {total_count} total records in iDigBio")
+    async def __arun__(self, ai: AI, conversation, request: str) -> AsyncIterator[str]:
+        try:
+            params = await _agenerate_records_summary_parameters(ai, conversation, request)
+        except AIGenerationException as e:
+            yield self.note(e.message)
+            return
+
+        if "top_fields" not in params:
+            params |= {"top_fields": "scientificname"}
+
+        yield self.note(f"Generated search parameters:\n```json\n{make_pretty_json_string(params)}\n```")
+
+        full_summary_api_url, limited_summary_api_url = _prepare_summary_query(self, params)
+        # Counting records in a local store can take a while, so it runs off the event loop
+        total_count, top_counts = (await asyncio.to_thread(_query_local_store, self, params) or
+                                   await _query_summary_api_async(params))
+        for text in _report_summary(self, params, full_summary_api_url, limited_summary_api_url, total_count,
+                                    top_counts):
+            yield text
+
+
+def _prepare_summary_query(process: Process | AsyncProcess, params: dict) -> (str, str):
+    """
+    :return: URLs for querying the summary API for all top counts and for a limited number of them
+    """
+    url_params = idigbio_util.url_encode_params(params)
+    full_summary_api_url = f"https://search.idigbio.org/v2/summary/top/records?{url_params}"
+
+    test_params = params.copy()
+    if "count" not in test_params:
+        test_params |= {"count": DEFAULT_NUM_TOP_COUNTS}
+    elif test_params["count"] > MAX_NUM_TOP_COUNTS:
+        test_params["count"] = MAX_NUM_TOP_COUNTS
+    limited_summary_api_url = f"https://search.idigbio.org/v2/summary/top/records?{url_params}"
+
+    process.note(f"Querying the iDigBio summary API with URL {full_summary_api_url}")
+    if "count" not in params:
+        process.note(f"Warning: count not specified, only checking the top {DEFAULT_NUM_TOP_COUNTS} counts.")
+    elif params["count"] > MAX_NUM_TOP_COUNTS:
+        process.note(f"\nWarning: only checking the top {MAX_NUM_TOP_COUNTS} counts.")
+
+    return full_summary_api_url, limited_summary_api_url
+
+
+def _report_summary(process: Process | AsyncProcess, params: dict, full_summary_api_url: str,
+                    limited_summary_api_url: str, total_count: int, top_counts: dict) -> Iterator[str]:
+    yield f"\n\n[View summary of {total_count} records]({full_summary_api_url})"
+    process.note(f"The API query matched {total_count} total records in iDigBio")
+
+    counts_table = "".join(_stream_record_counts_as_markdown_table(top_counts))
+    process.note(f"Breakdown of counts by {params['top_fields']} in descending order:\n\n{counts_table}")
+
+    process.set_results(Results(
+        params=params,
+        total_count=total_count,
+        top_counts=top_counts,
+        full_summary_api_url=full_summary_api_url,
+        limited_summary_api_url=limited_summary_api_url
+    ))
+
+
+def _query_local_store(process: Process | AsyncProcess, params: dict) -> Optional[tuple[int, dict]]:
+    """
+    :return: The total count and top counts from a local copy of the records, or None if no local store can answer
+    the query
+    """
+    rq = idigbio_util.sanitize_json(params.get("rq") or {})
+    store = local_occurrences.stores.find(rq)
+    if store is None:
+        return None
+
+    count = min(params.get("count") or DEFAULT_NUM_TOP_COUNTS, MAX_NUM_TOP_COUNTS)
+    try:
+        summary = store.top_counts(rq, params["top_fields"], count)
+    except local_occurrences.UnsupportedQuery as e:
+        print(f"LOCAL STORE: {e}")
+        return None
+
+    process.note(f"Counted records in a local copy of {store.record_count} iDigBio records")
+    return summary["itemCount"], summary
 
-        counts_table = "".join(_stream_record_counts_as_markdown_table(top_counts))
-        self.note(f"Breakdown of counts by {top_fields} in descending order:\n\n{counts_table}")
 
-        self.set_results(Results(
-            params=params,
-            total_count=total_count,
-            top_counts=top_counts,
-            full_summary_api_url=full_summary_api_url,
-            limited_summary_api_url=limited_summary_api_url
-        ))
+def _query_summary_api(params: dict) -> (int, dict):
+    _, _, summary = idigbio_util.client.query("GET", SUMMARY_API_ENDPOINT, idigbio_util.sanitize_json(params))
+    return summary["itemCount"], summary
 
 
-def _query_summary_api(query_url: str) -> (int, dict):
-    res = requests.get(query_url)
-    return res.json()["itemCount"], res.json()
+async def _query_summary_api_async(params: dict) -> (int, dict):
+    _, _, summary = await idigbio_util.client.aquery("GET", SUMMARY_API_ENDPOINT, idigbio_util.sanitize_json(params))
+    return summary["itemCount"], summary
 
 
 def _generate_records_summary_parameters(ai: AI, conversation: Conversation, request: str) -> dict:
     try:
         result = ai.client.chat.completions.create(
-            model="gpt-4o",
-            temperature=0,
-            response_model=IDigBioSummaryApiParameters,
-            messages=conversation.render_to_openai(system_message=idigbio_records_search.SYSTEM_PROMPT,
-                                                   request=request),
+            **_records_summary_parameters_request(conversation, request),
             max_retries=Retrying(stop=StopOnTerminalErrorOrMaxAttempts(3))
         )
     except InstructorRetryException as e:
@@ -97,6 +158,29 @@ def _generate_records_summary_parameters(ai: AI, conversation: Conversation, req
     return params
 
 
+async def _agenerate_records_summary_parameters(ai: AI, conversation: Conversation, request: str) -> dict:
+    try:
+        result = await ai.async_client.chat.completions.create(
+            **_records_summary_parameters_request(conversation, request),
+            max_retries=AsyncRetrying(stop=StopOnTerminalErrorOrMaxAttempts(3))
+        )
+    except InstructorRetryException as e:
+        raise AIGenerationException(e)
+
+    params = result.model_dump(exclude_none=True, by_alias=True)
+    return params
+
+
+def _records_summary_parameters_request(conversation: Conversation, request: str) -> dict:
+    return dict(
+        model="gpt-4o",
+        temperature=0,
+        response_model=IDigBioSummaryApiParameters,
+        messages=conversation.render_to_openai(system_message=idigbio_records_search.SYSTEM_PROMPT,
+                                               request=request),
+    )
+
+
 def _stream_record_counts_as_markdown_table(counts) -> Iterator[str]:
     top_field = [x for x in counts if x != "itemCount"][0]
 
@@ -1,4 +1,7 @@
-from chat.content_streams import StreamedString
+from typing import AsyncIterator
+
+from cancellation import cancellable
+from chat.content_streams import StreamedString, AsyncStreamedString
 from chat.conversation import Conversation
 from chat.messages import Message, AiProcessingMessage
 from nlp.ai import AI
@@ -17,7 +20,8 @@ class Process:
     results: dict
 
     def __init__(self, ai: AI, conversation: Conversation, request: str = None):
-        self.__content: StreamedString = StreamedString(self.__run__(ai, conversation, request))
+        # Stop between steps of the process if the turn is cancelled
+        self.__content: StreamedString = StreamedString(cancellable(self.__run__(ai, conversation, request)))
         self.__notes: list[str] = []
         self.__results: dict = dict()
 
@@ -64,3 +68,60 @@ class Process:
             yield self.describe()
 
         return AiProcessingMessage(self.process_summary, self.__content, StreamedString(think()))
+
+
+class AsyncProcess:
+    """
+    Like Process, but runs asynchronously so that waiting on LLMs and external APIs does not hold up a thread. The
+    executed process and its results should be communicated to the user in an AiProcessingMessage.
+
+    Attributes:
+        process_summary (str): A short description of what the process is supposed to do
+    """
+    process_summary: str
+
+    def __init__(self, ai: AI, conversation: Conversation, request: str = None):
+        self.__content: AsyncStreamedString = AsyncStreamedString(self.__arun__(ai, conversation, request))
+        self.__notes: list[str] = []
+        self.__results: dict = dict()
+
+    async def results(self):
+        await self.__content.gobble()
+        return self.__results
+
+    def set_results(self, results):
+        """
+        Called by the process to store its results.
+        """
+        self.__results = results
+
+    def note(self, text: str):
+        """
+        :param text: Leave a note for the chatbot to remember. This does not make the note visible to the user.
+        :return:
+        """
+        self.__notes += [text.strip()]
+        return text
+
+    async def __arun__(self, ai: AI, conversation: Conversation, request: str) -> AsyncIterator[str]:
+        """
+        Run the process, see Process.__run__.
+        """
+        yield ""
+
+    async def describe(self) -> str:
+        """
+        :return: Compiles the notes created while executing the process.
+        """
+        await self.__content.gobble()
+        return "\n\n".join(self.__notes)
+
+    def make_message(self) -> Message:
+        """
+        :return: An AiProcessingMessage that describes the executed process and its outcomes.
+        """
+
+        async def think():
+            yield await self.describe()
+
+        return AiProcessingMessage(self.process_summary, self.__content, AsyncStreamedString(think()))
@@ -1,9 +1,9 @@
-from typing import Iterator
+from typing import AsyncIterator, Iterator
 
 from chat.conversation import Conversation
 from chat.messages import Message, AiProcessingMessage
 from chat.tools.tool import Tool
-from chat.utils.assistant import present_results
+from chat.utils.assistant import present_results, apresent_results
 from nlp.ai import AI
 
 
@@ -17,8 +17,13 @@ class AskAnExpert(Tool):
         Asks the LLM to answer the user's prompt directly.
         """
 
-        result = (
-            "Something went wrong. The system either failed to understand the user's request or is incapable of "
-            "handling it.")
-        yield AiProcessingMessage("Thinking...", result, show_user=False)
-        yield present_results(ai, conversation, request, result + "\n\nPlease apologize.")
+        yield AiProcessingMessage("Thinking...", FAILURE_NOTE, show_user=False)
+        yield present_results(ai, conversation, request, FAILURE_NOTE + "\n\nPlease apologize.")
+
+    async def acall(self, ai: AI, conversation: Conversation, request: str, state: dict) -> AsyncIterator[Message]:
+        yield AiProcessingMessage("Thinking...", FAILURE_NOTE, show_user=False)
+        yield await apresent_results(ai, conversation, request, FAILURE_NOTE + "\n\nPlease apologize.")
+
+
+FAILURE_NOTE = ("Something went wrong. The system either failed to understand the user's request or is incapable of "
+                "handling it.")
@@ -1,9 +1,10 @@
-from typing import Iterator
+from typing import AsyncIterator, Iterator
 
+from chat.content_streams import StreamedString, AsyncStreamedString
 from chat.conversation import Conversation
 from chat.messages import AiChatMessage, Message
 from chat.tools.tool import Tool
-from chat.utils.json import stream_openai
+from chat.utils.json import stream_openai, astream_openai
 from nlp.ai import AI
 
 DESCRIPTION = """\
@@ -20,6 +21,9 @@ class Converse(Tool):
     def call(self, ai: AI, conversation: Conversation, request: str, state: dict) -> Iterator[Message]:
         yield _ask_llm_for_a_friendly_response(ai, conversation, request)
 
+    async def acall(self, ai: AI, conversation: Conversation, request: str, state: dict) -> AsyncIterator[Message]:
+        yield await _aask_llm_for_a_friendly_response(ai, conversation, request)
+
 
 CONVERSATIONAL_PROMPT = """
 You are a friendly AI assistant that makes use of biodiversity information aggregated by iDigBio. You do not provide 
@@ -33,11 +37,19 @@ def _ask_llm_for_a_friendly_response(ai: AI, conversation: Conversation, request
     """
     Asks the LLM to continue the conversation without providing scientific data.
     """
-    result = ai.openai.chat.completions.create(
+    result = ai.openai.chat.completions.create(**_friendly_response_request(conversation, request))
+    return AiChatMessage(StreamedString(stream_openai(result)))
+
+
+async def _aask_llm_for_a_friendly_response(ai: AI, conversation: Conversation, request: str):
+    result = await ai.async_openai.chat.completions.create(**_friendly_response_request(conversation, request))
+    return AiChatMessage(AsyncStreamedString(astream_openai(result)))
+
+
+def _friendly_response_request(conversation: Conversation, request: str) -> dict:
+    return dict(
         model="gpt-4o",
         temperature=1,
         stream=True,
         messages=conversation.render_to_openai(system_message=CONVERSATIONAL_PROMPT, request=request)
     )
-
-    return AiChatMessage("".join(filter(None, stream_openai(result))))
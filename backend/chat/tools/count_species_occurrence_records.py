@@ -1,11 +1,11 @@
-from collections.abc import Iterator
+from collections.abc import AsyncIterator, Iterator
 
 from chat.plans import DataType
-from chat.processes.idigbio_records_summary import IDigBioRecordsSummary
+from chat.processes.idigbio_records_summary import IDigBioRecordsSummary, AsyncIDigBioRecordsSummary
 from chat.conversation import Conversation
 from chat.messages import Message
 from chat.tools.tool import Tool
-from chat.utils.assistant import present_results
+from chat.utils.assistant import present_results, apresent_results
 from nlp.ai import AI
 
 DESCRIPTION = """\
@@ -36,3 +36,8 @@ class CountSpeciesOccurrenceRecords(Tool):
         search = IDigBioRecordsSummary(ai, conversation, request)
         yield search.make_message()
         yield present_results(ai, conversation, request, search.describe())
+
+    async def acall(self, ai: AI, conversation: Conversation, request: str, state: dict) -> AsyncIterator[Message]:
+        search = AsyncIDigBioRecordsSummary(ai, conversation, request)
+        yield search.make_message()
+        yield await apresent_results(ai, conversation, request, await search.describe())
@@ -1,11 +1,11 @@
-from collections.abc import Iterator
+from collections.abc import AsyncIterator, Iterator
 
 from chat.plans import DataType
-from chat.processes.idigbio_records_search import IDigBioRecordsSearch
+from chat.processes.idigbio_records_search import IDigBioRecordsSearch, AsyncIDigBioRecordsSearch
 from chat.conversation import Conversation
 from chat.messages import Message, AiMapMessage
 from chat.tools.tool import Tool
-from chat.utils.assistant import present_results
+from chat.utils.assistant import present_results, apresent_results
 from nlp.ai import AI
 
 DESCRIPTION = """\
@@ -26,6 +26,18 @@ class ShowMapOfSpeciesOccurrences(Tool):
         if search.results.record_count > 0:
             yield AiMapMessage(search.results.params)
         else:
-            yield present_results(ai, conversation, request, search.describe() +
-                                  f"\n\nPlease explain to the user that because no records were found, no map will be "
-                                  f"shown. Be as concise as possible.")
+            yield present_results(ai, conversation, request, search.describe() + NO_RECORDS_NOTE)
+
+    async def acall(self, ai: AI, conversation: Conversation, request: str, state: dict) -> AsyncIterator[Message]:
+        search = AsyncIDigBioRecordsSearch(ai, conversation, request)
+        yield search.make_message()
+
+        results = await search.results()
+        if results.record_count > 0:
+            yield AiMapMessage(results.params)
+        else:
+            yield await apresent_results(ai, conversation, request, await search.describe() + NO_RECORDS_NOTE)
+
+
+NO_RECORDS_NOTE = ("\n\nPlease explain to the user that because no records were found, no map will be shown. Be as "
+                   "concise as possible.")
@@ -1,9 +1,11 @@
+import asyncio
 import glob
 import importlib
 import typing
 from os.path import dirname, basename, isfile, join
-from typing import Iterator
+from typing import AsyncIterator, Iterator
 
+from cancellation import cancellable
 from chat.conversation import Conversation
 from chat.messages import Message
 from chat.plans import DataType
@@ -32,6 +34,25 @@ class Tool:
         """
         pass
 
+    async def acall(self, ai: AI, conversation: Conversation, request: str, state: dict) -> AsyncIterator[Message]:
+        """
+        Asynchronous version of call. Tools that don't override it have call run to completion in a worker thread,
+        so their messages are only yielded once all of them have been generated. The thread stops between messages if
+        the turn is cancelled.
+        """
+
+        def run() -> list[Message]:
+            # Append messages as they are made so that later steps can see them, like when the response is streamed
+            fork = conversation.fork()
+            messages = []
+            for message in cancellable(self.call(ai, fork, request, state)):
+                fork.append(message)
+                messages.append(message)
+            return messages
+
+        for message in await asyncio.to_thread(run):
+            yield message
+
 
 def __gather_tools():
     modules = glob.glob(join(dirname(__file__), "*.py"))
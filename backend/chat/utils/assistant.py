@@ -1,7 +1,7 @@
-from chat.content_streams import StreamedString
+from chat.content_streams import StreamedString, AsyncStreamedString
 from chat.conversation import Conversation
 from chat.messages import AiChatMessage
-from chat.utils.json import stream_openai
+from chat.utils.json import stream_openai, astream_openai
 from nlp.ai import AI
 
 PRESENT_RESULTS_PROMPT = """
@@ -23,17 +23,27 @@ Use the context information below:
 
 
 def present_results(ai: AI, conversation: Conversation, request: str, results: str | StreamedString) -> AiChatMessage:
-    response = ai.openai.chat.completions.create(
+    """
+    :return: A message whose text is streamed from the LLM as it is generated.
+    """
+    response = ai.openai.chat.completions.create(**_present_results_request(conversation, request, results))
+    return AiChatMessage(StreamedString(stream_openai(response)))
+
+
+async def apresent_results(ai: AI, conversation: Conversation, request: str, results: str) -> AiChatMessage:
+    """
+    Asynchronous version of present_results.
+    """
+    response = await ai.async_openai.chat.completions.create(
+        **_present_results_request(conversation, request, results))
+    return AiChatMessage(AsyncStreamedString(astream_openai(response)))
+
+
+def _present_results_request(conversation: Conversation, request: str, results: str | StreamedString) -> dict:
+    return dict(
         model="gpt-4o",
         temperature=1,
         messages=conversation.render_to_openai(PRESENT_RESULTS_PROMPT.format(request=request, context=results),
                                                request),
         stream=True,
     )
-    print('PRESENT RESULTS FULL RESPOSNE:')
-    full_response = ''
-    for chunk in response:
-        if chunk.choices[0].delta.content:
-            full_response += chunk.choices[0].delta.content
-
-    return AiChatMessage(full_response)
@@ -1,5 +1,14 @@
 import json
-from typing import Iterable, Any
+from typing import Iterable, Any, AsyncIterable, AsyncIterator, Iterator
+
+from chat.content_streams import StreamedContent, StreamedDict, AsyncStreamedDict
+
+# Characters of JSON to gather before yielding them, unless streamed content is waiting for its next delta. The app
+# uses [CHAT] STREAM_CHUNK_SIZE instead.
+DEFAULT_CHUNK_SIZE = 4096
+
+# Marks points where streamed content may wait on its next delta, e.g. from the LLM, so everything before it is sent
+_FLUSH = object()
 
 
 def escape_str(s: str):
@@ -10,8 +19,77 @@ def remove_empty(it: Iterable[str | None]):
     yield from filter(bool, it)
 
 
-def stream_as_json(value: Any):
-    yield from remove_empty(_stream_as_json_unsafe(value))
+def stream_as_json(value: Any, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Streams the value as JSON in chunks of about chunk_size characters, only sending smaller ones before waiting on
+    streamed content, like StreamedString, so that each delta still reaches the frontend as soon as it is generated.
+    """
+    yield from coalesce(_stream_as_json_unsafe(value), chunk_size)
+
+
+def coalesce(fragments: Iterable[Any], chunk_size: int) -> Iterator[str]:
+    """
+    :param fragments: Strings and flush markers
+    :return: The strings joined into chunks of at least chunk_size characters, except before flush markers and at the
+    end
+    """
+    chunks = _Chunks(chunk_size)
+    for fragment in fragments:
+        chunk = chunks.add(fragment)
+        if chunk:
+            yield chunk
+    chunk = chunks.flush()
+    if chunk:
+        yield chunk
+
+
+async def acoalesce(fragments: AsyncIterable[Any], chunk_size: int) -> AsyncIterator[str]:
+    """
+    Asynchronous version of coalesce.
+    """
+    chunks = _Chunks(chunk_size)
+    async for fragment in fragments:
+        chunk = chunks.add(fragment)
+        if chunk:
+            yield chunk
+    chunk = chunks.flush()
+    if chunk:
+        yield chunk
+
+
+class _Chunks:
+    """
+    Joins fragments into chunks for coalesce and acoalesce.
+    """
+
+    def __init__(self, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.__buffer: list[str] = []
+        self.__size = 0
+
+    def add(self, fragment: Any) -> str | None:
+        """
+        :param fragment: A string or flush marker
+        :return: A chunk that is ready to be sent, if any
+        """
+        if fragment is _FLUSH:
+            return self.flush()
+        if fragment:
+            self.__buffer.append(fragment)
+            self.__size += len(fragment)
+            if self.__size >= self.chunk_size:
+                return self.flush()
+        return None
+
+    def flush(self) -> str | None:
+        """
+        :return: The fragments added since the last chunk, if any
+        """
+        if self.__size == 0:
+            return None
+        chunk = "".join(self.__buffer)
+        self.__buffer, self.__size = [], 0
+        return chunk
 
 
 def _stream_as_json_unsafe(value: Any):
@@ -32,13 +110,19 @@ def _stream_as_json_unsafe(value: Any):
                 yield ","
             yield from _stream_as_json_unsafe(v)
         yield "]"
+    elif isinstance(value, StreamedDict):
+        # Deltas may change any field of the dict, so it is sent as an object once complete
+        yield _FLUSH
+        yield from _stream_as_json_unsafe(value.get())
     elif isinstance(value, Iterable):
         yield '"'
+        yield _FLUSH
         for fragment in value:
             if isinstance(fragment, str):
                 yield escape_str(fragment)
             elif fragment is not None:
                 yield from _stream_as_json_unsafe(fragment)
+            yield _FLUSH
         yield '"'
     else:
         yield '"'
@@ -46,9 +130,89 @@ def _stream_as_json_unsafe(value: Any):
         yield '"'
 
 
+def to_json_value(value: Any) -> Any:
+    """
+    :return: What parsing the output of stream_as_json would, without encoding and parsing it. Streamed content must
+    be complete, e.g. already sent to the frontend.
+    """
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, dict):
+        return {k: to_json_value(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [to_json_value(v) for v in value]
+    elif isinstance(value, StreamedDict | AsyncStreamedDict):
+        return to_json_value(next(iter(value)))
+    elif isinstance(value, Iterable):
+        return join_fragments(value)
+    else:
+        return str(value)
+
+
+def join_fragments(value: Iterable) -> str:
+    """
+    :return: The text of streamed content, like the fragments of a StreamedString
+    """
+    if isinstance(value, StreamedContent):
+        value = [value.get()]
+    return "".join(f if isinstance(f, str) else "".join(stream_as_json(f)) for f in value if f is not None)
+
+
+async def astream_as_json(value: Any, chunk_size: int = DEFAULT_CHUNK_SIZE) -> AsyncIterator[str]:
+    """
+    Like stream_as_json, but also streams values that are generated asynchronously, like AsyncStreamedContent.
+    """
+    async for chunk in acoalesce(_astream_as_json_unsafe(value), chunk_size):
+        yield chunk
+
+
+async def _astream_as_json_unsafe(value: Any) -> AsyncIterator[str]:
+    if isinstance(value, dict):
+        yield "{"
+        for i, (k, v) in enumerate(value.items()):
+            if i > 0:
+                yield ","
+            yield f'{json.dumps(k)}:'
+            async for fragment in _astream_as_json_unsafe(v):
+                yield fragment
+        yield "}"
+    elif isinstance(value, list):
+        yield "["
+        for i, v in enumerate(value):
+            if i > 0:
+                yield ","
+            async for fragment in _astream_as_json_unsafe(v):
+                yield fragment
+        yield "]"
+    elif isinstance(value, AsyncStreamedDict):
+        yield _FLUSH
+        async for fragment in _astream_as_json_unsafe(await value.get()):
+            yield fragment
+    elif isinstance(value, AsyncIterable):
+        yield '"'
+        yield _FLUSH
+        async for fragment in value:
+            if isinstance(fragment, str):
+                yield escape_str(fragment)
+            elif fragment is not None:
+                async for f in _astream_as_json_unsafe(fragment):
+                    yield f
+            yield _FLUSH
+        yield '"'
+    else:
+        for fragment in _stream_as_json_unsafe(value):
+            yield fragment
+
+
 def stream_openai(response):
     for chunk in response:
-        if chunk.choices[0].delta.content is not None:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def astream_openai(response):
+    async for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
             yield chunk.choices[0].delta.content
 
 
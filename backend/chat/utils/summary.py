@@ -0,0 +1,33 @@
+from typing import Optional
+
+from chat.messages import ColdMessage
+from nlp.ai import AI
+
+SUMMARY_PROMPT = """
+You condense conversations between a user and a chatbot that searches biodiversity records in iDigBio. Write a brief 
+summary of the conversation that the chatbot can rely on instead of the full transcript. Keep anything the user may 
+refer back to, such as taxa, locations, dates, search parameters, record counts, URLs, email addresses, and facts the 
+user shared about themselves. Leave out greetings, pleasantries, and step-by-step processing details. If a previous 
+summary is provided, update it with the new messages. Respond with only the summary.
+"""
+
+
+def summarize_messages(ai: AI, previous_summary: Optional[str], messages: list[ColdMessage]) -> str:
+    transcript = "\n\n".join(
+        f"{m['role']}: {m['content']}" for message in messages for m in message.read("openai_messages")
+    )
+
+    if previous_summary:
+        content = f"Previous summary:\n\n{previous_summary}\n\nNew messages:\n\n{transcript}"
+    else:
+        content = f"Messages:\n\n{transcript}"
+
+    result = ai.openai.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": content}
+        ]
+    )
+    return result.choices[0].message.content
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import threading
+import time
+from typing import Optional
+
+from attr import dataclass
+from redis import Redis, RedisError
+
+import metrics
+
+KEY_PREFIX = "idigbio_cache:"
+
+# Seconds to serve responses from each endpoint without asking the API again. Endpoints that aren't listed, like
+# /v2/download, are never cached.
+DEFAULT_TTLS = {
+    "/v2/search/records": 3600,
+    "/v2/search/media": 3600,
+    "/v2/summary/top/records": 3600,
+    "/v2/summary/count/records": 3600,
+    "/v2/summary/count/media": 3600,
+}
+
+
+def make_query_key(endpoint: str, params: dict) -> str:
+    """
+    :param params: Sanitized query parameters, see idigbio_util.sanitize_json
+    :return: A hash that is the same for equivalent queries
+    """
+    canonical = json.dumps([endpoint, params], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CachedResponse:
+    code: str
+    data: dict
+    stored_at: float
+    latency: float  # Seconds it took the API to respond originally
+    stale: bool = False
+
+
+class IDigBioResponseCache:
+    """
+    Stores successful iDigBio API responses in Redis, keyed by endpoint and query, so that repeated searches don't wait
+    on the API. Once a response is older than its endpoint's TTL, it is still served for another stale_ttl seconds
+    while it is refreshed in the background.
+    """
+
+    def __init__(self, redis: Redis, ttls: dict[str, int] = None, stale_ttl: int = 0):
+        self.redis = redis
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.stale_ttl = stale_ttl
+        self.__refreshing: set[str] = set()
+        self.__lock = threading.Lock()
+
+    def make_key(self, endpoint: str, params: dict) -> Optional[str]:
+        """
+        :param params: Sanitized query parameters, see idigbio_util.sanitize_json
+        :return: A key that is the same for equivalent queries, or None if responses from the endpoint aren't cached
+        """
+        if self.ttls.get(endpoint, 0) <= 0:
+            return None
+        return KEY_PREFIX + make_query_key(endpoint, params)
+
+    def get(self, key: str, endpoint: str) -> Optional[CachedResponse]:
+        try:
+            raw = self.redis.get(key)
+        except RedisError as e:
+            print(f"iDigBio cache unavailable: {e}")
+            raw = None
+
+        if raw is None:
+            metrics.increment("idigbio_cache.misses")
+            return None
+
+        response = CachedResponse(**json.loads(raw))
+        response.stale = time.time() - response.stored_at > self.ttls[endpoint]
+
+        metrics.increment("idigbio_cache.stale_hits" if response.stale else "idigbio_cache.hits")
+        metrics.increment("idigbio_cache.saved_seconds", response.latency)
+        return response
+
+    def set(self, key: str, endpoint: str, code: str, data: dict, latency: float):
+        value = json.dumps({"code": code, "data": data, "stored_at": time.time(), "latency": latency})
+        try:
+            self.redis.set(key, value, ex=self.ttls[endpoint] + self.stale_ttl)
+        except RedisError as e:
+            print(f"iDigBio cache unavailable: {e}")
+
+    def start_refresh(self, key: str) -> bool:
+        """
+        :return: Whether the caller should refresh the response, i.e. no one else in this process is already on it
+        """
+        with self.__lock:
+            if key in self.__refreshing:
+                return False
+            self.__refreshing.add(key)
+            return True
+
+    def finish_refresh(self, key: str):
+        with self.__lock:
+            self.__refreshing.discard(key)
@@ -1,7 +1,27 @@
+import asyncio
+import contextvars
 import http.client
-from typing import Sized, Union
+import json
+import queue
+import random
+import threading
+import time
+import uuid
+import weakref
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Sized, Union, Callable, Awaitable, Iterator
 
-import requests
+import httpx
+from attr import dataclass
+from flask import Flask
+from redis import Redis, RedisError
+
+import cancellation
+import metrics
+from idigbio_cache import IDigBioResponseCache, make_query_key
+from json_stream import iter_object, IncrementalObjectParser
 
 
 def url_encode_inner(x):
@@ -60,12 +80,747 @@ def _is_empty(data):
     return len(data) == 0 if isinstance(data, Sized) else False
 
 
-def query_idigbio_api(endpoint: str, params: dict) -> (str, bool, dict):
-    params = sanitize_json(params)
-    api_url = make_idigbio_api_url(endpoint)
-    response = requests.post(api_url, json=params)
-    code = f"{response.status_code} {http.client.responses.get(response.status_code, '')}"
-    return code, response.ok, response.json()
+IDIGBIO_API_URL = "https://search.idigbio.org"
+
+# Responses worth retrying, since they are usually caused by load or brief outages
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Upper bounds of histogram buckets for iDigBio API latency, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+
+
+class IDigBioClient:
+    """
+    Sends requests to the iDigBio API over pooled keep-alive connections, with timeouts and retries. Latency is
+    recorded per endpoint in the "idigbio.latency_seconds.<endpoint>" histograms, e.g.
+    "idigbio.latency_seconds.v2.search.records".
+
+    Requests are retried with exponential backoff and full jitter when the API is overloaded or unavailable. Requests
+    that are not idempotent, like creating a download, are only retried if they could not be sent at all.
+
+    Queries are answered from a response cache when one is set up, see idigbio_cache. Identical queries that are made
+    at the same time are only sent once, see SingleFlight.
+    """
+    cache: IDigBioResponseCache | None = None
+    single_flight: "SingleFlight | None" = None
+    flight_locks: "RedisFlightLocks | None" = None
+
+    def __init__(self, connect_timeout: float = 5, read_timeout: float = 30, max_retries: int = 3,
+                 retry_backoff: float = 0.5, max_retry_backoff: float = 8, max_connections: int = 20,
+                 http2: bool = False, transport: httpx.BaseTransport = None,
+                 async_transport: httpx.AsyncBaseTransport = None):
+        """
+        :param retry_backoff: Seconds to wait, at most, before the first retry. The wait doubles with each retry.
+        :param http2: Whether to use HTTP/2, which needs the h2 package. Falls back to HTTP/1.1 if it's missing.
+        :param transport: Replaces the network, for testing
+        """
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.single_flight = SingleFlight()
+        self.__configure_connections(connect_timeout, read_timeout, max_connections, http2, transport,
+                                     async_transport)
+
+    def init_app(self, app: Flask, redis: Redis):
+        config = app.config.get("IDIGBIO", {})
+
+        self.cache = None
+        if config.get("CACHE", False):
+            self.cache = IDigBioResponseCache(redis, config.get("CACHE_TTLS"), config.get("CACHE_STALE_TTL", 0))
+
+        self.single_flight = SingleFlight() if config.get("SINGLE_FLIGHT", True) else None
+        self.flight_locks = None
+        if self.cache is not None and config.get("SINGLE_FLIGHT_REDIS_LOCK", False):
+            self.flight_locks = RedisFlightLocks(redis, timeout=config.get("READ_TIMEOUT", 30))
+
+        self.max_retries = config.get("MAX_RETRIES", self.max_retries)
+        self.retry_backoff = config.get("RETRY_BACKOFF", self.retry_backoff)
+        self.__client.close()
+        self.__configure_connections(config.get("CONNECT_TIMEOUT", 5), config.get("READ_TIMEOUT", 30),
+                                     config.get("MAX_CONNECTIONS", 20), config.get("HTTP2", False))
+
+    def __configure_connections(self, connect_timeout: float, read_timeout: float, max_connections: int,
+                                http2: bool, transport: httpx.BaseTransport = None,
+                                async_transport: httpx.AsyncBaseTransport = None):
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.http2 = http2 and _http2_available()
+        self.async_transport = async_transport
+
+        self.__client = httpx.Client(base_url=IDIGBIO_API_URL, timeout=self.timeout, limits=self.limits,
+                                     http2=self.http2, transport=transport)
+
+        # Async clients pool their connections, but can only be used with the event loop they were created in
+        self.__async_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = \
+            weakref.WeakKeyDictionary()
+        # Keeps background refreshes of cached responses from being garbage collected before they finish
+        self.__refresh_tasks: set[asyncio.Task] = set()
+
+    def request(self, method: str, url: str, idempotent: bool = True, stream: bool = False,
+                **kwargs) -> httpx.Response:
+        """
+        :param url: An endpoint, like "/v2/search/records", or a full URL
+        :param stream: Whether to return as soon as the response headers arrive, leaving the body to be read and the
+        response to be closed by the caller
+        :param kwargs: Passed on to httpx, e.g. json=...
+        :raises cancellation.Cancelled: If the turn that the request is made for was cancelled
+        """
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            cancellation.check_cancelled(skipped="idigbio.cancelled_requests")
+            try:
+                response = self.__client.send(self.__client.build_request(method, url, **kwargs), stream=stream)
+            except httpx.TransportError as e:
+                if not self.__should_retry_error(e, attempt, idempotent):
+                    _record_latency(url, start, failed=True)
+                    raise
+                time.sleep(self.__backoff(attempt))
+                continue
+
+            if not self.__should_retry_response(response, attempt, idempotent):
+                _record_latency(url, start, failed=response.is_error)
+                return response
+            response.close()
+            time.sleep(self.__backoff(attempt, response))
+
+    async def arequest(self, method: str, url: str, idempotent: bool = True, stream: bool = False,
+                       **kwargs) -> httpx.Response:
+        """
+        Asynchronous version of request.
+
+        :raises cancellation.Cancelled: If the turn that the request is made for was cancelled
+        """
+        client = self.__get_async_client()
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            cancellation.check_cancelled(skipped="idigbio.cancelled_requests")
+            try:
+                response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+            except httpx.TransportError as e:
+                if not self.__should_retry_error(e, attempt, idempotent):
+                    _record_latency(url, start, failed=True)
+                    raise
+                await asyncio.sleep(self.__backoff(attempt))
+                continue
+
+            if not self.__should_retry_response(response, attempt, idempotent):
+                _record_latency(url, start, failed=response.is_error)
+                return response
+            await response.aclose()
+            await asyncio.sleep(self.__backoff(attempt, response))
+
+    def query(self, method: str, url: str, params: dict = None, idempotent: bool = True) -> (str, bool, dict):
+        """
+        :param url: An endpoint or full URL, without a query string
+        :param params: Sanitized parameters to send as the body of a POST request, or as the query string of a GET
+        request. Responses are cached and shared by these parameters.
+        :return: A description of the response code, whether the request succeeded and the response's JSON content
+        """
+        endpoint, query_key, key = self.__make_keys(url, params, idempotent)
+        if key is not None:
+            cached = self.cache.get(key, endpoint)
+            if cached is not None:
+                if cached.stale and self.cache.start_refresh(key):
+                    threading.Thread(target=self.__refresh, args=(method, url, params, endpoint, key),
+                                     daemon=True).start()
+                return cached.code, True, cached.data
+
+        if query_key is None or self.single_flight is None:
+            return self.__fetch(method, url, params, idempotent, endpoint, key)
+        return self.single_flight.do(query_key, lambda: self.__fetch_once(method, url, params, endpoint, key))
+
+    async def aquery(self, method: str, url: str, params: dict = None, idempotent: bool = True) -> (str, bool, dict):
+        """
+        Asynchronous version of query.
+        """
+        endpoint, query_key, key = self.__make_keys(url, params, idempotent)
+        if key is not None:
+            cached = await asyncio.to_thread(self.cache.get, key, endpoint)
+            if cached is not None:
+                if cached.stale and self.cache.start_refresh(key):
+                    task = asyncio.create_task(self.__arefresh(method, url, params, endpoint, key))
+                    self.__refresh_tasks.add(task)
+                    task.add_done_callback(self.__refresh_tasks.discard)
+                return cached.code, True, cached.data
+
+        if query_key is None or self.single_flight is None:
+            return await self.__afetch(method, url, params, idempotent, endpoint, key)
+        return await self.single_flight.ado(query_key,
+                                            lambda: self.__afetch_once(method, url, params, endpoint, key))
+
+    def __make_keys(self, url: str, params: dict, idempotent: bool) -> (str, str | None, str | None):
+        """
+        :return: The endpoint, a key identifying the query if it is idempotent, and its cache key if it is cached
+        """
+        endpoint = httpx.URL(url).path
+        if not idempotent:
+            return endpoint, None, None
+
+        query = params if params is not None else {}
+        key = self.cache.make_key(endpoint, query) if self.cache is not None else None
+        return endpoint, make_query_key(endpoint, query), key
+
+    def __fetch_once(self, method: str, url: str, params: dict, endpoint: str, key: str | None) -> (str, bool, dict):
+        """
+        Fetches a response, unless another process is already fetching it, in which case it waits for the response to
+        be cached.
+        """
+        if self.flight_locks is None or key is None:
+            return self.__fetch(method, url, params, True, endpoint, key)
+
+        token = self.flight_locks.acquire(key)
+        if token is None:
+            self.flight_locks.wait(key)
+            cached = self.cache.get(key, endpoint)
+            if cached is not None:
+                metrics.increment("idigbio.single_flight.collapsed_across_processes")
+                return cached.code, True, cached.data
+
+        try:
+            return self.__fetch(method, url, params, True, endpoint, key)
+        finally:
+            if token is not None:
+                self.flight_locks.release(key, token)
+
+    async def __afetch_once(self, method: str, url: str, params: dict, endpoint: str,
+                            key: str | None) -> (str, bool, dict):
+        """
+        Asynchronous version of __fetch_once.
+        """
+        if self.flight_locks is None or key is None:
+            return await self.__afetch(method, url, params, True, endpoint, key)
+
+        token = await asyncio.to_thread(self.flight_locks.acquire, key)
+        if token is None:
+            await self.flight_locks.await_release(key)
+            cached = await asyncio.to_thread(self.cache.get, key, endpoint)
+            if cached is not None:
+                metrics.increment("idigbio.single_flight.collapsed_across_processes")
+                return cached.code, True, cached.data
+
+        try:
+            return await self.__afetch(method, url, params, True, endpoint, key)
+        finally:
+            if token is not None:
+                await asyncio.to_thread(self.flight_locks.release, key, token)
+
+    def __fetch(self, method: str, url: str, params: dict, idempotent: bool, endpoint: str,
+                key: str | None) -> (str, bool, dict):
+        start = time.perf_counter()
+        response = self.request(method, url, idempotent=idempotent, stream=True,
+                                **_make_request_content(method, params))
+        result = _describe_status(response), not response.is_error, _read_json(response, endpoint)
+        if key is not None and result[1]:
+            self.cache.set(key, endpoint, result[0], result[2], time.perf_counter() - start)
+        return result
+
+    async def __afetch(self, method: str, url: str, params: dict, idempotent: bool, endpoint: str,
+                       key: str | None) -> (str, bool, dict):
+        start = time.perf_counter()
+        response = await self.arequest(method, url, idempotent=idempotent, stream=True,
+                                       **_make_request_content(method, params))
+        result = _describe_status(response), not response.is_error, await _aread_json(response, endpoint)
+        if key is not None and result[1]:
+            await asyncio.to_thread(self.cache.set, key, endpoint, result[0], result[2], time.perf_counter() - start)
+        return result
+
+    def __refresh(self, method: str, url: str, params: dict, endpoint: str, key: str):
+        try:
+            self.__fetch(method, url, params, True, endpoint, key)
+        except httpx.HTTPError as e:
+            print(f"IDIGBIO: failed to refresh cached response from {endpoint}: {e}")
+        finally:
+            self.cache.finish_refresh(key)
+
+    async def __arefresh(self, method: str, url: str, params: dict, endpoint: str, key: str):
+        try:
+            await self.__afetch(method, url, params, True, endpoint, key)
+        except httpx.HTTPError as e:
+            print(f"IDIGBIO: failed to refresh cached response from {endpoint}: {e}")
+        finally:
+            self.cache.finish_refresh(key)
+
+    def __get_async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if loop not in self.__async_clients:
+            self.__async_clients[loop] = httpx.AsyncClient(base_url=IDIGBIO_API_URL, timeout=self.timeout,
+                                                           limits=self.limits, http2=self.http2,
+                                                           transport=self.async_transport)
+        return self.__async_clients[loop]
+
+    def __should_retry_error(self, e: httpx.TransportError, attempt: int, idempotent: bool) -> bool:
+        # Requests that failed to connect never reached the API, so they are safe to send again
+        unsent = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+        if attempt >= self.max_retries or not (idempotent or unsent):
+            return False
+
+        metrics.increment("idigbio.retries")
+        print(f"IDIGBIO: retrying after {type(e).__name__}")
+        return True
+
+    def __should_retry_response(self, response: httpx.Response, attempt: int, idempotent: bool) -> bool:
+        if attempt >= self.max_retries or not idempotent or response.status_code not in RETRY_STATUS_CODES:
+            return False
+
+        metrics.increment("idigbio.retries")
+        print(f"IDIGBIO: retrying after {response.status_code} response from {response.request.url.path}")
+        return True
+
+    def __backoff(self, attempt: int, response: httpx.Response = None) -> float:
+        """
+        :return: Seconds to wait before the next attempt. Waits as long as the API asks with a Retry-After header.
+        """
+        retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+        if retry_after.isdigit():
+            return min(float(retry_after), self.max_retry_backoff)
+        return random.uniform(0, min(self.retry_backoff * 2 ** attempt, self.max_retry_backoff))
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls made at the same time, so that only the first caller does the work and the others wait
+    for and share its result. Works across threads and event loops. Shared results should be treated as read-only.
+
+    Cancellation isn't shared: if the first caller's turn is cancelled, the callers waiting on it make the call again.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__flights: dict[str, Future] = {}
+
+    def do(self, key: str, fn: Callable):
+        while True:
+            flight, leader = self.__join(key)
+            if leader:
+                break
+            try:
+                return flight.result()
+            except _Abandoned:
+                continue
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self.__land(key, flight, exception=e)
+            raise
+        self.__land(key, flight, result=result)
+        return result
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable]):
+        """
+        Asynchronous version of do.
+        """
+        while True:
+            flight, leader = self.__join(key)
+            if leader:
+                break
+            try:
+                # Shielded, so that cancelling one of the waiting tasks doesn't cancel the flight for everyone
+                return await asyncio.shield(asyncio.wrap_future(flight))
+            except _Abandoned:
+                continue
+
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.__land(key, flight, exception=e)
+            raise
+        self.__land(key, flight, result=result)
+        return result
+
+    def __join(self, key: str) -> (Future, bool):
+        with self.__lock:
+            if key in self.__flights:
+                metrics.increment("idigbio.single_flight.collapsed")
+                return self.__flights[key], False
+            flight = self.__flights[key] = Future()
+            return flight, True
+
+    def __land(self, key: str, flight: Future, result=None, exception: BaseException = None):
+        with self.__lock:
+            del self.__flights[key]
+        if isinstance(exception, (cancellation.Cancelled, asyncio.CancelledError)):
+            metrics.increment("idigbio.single_flight.abandoned")
+            flight.set_exception(_Abandoned())
+        elif exception is not None:
+            flight.set_exception(exception)
+        else:
+            flight.set_result(result)
+
+
+class _Abandoned(Exception):
+    """
+    Tells the callers waiting on a flight that its leader was cancelled before finishing.
+    """
+
+
+FLIGHT_LOCK_PREFIX = "idigbio_flight:"
+
+
+class RedisFlightLocks:
+    """
+    Lets one worker process at a time fetch a cacheable response, while the others wait for it to show up in the cache.
+    """
+
+    def __init__(self, redis: Redis, timeout: float, poll_interval: float = 0.05):
+        """
+        :param timeout: Seconds after which a lock is abandoned, e.g. because its holder crashed
+        """
+        self.redis = redis
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def acquire(self, key: str) -> str | None:
+        """
+        :return: A token for releasing the lock, or None if another process holds it
+        """
+        token = uuid.uuid4().hex
+        try:
+            acquired = self.redis.set(FLIGHT_LOCK_PREFIX + key, token, nx=True, px=int(self.timeout * 1000))
+        except RedisError as e:
+            print(f"iDigBio flight locks unavailable: {e}")
+            return token
+        return token if acquired else None
+
+    def release(self, key: str, token: str):
+        # Compare and delete in a transaction, so that a lock that expired and was taken by someone else is kept
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.watch(FLIGHT_LOCK_PREFIX + key)
+                if pipe.get(FLIGHT_LOCK_PREFIX + key) == token.encode("utf-8"):
+                    pipe.multi()
+                    pipe.delete(FLIGHT_LOCK_PREFIX + key)
+                    pipe.execute()
+        except RedisError as e:
+            print(f"Failed to release iDigBio flight lock: {e}")
+
+    def wait(self, key: str):
+        deadline = time.monotonic() + self.timeout
+        while self.__is_locked(key) and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+
+    async def await_release(self, key: str):
+        deadline = time.monotonic() + self.timeout
+        while await asyncio.to_thread(self.__is_locked, key) and time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+
+    def __is_locked(self, key: str) -> bool:
+        try:
+            return self.redis.exists(FLIGHT_LOCK_PREFIX + key) > 0
+        except RedisError:
+            return False
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        print("HTTP/2 needs the h2 package, falling back to HTTP/1.1 for the iDigBio API")
+        return False
+
+
+def _record_latency(url: str, start: float, failed: bool):
+    endpoint = httpx.URL(url).path.strip("/").replace("/", ".")
+    metrics.increment(f"idigbio.requests.{endpoint}")
+    if failed:
+        metrics.increment(f"idigbio.errors.{endpoint}")
+    metrics.observe(f"idigbio.latency_seconds.{endpoint}", time.perf_counter() - start, LATENCY_BUCKETS)
+
+
+client = IDigBioClient()
+
+
+def query_idigbio_api(endpoint: str, params: dict, idempotent: bool = True) -> (str, bool, dict):
+    """
+    :param idempotent: Whether the request can safely be sent again if the API fails to respond to it. Responses to
+    requests that aren't idempotent are never cached.
+    """
+    return client.query("POST", endpoint, sanitize_json(params), idempotent=idempotent)
+
+
+async def query_idigbio_api_async(endpoint: str, params: dict, idempotent: bool = True) -> (str, bool, dict):
+    """
+    Asynchronous version of query_idigbio_api.
+    """
+    return await client.aquery("POST", endpoint, sanitize_json(params), idempotent=idempotent)
+
+
+# Summary endpoints that count the records matched by a search endpoint, without returning any of them
+COUNT_ENDPOINTS = {
+    "/v2/search/records": "/v2/summary/count/records",
+    "/v2/search/media": "/v2/summary/count/media",
+}
+
+
+class StreamedSearch:
+    """
+    A response from one of the iDigBio search endpoints that is parsed as it is read, so that only one record at a
+    time is held in memory.
+    """
+
+    def __init__(self, response: httpx.Response):
+        self.code = _describe_status(response)
+        self.success = not response.is_error
+        self.fields = {}  # Top-level fields parsed so far, like itemCount
+        self.__pending = deque()
+
+        if self.success:
+            self.__events = iter_object(response.iter_bytes(), stream_keys=["items"])
+        else:
+            self.__events = iter([])
+            response.read()
+            try:
+                self.fields = response.json()
+            except ValueError:
+                pass
+
+    @property
+    def item_count(self) -> int:
+        """
+        The total number of records matched by the search. iDigBio sends it before the records, so none have to be
+        parsed to find it.
+        """
+        while "itemCount" not in self.fields and self.__advance():
+            pass
+        return self.fields.get("itemCount", 0)
+
+    def items(self) -> Iterator[dict]:
+        """
+        :return: The records in the response, each parsed once its last byte arrives
+        """
+        while True:
+            while self.__pending:
+                yield self.__pending.popleft()
+            if not self.__advance():
+                return
+
+    def __advance(self) -> bool:
+        start = time.perf_counter()
+        event = next(self.__events, None)
+        metrics.increment("idigbio.parse_seconds", time.perf_counter() - start)
+
+        if event is None:
+            return False
+
+        key, value = event
+        if key == "items":
+            self.__pending.append(value)
+        else:
+            self.fields[key] = value
+        return True
+
+
+@contextmanager
+def stream_idigbio_search(endpoint: str, params: dict) -> Iterator[StreamedSearch]:
+    """
+    Searches iDigBio, parsing records as they arrive. Responses aren't cached.
+
+    :param endpoint: "/v2/search/records" or "/v2/search/media"
+    """
+    response = client.request("POST", endpoint, json=sanitize_json(params), stream=True)
+    scope = cancellation.current_scope()
+    if scope is not None:
+        # Stop downloading records as soon as the turn is cancelled
+        scope.add(response)
+    try:
+        yield StreamedSearch(response)
+    finally:
+        if scope is not None:
+            scope.discard(response)
+        metrics.increment("idigbio.downloaded_bytes", response.num_bytes_downloaded)
+        response.close()
+
+
+class IDigBioError(Exception):
+    def __init__(self, code: str):
+        super().__init__(f"The iDigBio API responded with {code}")
+        self.code = code
+
+
+@dataclass
+class RecordPage:
+    offset: int
+    item_count: int  # The total number of records matched by the search
+    items: list[dict]
+
+
+# The search endpoints only return records up to this offset + limit
+SEARCH_WINDOW = 10000
+
+# Marks the end of a paginated search in the page queue
+_LAST_PAGE = object()
+
+
+def paginate_idigbio_search(endpoint: str, params: dict, page_size: int = 100, max_records: int = SEARCH_WINDOW,
+                            prefetch: int = 2) -> Iterator[RecordPage]:
+    """
+    Pages through the records matched by a search using limit and offset. Pages are fetched by a background thread
+    while earlier ones are consumed, at most `prefetch` pages ahead, so that only a few pages are ever held in memory.
+    Fetching stops when the returned iterator is closed.
+
+    :param endpoint: "/v2/search/records" or "/v2/search/media"
+    :param max_records: Stop after this many records, even if more match. Searches can't be paged past SEARCH_WINDOW.
+    :raises IDigBioError: If the API fails to return a page
+    """
+    max_records = min(max_records, SEARCH_WINDOW)
+    pages = queue.Queue(maxsize=prefetch)
+    stopped = threading.Event()
+
+    def put(page):
+        while not stopped.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def fetch_pages():
+        offset = 0
+        try:
+            while not stopped.is_set():
+                limit = min(page_size, max_records - offset)
+                with stream_idigbio_search(endpoint, params | {"limit": limit, "offset": offset}) as search:
+                    if not search.success:
+                        raise IDigBioError(search.code)
+                    page = RecordPage(offset=offset, item_count=search.item_count, items=list(search.items()))
+
+                put(page)
+                offset += len(page.items)
+                if len(page.items) == 0 or offset >= min(page.item_count, max_records):
+                    break
+        except Exception as e:
+            put(e)
+        finally:
+            put(_LAST_PAGE)
+
+    # Copy the context so that pages are counted towards the current turn and stop being fetched if it is cancelled
+    threading.Thread(target=contextvars.copy_context().run, args=(fetch_pages,), daemon=True).start()
+    try:
+        while (page := pages.get()) is not _LAST_PAGE:
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stopped.set()
+
+
+def count_idigbio_records(search_endpoint: str, params: dict) -> (str, bool, int):
+    """
+    Counts the records that a search would match. Much less data is transferred and parsed than when searching, since
+    no records are returned.
+
+    :param search_endpoint: "/v2/search/records" or "/v2/search/media"
+    :param params: Search parameters. Only the record and media queries are used.
+    :return: A description of the response code, whether the request succeeded and the number of matching records
+    """
+    code, success, data = client.query("POST", COUNT_ENDPOINTS[search_endpoint], _make_count_query(params))
+    return code, success, data.get("itemCount", 0)
+
+
+async def count_idigbio_records_async(search_endpoint: str, params: dict) -> (str, bool, int):
+    """
+    Asynchronous version of count_idigbio_records.
+    """
+    code, success, data = await client.aquery("POST", COUNT_ENDPOINTS[search_endpoint], _make_count_query(params))
+    return code, success, data.get("itemCount", 0)
+
+
+def _make_count_query(params: dict) -> dict:
+    # Sent as JSON rather than in the URL, which url_encode_params doesn't fully escape and which loses JSON types
+    return sanitize_json({k: v for k, v in params.items() if k in ("rq", "mq")})
+
+
+def _describe_status(response: httpx.Response) -> str:
+    return f"{response.status_code} {http.client.responses.get(response.status_code, '')}"
+
+
+def _make_request_content(method: str, params: dict | None) -> dict:
+    """
+    :return: Arguments for httpx that send params in the body of a POST request, or in the query string of a GET
+    request with each value encoded as JSON
+    """
+    if params is None:
+        return {}
+    if method == "GET":
+        return {"params": {k: json.dumps(v, separators=(",", ":")) for k, v in params.items()}}
+    return {"json": params}
+
+
+def _read_json(response: httpx.Response, endpoint: str) -> dict:
+    """
+    Reads and closes a streamed response, parsing its JSON as it arrives.
+    """
+    reader = _JSONReader(response, endpoint)
+    try:
+        for chunk in response.iter_bytes():
+            reader.feed(chunk)
+        return reader.close()
+    except ValueError:
+        # Error pages from proxies in front of the API aren't JSON
+        return {}
+    finally:
+        response.close()
+        reader.record_metrics()
+
+
+async def _aread_json(response: httpx.Response, endpoint: str) -> dict:
+    """
+    Asynchronous version of _read_json.
+    """
+    reader = _JSONReader(response, endpoint)
+    try:
+        async for chunk in response.aiter_bytes():
+            reader.feed(chunk)
+        return reader.close()
+    except ValueError:
+        return {}
+    finally:
+        await response.aclose()
+        reader.record_metrics()
+
+
+class _JSONReader:
+    """
+    Parses a JSON object from the chunks of a response. The records in search results are parsed one at a time, so
+    that the raw text of the whole page is never held in memory.
+    """
+
+    def __init__(self, response: httpx.Response, endpoint: str):
+        self.response = response
+        # The search endpoints are the ones with counterparts in COUNT_ENDPOINTS
+        self.stream_keys = ["items"] if endpoint in COUNT_ENDPOINTS else []
+        self.parser = IncrementalObjectParser(self.stream_keys)
+        self.data = {}
+        self.size = 0
+        self.parse_seconds = 0
+
+    def feed(self, chunk: bytes):
+        self.size += len(chunk)
+        start = time.perf_counter()
+        self.__add(self.parser.feed(chunk))
+        self.parse_seconds += time.perf_counter() - start
+
+    def close(self) -> dict:
+        start = time.perf_counter()
+        self.__add(self.parser.close())
+        self.parse_seconds += time.perf_counter() - start
+        # Empty arrays emit no events
+        for key in self.parser.streamed_keys:
+            self.data.setdefault(key, [])
+        return self.data
+
+    def record_metrics(self):
+        metrics.increment("idigbio.downloaded_bytes", self.response.num_bytes_downloaded)
+        metrics.increment("idigbio.response_bytes", self.size)
+        metrics.increment("idigbio.parse_seconds", self.parse_seconds)
+
+    def __add(self, events: list):
+        for key, value in events:
+            if key in self.stream_keys:
+                self.data.setdefault(key, []).append(value)
+            else:
+                self.data[key] = value
 
 
 def make_idigbio_portal_url(params: dict = None):
@@ -75,4 +830,4 @@ def make_idigbio_portal_url(params: dict = None):
 
 def make_idigbio_api_url(endpoint: str, params: dict = None) -> str:
     url_params = "" if params is None else "?" + url_encode_params(params)
-    return f"https://search.idigbio.org{endpoint}{url_params}"
+    return f"{IDIGBIO_API_URL}{endpoint}{url_params}"
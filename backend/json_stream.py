@@ -0,0 +1,205 @@
+"""
+Parses JSON objects as their bytes arrive, so that large API responses, like pages of iDigBio search results, can be
+processed one item at a time instead of being held in memory in full.
+"""
+import codecs
+import json
+import re
+from typing import Any, Iterable, Iterator
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NUMBER_ENDS = " \t\n\r,]}"
+_STRUCTURE = re.compile(r'[{}\[\]"]')
+_STRING_END = re.compile(r'["\\]')
+
+# Parser states, named after what is expected next
+_START = "start"
+_FIRST_KEY = "first key"
+_KEY = "key"
+_COLON = "colon"
+_VALUE = "value"
+_MEMBER_SEPARATOR = "member separator"
+_FIRST_ELEMENT = "first element"
+_ELEMENT = "element"
+_ELEMENT_SEPARATOR = "element separator"
+_DONE = "done"
+
+_INCOMPLETE = object()
+
+
+class IncrementalObjectParser:
+    """
+    Parses a JSON object fed to it in chunks of bytes. Members are emitted as (key, value) events as soon as they are
+    complete, except for the members named in stream_keys, which must be arrays: an event is emitted for each of their
+    elements instead. Only the element being parsed is ever buffered, and it is only decoded once its last byte has
+    arrived, so that each byte is scanned once however many chunks an element is split into.
+    """
+
+    def __init__(self, stream_keys: Iterable[str] = ("items",)):
+        self.stream_keys = set(stream_keys)
+        self.streamed_keys = set()  # The members of stream_keys found so far, including empty ones
+        self.__decoder = json.JSONDecoder()
+        self.__text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.__buffer = ""
+        self.__pos = 0
+        self.__chunks = []  # Text that arrived while the value at __pos was incomplete, not yet joined to the buffer
+        self.__scan: _ValueScan | None = None  # Where the value at __pos was scanned up to, if it is incomplete
+        self.__state = _START
+        self.__key = None
+        self.__final = False
+
+    def feed(self, chunk: bytes) -> list[tuple[str, Any]]:
+        """
+        :return: The events completed by the chunk
+        """
+        return self.__add(self.__text_decoder.decode(chunk))
+
+    def close(self) -> list[tuple[str, Any]]:
+        """
+        :return: The remaining events
+        :raises ValueError: If the document is incomplete
+        """
+        self.__final = True
+        events = self.__add(self.__text_decoder.decode(b"", final=True))
+        if self.__state != _DONE:
+            raise ValueError(f"Incomplete JSON object, expected {self.__state}")
+        return events
+
+    def __add(self, text: str) -> list[tuple[str, Any]]:
+        self.__chunks.append(text)
+        # Leave incomplete values in pieces until they end, rather than copying them into the buffer with every chunk
+        if self.__scan is not None and not self.__final and not self.__scan.feed(text):
+            return []
+
+        self.__buffer = self.__buffer[self.__pos:] + "".join(self.__chunks)
+        self.__chunks = []
+        self.__pos = 0
+        return self.__parse()
+
+    def __parse(self) -> list[tuple[str, Any]]:
+        events = []
+        while True:
+            self.__pos = _WHITESPACE.match(self.__buffer, self.__pos).end()
+            if self.__pos >= len(self.__buffer):
+                return events
+
+            c = self.__buffer[self.__pos]
+            state = self.__state
+
+            if state == _START:
+                self.__expect(c, "{", _FIRST_KEY)
+            elif state == _FIRST_KEY and c == "}":
+                self.__expect(c, "}", _DONE)
+            elif state in (_FIRST_KEY, _KEY):
+                key = self.__decode()
+                if key is _INCOMPLETE:
+                    return events
+                if not isinstance(key, str):
+                    raise ValueError(f"Expected a key at position {self.__pos}, found {key!r}")
+                self.__key = key
+                self.__state = _COLON
+            elif state == _COLON:
+                self.__expect(c, ":", _VALUE)
+            elif state == _VALUE and self.__key in self.stream_keys:
+                self.__expect(c, "[", _FIRST_ELEMENT)
+                self.streamed_keys.add(self.__key)
+            elif state == _VALUE:
+                value = self.__decode()
+                if value is _INCOMPLETE:
+                    return events
+                events.append((self.__key, value))
+                self.__state = _MEMBER_SEPARATOR
+            elif state == _MEMBER_SEPARATOR:
+                self.__expect(c, ",}", _KEY if c == "," else _DONE)
+            elif state == _FIRST_ELEMENT and c == "]":
+                self.__expect(c, "]", _MEMBER_SEPARATOR)
+            elif state in (_FIRST_ELEMENT, _ELEMENT):
+                element = self.__decode()
+                if element is _INCOMPLETE:
+                    return events
+                events.append((self.__key, element))
+                self.__state = _ELEMENT_SEPARATOR
+            elif state == _ELEMENT_SEPARATOR:
+                self.__expect(c, ",]", _ELEMENT if c == "," else _MEMBER_SEPARATOR)
+            else:
+                raise ValueError(f"Extra data at position {self.__pos}")
+
+    def __expect(self, c: str, expected: str, next_state: str):
+        if c not in expected:
+            raise ValueError(f"Expected {self.__state} at position {self.__pos}, found {c!r}")
+        self.__pos += 1
+        self.__state = next_state
+
+    def __decode(self) -> Any:
+        if self.__scan is None and not self.__final and self.__buffer[self.__pos] in '{["':
+            scan = _ValueScan()
+            if not scan.feed(self.__buffer, self.__pos):
+                self.__scan = scan
+                return _INCOMPLETE
+        self.__scan = None
+
+        try:
+            value, end = self.__decoder.raw_decode(self.__buffer, self.__pos)
+        except json.JSONDecodeError:
+            if self.__final:
+                raise
+            return _INCOMPLETE
+
+        # A number may continue in the next chunk, e.g. "12" may turn out to be "12.5e3", unless something follows it
+        is_number = isinstance(value, int | float) and not isinstance(value, bool)
+        if is_number and not self.__final and (end == len(self.__buffer) or self.__buffer[end] not in _NUMBER_ENDS):
+            return _INCOMPLETE
+
+        self.__pos = end
+        return value
+
+
+class _ValueScan:
+    """
+    Finds the end of a JSON object, array or string that arrives in pieces, without decoding it.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str, pos: int = 0) -> bool:
+        """
+        :return: Whether the value ends in text
+        """
+        while True:
+            if self.escaped:
+                if pos >= len(text):
+                    return False
+                pos += 1
+                self.escaped = False
+
+            match = (_STRING_END if self.in_string else _STRUCTURE).search(text, pos)
+            if match is None:
+                return False
+            pos = match.end()
+
+            c = match.group()
+            if c == "\\":
+                self.escaped = True
+            elif c == '"':
+                self.in_string = not self.in_string
+                if not self.in_string and self.depth == 0:
+                    return True
+            elif c in "{[":
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+
+
+def iter_object(chunks: Iterable[bytes], stream_keys: Iterable[str] = ("items",)) -> Iterator[tuple[str, Any]]:
+    """
+    :return: The events of parsing a JSON object from chunks of bytes, see IncrementalObjectParser
+    """
+    parser = IncrementalObjectParser(stream_keys)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
@@ -0,0 +1,446 @@
+"""
+Local copies of iDigBio occurrence records, built from the DarwinCore Archives sent by the download API, so that
+repeated searches over the same large subsets, like a state's flora, can be answered without asking the iDigBio API.
+
+Records are stored in SQLite with an index on each commonly searched field, and searches in the iDigBio query format
+are translated into SQL. A store only answers queries that are at least as narrow as the query it was downloaded with.
+
+To build a store from an archive, run from the backend directory:
+
+    python -m local_occurrences archive.zip -o stores/florida.sqlite --rq '{"stateprovince": "florida"}'
+"""
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import re
+import sqlite3
+import time
+import zipfile
+import xml.etree.ElementTree as ElementTree
+from contextlib import closing
+from typing import Iterator, Optional
+
+import metrics
+from schema.idigbio.api import IDBRecordsQuerySchema
+
+DATE_FIELDS = {"datecollected", "datemodified", "eventdate"}
+NUMERIC_FIELDS = {"maxdepth", "maxelevation", "mindepth", "minelevation", "version"}
+BOOLEAN_FIELDS = {"hasImage"}
+
+# Every field of the query format, except geopoint, which is stored as lat and lon columns
+FIELDS = [f.alias or name for name, f in IDBRecordsQuerySchema.model_fields.items() if name != "geopoint"]
+
+INDEXED_FIELDS = ["scientificname", "genus", "family", "order", "class", "kingdom", "country", "stateprovince",
+                  "county", "institutioncode", "collectioncode", "recordset", "basisofrecord", "datecollected"]
+
+# Terms, without namespaces and lowercased, that archive columns may use for each field, in order of preference
+FIELD_TERMS = {
+    "uuid": ["uuid", "coreid", "id"],
+    "datecollected": ["datecollected", "eventdate"],
+    "datemodified": ["datemodified", "modified"],
+    "collector": ["collector", "recordedby"],
+    "commonname": ["commonname", "vernacularname"],
+    "maxdepth": ["maxdepth", "maximumdepthinmeters"],
+    "mindepth": ["mindepth", "minimumdepthinmeters"],
+    "maxelevation": ["maxelevation", "maximumelevationinmeters"],
+    "minelevation": ["minelevation", "minimumelevationinmeters"],
+    "hasImage": ["hasimage"],
+}
+
+_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_DWC_TEXT_NAMESPACE = "{http://rs.tdwg.org/dwc/text/}"
+
+
+class UnsupportedQuery(Exception):
+    """
+    Raised for queries that the local query engine can't translate, which should be sent to the iDigBio API instead.
+    """
+
+
+class LocalOccurrenceStore:
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self.__connect()) as connection:
+            info = dict(connection.execute("SELECT key, value FROM store_info"))
+        self.source_rq = json.loads(info["source_rq"])
+        self.record_count = int(info["record_count"])
+
+    def covers(self, rq: dict) -> bool:
+        """
+        :return: Whether every record matching rq is in the store, i.e. rq repeats every filter of the query the store
+        was downloaded with
+        """
+        return all(_normalize(rq.get(field)) == _normalize(value) for field, value in self.source_rq.items())
+
+    def count(self, rq: dict) -> int:
+        where, params = build_where(rq)
+        with closing(self.__connect()) as connection:
+            return connection.execute(f"SELECT COUNT(*) FROM records WHERE {where}", params).fetchone()[0]
+
+    def search(self, rq: dict, limit: int = 100, offset: int = 0) -> list[dict]:
+        """
+        :return: Matching records as dicts of field values, like the "indexTerms" of iDigBio search results
+        """
+        where, params = build_where(rq)
+        with closing(self.__connect()) as connection:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute(f"SELECT * FROM records WHERE {where} LIMIT ? OFFSET ?",
+                                      params + [limit, offset])
+            return [_row_to_record(row) for row in rows]
+
+    def top_counts(self, rq: dict, top_field: str, count: int = 10) -> dict:
+        """
+        :return: Counts of the most common values of top_field among matching records, in the format of the iDigBio
+        summary API: { "itemCount": int, top_field: { value: { "itemCount": int } } }
+        """
+        if top_field not in FIELDS:
+            raise UnsupportedQuery(f"Can't count values of {top_field}")
+
+        where, params = build_where(rq)
+        column = _quote(top_field)
+        with closing(self.__connect()) as connection:
+            total = connection.execute(f"SELECT COUNT(*) FROM records WHERE {where}", params).fetchone()[0]
+            rows = connection.execute(f"SELECT {column}, COUNT(*) AS n FROM records "
+                                      f"WHERE {where} AND {column} IS NOT NULL "
+                                      f"GROUP BY {column} ORDER BY n DESC, {column} LIMIT ?", params + [count])
+            return {"itemCount": total, top_field: {value: {"itemCount": n} for value, n in rows}}
+
+    def __connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        connection.create_function("distance_km", 4, _distance_km, deterministic=True)
+        return connection
+
+
+class LocalOccurrenceStores:
+    """
+    The local stores configured for the app, in [IDIGBIO] LOCAL_STORES.
+    """
+
+    def __init__(self):
+        self.stores: list[LocalOccurrenceStore] = []
+
+    def init_app(self, app):
+        paths = app.config.get("IDIGBIO", {}).get("LOCAL_STORES", [])
+        self.stores = [LocalOccurrenceStore(path) for path in paths]
+
+    def find(self, rq: dict) -> Optional[LocalOccurrenceStore]:
+        """
+        :return: The smallest store that covers rq, if any
+        """
+        covering = [store for store in self.stores if store.covers(rq)]
+        metrics.increment("local_occurrences.hits" if covering else "local_occurrences.misses")
+        return min(covering, key=lambda store: store.record_count, default=None)
+
+
+stores = LocalOccurrenceStores()
+
+
+def build_where(rq: dict) -> (str, list):
+    """
+    :return: An SQL condition matching the records that match rq, and its parameters
+    :raises UnsupportedQuery: If rq uses a field or filter that the local store can't answer
+    """
+    conditions, params = ["1"], []
+    for field, value in rq.items():
+        if field == "geopoint":
+            condition, condition_params = _geopoint_condition(value)
+        elif field in FIELDS:
+            condition, condition_params = _field_condition(field, value)
+        else:
+            raise UnsupportedQuery(f"Unknown field {field}")
+        conditions.append(condition)
+        params += condition_params
+    return " AND ".join(conditions), params
+
+
+def _field_condition(field: str, value) -> (str, list):
+    column = _quote(field)
+    if isinstance(value, dict):
+        match value.get("type"):
+            case "exists":
+                return f"{column} IS NOT NULL", []
+            case "missing":
+                return f"{column} IS NULL", []
+            case "range":
+                bounds = [(op, _to_column_value(field, value[key])) for key, op in (("gte", ">="), ("lte", "<="))
+                          if key in value]
+                if len(bounds) == 0:
+                    raise UnsupportedQuery(f"Empty range for {field}")
+                # iDigBio also accepts bounds like partial dates, which aren't stored in a comparable form
+                if any(bound is None for _, bound in bounds):
+                    raise UnsupportedQuery(f"Unsupported range for {field}: {value}")
+                return " AND ".join(f"{column} {op} ?" for op, _ in bounds), [bound for _, bound in bounds]
+        raise UnsupportedQuery(f"Unsupported filter for {field}: {value}")
+    elif isinstance(value, list):
+        values = [_to_column_value(field, v) for v in value]
+        if any(v is None for v in values):
+            raise UnsupportedQuery(f"Unsupported values for {field}: {value}")
+        return f"{column} IN ({', '.join('?' * len(values))})", values
+    else:
+        column_value = _to_column_value(field, value)
+        # "col = NULL" matches nothing, so leave values that can't be compared to the API
+        if column_value is None:
+            raise UnsupportedQuery(f"Unsupported value for {field}: {value}")
+        return f"{column} = ?", [column_value]
+
+
+def _geopoint_condition(value: dict) -> (str, list):
+    match value.get("type"):
+        case "exists":
+            return "lat IS NOT NULL", []
+        case "missing":
+            return "lat IS NULL", []
+        case "geo_bounding_box":
+            top_left, bottom_right = value["top_left"], value["bottom_right"]
+            return "lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?", [bottom_right["lat"], top_left["lat"],
+                                                                  top_left["lon"], bottom_right["lon"]]
+        case "geo_distance":
+            distance = _parse_distance_km(value["distance"])
+            return "distance_km(lat, lon, ?, ?) <= ?", [value["lat"], value["lon"], distance]
+    raise UnsupportedQuery(f"Unsupported geopoint filter: {value}")
+
+
+def _parse_distance_km(distance) -> float:
+    match = re.fullmatch(r"\s*([\d.]+)\s*(km|m|mi)?\s*", str(distance))
+    if match is None:
+        raise UnsupportedQuery(f"Unsupported distance: {distance}")
+    number, unit = float(match.group(1)), match.group(2) or "m"
+    return number * {"km": 1, "m": 0.001, "mi": 1.609344}[unit]
+
+
+def _distance_km(lat1, lon1, lat2, lon2) -> Optional[float]:
+    if lat1 is None or lon1 is None:
+        return None
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 6371.0088 * 2 * math.asin(math.sqrt(a))
+
+
+def _to_column_value(field: str, value):
+    """
+    Normalizes values like iDigBio's search index does, so that they can be compared with stored ones: text is
+    lowercased and dates are reduced to YYYY-MM-DD.
+    """
+    if value is None or value == "":
+        return None
+    if field in BOOLEAN_FIELDS:
+        return int(value in (True, 1, "true", "True", "1"))
+    if field in NUMERIC_FIELDS:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    if field in DATE_FIELDS:
+        match = _DATE.match(str(value))
+        return match.group(0) if match else None
+    return str(value).lower()
+
+
+def _normalize(value):
+    """
+    :return: The value with all text lowercased, since iDigBio searches ignore case
+    """
+    if isinstance(value, str):
+        return value.lower()
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    return value
+
+
+def _row_to_record(row: sqlite3.Row) -> dict:
+    record = {key: row[key] for key in row.keys() if row[key] is not None and key not in ("lat", "lon")}
+    if row["lat"] is not None:
+        record["geopoint"] = {"lat": row["lat"], "lon": row["lon"]}
+    if "hasImage" in record:
+        record["hasImage"] = bool(record["hasImage"])
+    return record
+
+
+def _quote(field: str) -> str:
+    return f'"{field}"'
+
+
+def read_core_layout(archive: zipfile.ZipFile) -> (str, dict):
+    """
+    :return: The name of the archive's core data file, occurrence.txt by default, and how to read it: the csv reader
+    arguments, the number of header lines and the term of each column, if the archive describes them in meta.xml
+    """
+    if "meta.xml" not in archive.namelist():
+        return "occurrence.txt", {"delimiter": None, "quotechar": '"', "header_lines": 1, "terms": None}
+
+    core = ElementTree.fromstring(archive.read("meta.xml")).find(f"{_DWC_TEXT_NAMESPACE}core")
+    terms = {int(f.get("index")): f.get("term") for f in core.iter(f"{_DWC_TEXT_NAMESPACE}field")
+             if f.get("index") is not None}
+    id_element = core.find(f"{_DWC_TEXT_NAMESPACE}id")
+    if id_element is not None:
+        terms.setdefault(int(id_element.get("index")), "id")
+
+    delimiter = core.get("fieldsTerminatedBy", ",").encode().decode("unicode_escape")
+    return core.find(f"{_DWC_TEXT_NAMESPACE}files/{_DWC_TEXT_NAMESPACE}location").text.strip(), {
+        "delimiter": delimiter,
+        "quotechar": core.get("fieldsEnclosedBy", '"') or None,
+        "header_lines": int(core.get("ignoreHeaderLines", "0")),
+        "terms": terms,
+    }
+
+
+def iter_archive_records(archive_path: str) -> Iterator[dict]:
+    """
+    Streams the core records out of a DarwinCore Archive without extracting it.
+
+    :return: Records as dicts of field values, normalized for storage
+    """
+    # Some fields, like dynamicProperties, can be longer than the csv module allows by default
+    csv.field_size_limit(2 ** 31 - 1)
+
+    with zipfile.ZipFile(archive_path) as archive:
+        member, layout = read_core_layout(archive)
+        with archive.open(member) as raw:
+            text = io.TextIOWrapper(raw, encoding="utf-8", errors="replace", newline="")
+            header = None
+            if layout["header_lines"] > 0:
+                header_line = text.readline()
+                for _ in range(layout["header_lines"] - 1):
+                    text.readline()
+                if layout["delimiter"] is None:
+                    layout["delimiter"] = "\t" if "\t" in header_line else ","
+                header = next(csv.reader([header_line], delimiter=layout["delimiter"],
+                                         quotechar=layout["quotechar"]))
+
+            terms = layout["terms"] or dict(enumerate(header))
+            columns = _map_columns(terms)
+
+            reader = csv.reader(text, delimiter=layout["delimiter"], quotechar=layout["quotechar"],
+                                quoting=csv.QUOTE_MINIMAL if layout["quotechar"] else csv.QUOTE_NONE)
+            for row in reader:
+                yield _make_record(row, columns)
+
+
+def _map_columns(terms: dict[int, str]) -> dict[str, int]:
+    """
+    :return: The index of the archive column for each stored field that the archive has
+    """
+    indices = {}
+    for index, term in sorted(terms.items()):
+        name = re.split(r"[/:#]", term)[-1].lower()
+        indices.setdefault(name, index)
+
+    columns = {}
+    for field in FIELDS + ["geopoint", "decimallatitude", "decimallongitude"]:
+        for term in FIELD_TERMS.get(field, [field.lower()]):
+            if term in indices:
+                columns[field] = indices[term]
+                break
+    return columns
+
+
+def _make_record(row: list[str], columns: dict[str, int]) -> dict:
+    def get(field: str) -> Optional[str]:
+        index = columns.get(field)
+        return row[index] if index is not None and index < len(row) and row[index] != "" else None
+
+    record = {field: _to_column_value(field, get(field)) for field in FIELDS if field in columns}
+
+    lat, lon = None, None
+    if get("geopoint") is not None:
+        try:
+            geopoint = json.loads(get("geopoint"))
+            lat, lon = geopoint["lat"], geopoint["lon"]
+        except (ValueError, KeyError, TypeError):
+            pass
+    elif get("decimallatitude") is not None and get("decimallongitude") is not None:
+        try:
+            lat, lon = float(get("decimallatitude")), float(get("decimallongitude"))
+        except ValueError:
+            pass
+    if lat is not None and not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        lat, lon = None, None
+
+    record["lat"], record["lon"] = lat, lon
+    return record
+
+
+def ingest_dwca(archive_path: str, store_path: str, source_rq: dict = None, batch_size: int = 10000) -> int:
+    """
+    Builds a store from a DarwinCore Archive. The store is written next to store_path and moved into place once it is
+    complete, so a store being rebuilt can still be queried.
+
+    :param source_rq: The query the archive was downloaded with, which decides what queries the store can answer
+    :return: The number of records stored
+    """
+    temp_path = f"{store_path}.{os.getpid()}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    columns = FIELDS + ["lat", "lon"]
+    insert = (f"INSERT INTO records ({', '.join(map(_quote, columns))}) "
+              f"VALUES ({', '.join('?' * len(columns))})")
+
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        column_definitions = [f"{_quote(f)} {_column_type(f)}" for f in FIELDS] + ["lat REAL", "lon REAL"]
+        connection.execute(f"CREATE TABLE records ({', '.join(column_definitions)})")
+        connection.execute("CREATE TABLE store_info (key TEXT PRIMARY KEY, value TEXT)")
+
+        record_count = 0
+        batch = []
+        for record in iter_archive_records(archive_path):
+            batch.append([record.get(c) for c in columns])
+            if len(batch) >= batch_size:
+                connection.executemany(insert, batch)
+                record_count += len(batch)
+                batch = []
+        connection.executemany(insert, batch)
+        record_count += len(batch)
+
+        # Building indexes once all rows are in is much faster than updating them row by row
+        for field in INDEXED_FIELDS:
+            connection.execute(f"CREATE INDEX {_quote('records_' + field)} ON records ({_quote(field)})")
+        connection.execute("CREATE INDEX records_geopoint ON records (lat, lon)")
+
+        connection.executemany("INSERT INTO store_info VALUES (?, ?)", [
+            ("source_rq", json.dumps(source_rq or {})),
+            ("record_count", str(record_count)),
+            ("archive", os.path.basename(archive_path)),
+            ("ingested_at", str(time.time())),
+        ])
+        connection.commit()
+        connection.execute("ANALYZE")
+    finally:
+        connection.close()
+
+    os.replace(temp_path, store_path)
+    return record_count
+
+
+def _column_type(field: str) -> str:
+    if field in NUMERIC_FIELDS:
+        return "REAL"
+    if field in BOOLEAN_FIELDS:
+        return "INTEGER"
+    return "TEXT"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a local occurrence store from a DarwinCore Archive.")
+    parser.add_argument("archive", help="DarwinCore Archive zip file from the iDigBio download API")
+    parser.add_argument("-o", "--output", required=True, help="Path of the SQLite store to create")
+    parser.add_argument("--rq", default="{}", help="The iDigBio query the archive was downloaded with, as JSON")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    record_count = ingest_dwca(args.archive, args.output, json.loads(args.rq), args.batch_size)
+    print(f"Stored {record_count} records in {args.output} in {time.perf_counter() - start:.1f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+In-process counters and histograms for monitoring the chat pipeline. Values are kept per worker process and reset when
+it restarts.
+"""
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_histograms: dict[str, "Histogram"] = {}
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """
+    Counts observed values in buckets with fixed upper bounds, plus a catch-all bucket for anything larger.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        i = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def read_all(self) -> dict:
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip(bounds, self.bucket_counts))
+        }
+
+
+class TurnStats:
+    """
+    Counters scoped to a single chat turn, i.e. everything done to respond to one user message.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counts: dict[str, float] = {}
+
+    def increment(self, name: str, amount: float = 1):
+        with self.__lock:
+            self.__counts[name] = self.__counts.get(name, 0) + amount
+
+    def get(self, name: str) -> float:
+        return self.__counts.get(name, 0)
+
+    def read_all(self) -> dict[str, float]:
+        with self.__lock:
+            return dict(self.__counts)
+
+
+_current_turn: ContextVar[TurnStats | None] = ContextVar("current_turn", default=None)
+
+
+def increment(name: str, amount: float = 1):
+    """
+    Adds to a process-wide counter and, if a turn is being tracked in the current context, to that turn's counter.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+    turn = _current_turn.get()
+    if turn is not None:
+        turn.increment(name, amount)
+
+
+def observe(name: str, value: float, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+    """
+    Records a value, like a latency in seconds, in a process-wide histogram.
+    """
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(buckets)
+        _histograms[name].observe(value)
+
+
+def get(name: str) -> float:
+    return _counters.get(name, 0)
+
+
+def get_histogram(name: str) -> dict | None:
+    with _lock:
+        return _histograms[name].read_all() if name in _histograms else None
+
+
+def snapshot() -> dict[str, dict]:
+    with _lock:
+        return {
+            "counters": dict(sorted(_counters.items())),
+            "histograms": {k: v.read_all() for k, v in sorted(_histograms.items())}
+        }
+
+
+def current_turn() -> TurnStats | None:
+    return _current_turn.get()
+
+
+@contextmanager
+def track_turn() -> Iterator[TurnStats]:
+    """
+    Collects the counters incremented within the block into a TurnStats object.
+    """
+    previous = _current_turn.get()
+    stats = TurnStats()
+    _current_turn.set(stats)
+    try:
+        yield stats
+    finally:
+        # Restore rather than reset with a token: the block may span generator yields, which can be resumed from a
+        # different context
+        _current_turn.set(previous)
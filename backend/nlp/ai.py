@@ -1,22 +1,195 @@
+import inspect
+import time
+from functools import wraps
+
 import instructor
 import openai
 from dotenv import load_dotenv
+from flask import Flask
 from instructor import Instructor, AsyncInstructor
 from instructor.exceptions import InstructorRetryException
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from redis import Redis
 from tenacity import RetryCallState
 from tenacity.stop import stop_base
 
+import cancellation
+import metrics
+from nlp.intent_classifier import IntentClassifier, load_intent_classifier
+from nlp.llm_cache import LLMResponseCache, CachedClient, AsyncCachedClient
+
 load_dotenv()  # Load API key and patch the instructor client
 
 
 class AI:
     openai: OpenAI
-    client: Instructor | AsyncInstructor
+    client: Instructor | AsyncInstructor | CachedClient
+    async_openai: AsyncOpenAI
+    async_client: AsyncInstructor | AsyncCachedClient
+
+    # Picks tools locally when confident enough, see nlp.intent_classifier and the [AI] section of config.toml.template
+    tool_classifier: IntentClassifier | None = None
+    tool_classifier_threshold: float = 0.9
+    tool_choice_log: str | None = None
 
     def __init__(self):
         self.openai = openai.OpenAI()
+        # Instrument before patching so that calls made through both the raw and instructor clients are measured
+        self.openai.chat.completions.create = _instrument(self.openai.chat.completions.create)
+        self.client = instructor.from_openai(self.openai)
+
+        self.async_openai = openai.AsyncOpenAI()
+        self.async_openai.chat.completions.create = _instrument_async(self.async_openai.chat.completions.create)
+        self.async_client = instructor.from_openai(self.async_openai)
+
+    def init_app(self, app: Flask, redis: Redis):
         self.client = instructor.from_openai(self.openai)
+        self.async_client = instructor.from_openai(self.async_openai)
+
+        config = app.config.get("AI", {})
+
+        ttl = config.get("CACHE_TTL", 0)
+        if ttl > 0:
+            cache = LLMResponseCache(redis, ttl)
+            self.client = CachedClient(self.client, cache)
+            self.async_client = AsyncCachedClient(self.async_client, cache)
+
+        self.tool_classifier = None
+        if config.get("TOOL_CLASSIFIER"):
+            try:
+                self.tool_classifier = load_intent_classifier(config["TOOL_CLASSIFIER"])
+            except OSError as e:
+                print(f"Tool classifier unavailable, picking all tools with the LLM: {e}")
+        self.tool_classifier_threshold = config.get("TOOL_CLASSIFIER_THRESHOLD", self.tool_classifier_threshold)
+        self.tool_choice_log = config.get("TOOL_CHOICE_LOG") or None
+
+
+def _instrument(create):
+    """
+    Counts calls to the chat completions API and records their latency and token usage, including prompt tokens that
+    were served from OpenAI's prompt cache. Calls are not made for turns that were cancelled, and response streams are
+    closed when their turn is.
+    """
+
+    @wraps(create)
+    def wrapper(*args, **kwargs):
+        cancellation.check_cancelled(skipped="llm.cancelled_calls")
+        metrics.increment("llm.calls")
+        start = time.perf_counter()
+
+        if kwargs.get("stream"):
+            kwargs.setdefault("stream_options", {"include_usage": True})
+            return _instrument_stream(_close_on_cancel(create(*args, **kwargs)), start, cancellation.current_scope())
+
+        response = create(*args, **kwargs)
+        metrics.observe("llm.latency_seconds", time.perf_counter() - start)
+        _record_usage(getattr(response, "usage", None))
+        return response
+
+    return wrapper
+
+
+def _instrument_stream(stream, start: float, scope: cancellation.CancelScope | None):
+    first_chunk = True
+    finished = False
+    try:
+        for chunk in stream:
+            if first_chunk:
+                metrics.observe("llm.time_to_first_token_seconds", time.perf_counter() - start)
+                first_chunk = False
+
+            if chunk.usage is not None:
+                _record_usage(chunk.usage)
+
+            # Usage is reported in an extra chunk without any choices, which callers don't expect
+            if chunk.choices:
+                yield chunk
+        finished = True
+    finally:
+        _close_stream(stream, finished, scope)
+
+
+def _instrument_async(create):
+    """
+    Like _instrument, but for the AsyncOpenAI client.
+    """
+
+    @wraps(create)
+    async def wrapper(*args, **kwargs):
+        cancellation.check_cancelled(skipped="llm.cancelled_calls")
+        metrics.increment("llm.calls")
+        start = time.perf_counter()
+
+        if kwargs.get("stream"):
+            kwargs.setdefault("stream_options", {"include_usage": True})
+            return _instrument_async_stream(_close_on_cancel(await create(*args, **kwargs)), start,
+                                            cancellation.current_scope())
+
+        response = await create(*args, **kwargs)
+        metrics.observe("llm.latency_seconds", time.perf_counter() - start)
+        _record_usage(getattr(response, "usage", None))
+        return response
+
+    return wrapper
+
+
+async def _instrument_async_stream(stream, start: float, scope: cancellation.CancelScope | None):
+    first_chunk = True
+    finished = False
+    try:
+        async for chunk in stream:
+            if first_chunk:
+                metrics.observe("llm.time_to_first_token_seconds", time.perf_counter() - start)
+                first_chunk = False
+
+            if chunk.usage is not None:
+                _record_usage(chunk.usage)
+
+            if chunk.choices:
+                yield chunk
+        finished = True
+    finally:
+        closed = _close_stream(stream, finished, scope)
+        if inspect.isawaitable(closed):
+            await closed
+
+
+def _close_on_cancel(stream):
+    """
+    Registers a response stream with the current turn, so that it is closed if the turn is cancelled, even if it was
+    never read.
+    """
+    scope = cancellation.current_scope()
+    if scope is not None:
+        scope.add(stream)
+    return stream
+
+
+def _close_stream(stream, finished: bool, scope: cancellation.CancelScope | None):
+    """
+    Closes a response stream, which stops the LLM from generating the rest of a response that was cancelled.
+
+    :return: The result of closing the stream, which needs to be awaited for AsyncOpenAI streams
+    """
+    if scope is not None:
+        scope.discard(stream)
+        if not finished and scope.cancelled:
+            metrics.increment("llm.cancelled_streams")
+
+    close = getattr(stream, "close", None)
+    return close() if close is not None else None
+
+
+def _record_usage(usage):
+    if usage is None:
+        return
+
+    metrics.increment("llm.prompt_tokens", usage.prompt_tokens)
+    metrics.increment("llm.completion_tokens", usage.completion_tokens)
+
+    details = usage.prompt_tokens_details
+    if details is not None and details.cached_tokens:
+        metrics.increment("llm.cached_prompt_tokens", details.cached_tokens)
 
 
 def _is_error_terminal(error: dict):
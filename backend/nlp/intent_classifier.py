@@ -0,0 +1,162 @@
+"""
+A small text classifier for picking tools without calling the LLM. Requests are represented by TF-IDF weighted word
+unigrams and bigrams and classified with multinomial logistic regression. Trained models are stored as compressed NumPy
+archives of a few hundred kilobytes at most.
+
+To train a model from labeled requests, like the seed examples in resources/tool_examples.jsonl and the tool choices
+logged by chat.api.create_plan, run from the backend directory:
+
+    python -m nlp.intent_classifier resources/tool_examples.jsonl tool_choices.jsonl -o resources/tool_classifier.npz
+"""
+import argparse
+import json
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def extract_features(text: str) -> Counter:
+    """
+    :return: Counts of lowercase word unigrams and bigrams
+    """
+    tokens = _TOKEN.findall(text.lower())
+    bigrams = [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    return Counter(tokens + bigrams)
+
+
+class IntentClassifier:
+    def __init__(self, vocabulary: list[str], idf: np.ndarray, weights: np.ndarray, bias: np.ndarray,
+                 labels: list[str]):
+        """
+        :param weights: A (features x labels) matrix
+        """
+        self.vocabulary = {feature: i for i, feature in enumerate(vocabulary)}
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.labels = labels
+
+    def vectorize(self, text: str) -> (np.ndarray, np.ndarray):
+        """
+        :return: The indices and values of the text's non-zero TF-IDF features, normalized to unit length
+        """
+        counts = [(self.vocabulary[f], c) for f, c in extract_features(text).items() if f in self.vocabulary]
+        if len(counts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        indices = np.array([i for i, _ in counts], dtype=np.int64)
+        values = np.array([1 + math.log(c) for _, c in counts], dtype=np.float32) * self.idf[indices]
+        return indices, values / np.linalg.norm(values)
+
+    def predict_proba(self, text: str) -> np.ndarray:
+        indices, values = self.vectorize(text)
+        logits = values @ self.weights[indices] + self.bias
+        return _softmax(logits)
+
+    def predict(self, text: str) -> (str, float):
+        """
+        :return: The most likely label and its probability
+        """
+        p = self.predict_proba(text)
+        best = int(np.argmax(p))
+        return self.labels[best], float(p[best])
+
+    def save(self, path: str):
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez_compressed(path, vocabulary=np.array(vocabulary), idf=self.idf, weights=self.weights,
+                            bias=self.bias, labels=np.array(self.labels))
+
+    @classmethod
+    def load(cls, path: str) -> "IntentClassifier":
+        with np.load(path, allow_pickle=False) as archive:
+            return cls(vocabulary=archive["vocabulary"].tolist(), idf=archive["idf"], weights=archive["weights"],
+                       bias=archive["bias"], labels=archive["labels"].tolist())
+
+    @classmethod
+    def train(cls, texts: list[str], labels: list[str], max_features: int = 20000, l2: float = 1e-4,
+              epochs: int = 1000, learning_rate: float = 5.0) -> "IntentClassifier":
+        """
+        Fits the model with full-batch gradient descent, which is plenty fast for a few thousand examples.
+        """
+        features = [extract_features(t) for t in texts]
+
+        document_frequency = Counter(f for counts in features for f in counts)
+        vocabulary = [f for f, _ in document_frequency.most_common(max_features)]
+        n = len(texts)
+        idf = np.array([math.log((1 + n) / (1 + document_frequency[f])) + 1 for f in vocabulary], dtype=np.float32)
+
+        label_names = sorted(set(labels))
+        model = cls(vocabulary, idf, np.zeros((len(vocabulary), len(label_names)), dtype=np.float32),
+                    np.zeros(len(label_names), dtype=np.float32), label_names)
+
+        x = np.zeros((n, len(vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            indices, values = model.vectorize(text)
+            x[row, indices] = values
+
+        y = np.zeros((n, len(label_names)), dtype=np.float32)
+        y[np.arange(n), [label_names.index(label) for label in labels]] = 1
+
+        for _ in range(epochs):
+            p = _softmax(x @ model.weights + model.bias)
+            error = (p - y) / n
+            model.weights -= learning_rate * (x.T @ error + l2 * model.weights)
+            model.bias -= learning_rate * error.sum(axis=0)
+
+        return model
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    e = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+@lru_cache(maxsize=4)
+def load_intent_classifier(path: str) -> IntentClassifier:
+    """
+    Loads each model file only once, no matter how many times the app is set up.
+    """
+    return IntentClassifier.load(path)
+
+
+def read_examples(*paths: str) -> (list[str], list[str]):
+    """
+    :param paths: JSON Lines files with one {"request": str, "tool_name": str} object per line
+    :return: Requests and their labels
+    """
+    texts, labels = [], []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    example = json.loads(line)
+                    texts.append(example["request"])
+                    labels.append(example["tool_name"])
+    return texts, labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a tool classifier from labeled requests.")
+    parser.add_argument("examples", nargs="+", help="JSON Lines files of {\"request\", \"tool_name\"} objects")
+    parser.add_argument("-o", "--output", default="resources/tool_classifier.npz")
+    parser.add_argument("--max-features", type=int, default=20000)
+    parser.add_argument("--l2", type=float, default=1e-4)
+    parser.add_argument("--epochs", type=int, default=1000)
+    args = parser.parse_args()
+
+    texts, labels = read_examples(*args.examples)
+    model = IntentClassifier.train(texts, labels, max_features=args.max_features, l2=args.l2, epochs=args.epochs)
+    model.save(args.output)
+
+    accuracy = sum(model.predict(t)[0] == label for t, label in zip(texts, labels)) / len(texts)
+    print(f"Trained on {len(texts)} examples of {len(model.labels)} tools with {len(model.vocabulary)} features. "
+          f"Training accuracy: {accuracy:.1%}. Saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
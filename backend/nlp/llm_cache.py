@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import json
+from typing import Any, Optional, Type
+
+from instructor import Instructor, AsyncInstructor
+from openai.types.chat import ChatCompletion
+from pydantic import BaseModel, ValidationError
+from redis import Redis, RedisError
+
+import metrics
+
+KEY_PREFIX = "llm_cache:"
+
+# Request arguments that determine the LLM's response. Others, like max_retries, only affect how it is obtained.
+KEYED_ARGUMENTS = ["model", "messages", "temperature", "max_tokens", "functions", "function_call", "tools",
+                   "tool_choice"]
+
+
+class LLMResponseCache:
+    """
+    Stores validated LLM responses in Redis so that identical, deterministic requests can skip the LLM entirely.
+    """
+
+    def __init__(self, redis: Redis, ttl: int):
+        """
+        :param ttl: How long to keep responses around, in seconds
+        """
+        self.redis = redis
+        self.ttl = ttl
+
+    def make_key(self, response_model: Optional[Type[BaseModel]], kwargs: dict[str, Any]) -> Optional[str]:
+        """
+        :return: A key derived from everything that determines the LLM's response, or None if the response should not
+        be cached.
+        """
+        if kwargs.get("temperature") != 0 or kwargs.get("stream"):
+            return None
+
+        request = {k: kwargs[k] for k in KEYED_ARGUMENTS if k in kwargs}
+        request["response_model"] = None if response_model is None else response_model.model_json_schema()
+
+        canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+        return KEY_PREFIX + hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, response_model: Optional[Type[BaseModel]]) -> Optional[BaseModel]:
+        try:
+            raw = self.redis.get(key)
+        except RedisError as e:
+            print(f"LLM cache unavailable: {e}")
+            raw = None
+
+        if raw is None:
+            metrics.increment("llm_cache.misses")
+            return None
+
+        model = ChatCompletion if response_model is None else response_model
+        try:
+            response = model.model_validate_json(raw)
+        except (ValidationError, ValueError) as e:
+            # Responses cached before the response model changed, e.g. by an earlier deploy, may no longer be valid
+            print(f"Discarding invalid cached LLM response: {e}")
+            metrics.increment("llm_cache.misses")
+            metrics.increment("llm_cache.invalid")
+            self.__delete(key)
+            return None
+
+        metrics.increment("llm_cache.hits")
+        return response
+
+    def __delete(self, key: str):
+        try:
+            self.redis.delete(key)
+        except RedisError as e:
+            print(f"LLM cache unavailable: {e}")
+
+    def set(self, key: str, response: Any):
+        if not isinstance(response, BaseModel):
+            return
+
+        try:
+            self.redis.set(key, response.model_dump_json(by_alias=True), ex=self.ttl)
+        except RedisError as e:
+            print(f"LLM cache unavailable: {e}")
+
+
+class CachedClient:
+    """
+    Wraps an instructor client to serve repeated temperature-0 chat completions from an LLMResponseCache. Mirrors the
+    client's chat.completions.create interface.
+    """
+
+    def __init__(self, client: Instructor, cache: LLMResponseCache):
+        self.__client = client
+        self.__cache = cache
+
+    @property
+    def chat(self):
+        return self
+
+    @property
+    def completions(self):
+        return self
+
+    def create(self, response_model: Optional[Type[BaseModel]] = None, **kwargs):
+        key = self.__cache.make_key(response_model, kwargs)
+        if key is not None:
+            cached = self.__cache.get(key, response_model)
+            if cached is not None:
+                return cached
+
+        response = self.__client.chat.completions.create(response_model=response_model, **kwargs)
+
+        if key is not None:
+            self.__cache.set(key, response)
+
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.__client, name)
+
+
+class AsyncCachedClient:
+    """
+    Like CachedClient, but wraps an async instructor client. Redis is accessed from a worker thread so that cache
+    lookups don't block the event loop.
+    """
+
+    def __init__(self, client: AsyncInstructor, cache: LLMResponseCache):
+        self.__client = client
+        self.__cache = cache
+
+    @property
+    def chat(self):
+        return self
+
+    @property
+    def completions(self):
+        return self
+
+    async def create(self, response_model: Optional[Type[BaseModel]] = None, **kwargs):
+        key = self.__cache.make_key(response_model, kwargs)
+        if key is not None:
+            cached = await asyncio.to_thread(self.__cache.get, key, response_model)
+            if cached is not None:
+                return cached
+
+        response = await self.__client.chat.completions.create(response_model=response_model, **kwargs)
+
+        if key is not None:
+            await asyncio.to_thread(self.__cache.set, key, response)
+
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.__client, name)
@@ -0,0 +1,38 @@
+import math
+from functools import lru_cache
+
+import tiktoken
+
+# Approximate number of tokens OpenAI adds to format each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Used to estimate token counts when the tokenizer is unavailable
+CHARACTERS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception as e:
+        # tiktoken downloads encodings on first use, which fails without internet access
+        print(f"Tokenizer unavailable, estimating token counts instead: {e}")
+        return None
+
+
+@lru_cache(maxsize=256)
+def count_tokens(text: str) -> int:
+    """
+    Counts tokens locally, without calling the OpenAI API.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / CHARACTERS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list[dict]) -> int:
+    """
+    :param messages: Messages in OpenAI format
+    """
+    return sum(MESSAGE_OVERHEAD_TOKENS + count_tokens(str(m.get("content") or "")) for m in messages)
@@ -0,0 +1,397 @@
+"""
+Aggregates occurrence records into geohash grid cells, so that maps of large taxa can be drawn from a few thousand
+counts instead of millions of points, and serves the points themselves as vector tiles for zoomed-in maps.
+"""
+import json
+import os
+import threading
+from typing import Optional
+
+import httpx
+import numpy as np
+from attr import dataclass, asdict
+from redis import Redis, RedisError
+
+import idigbio_util
+import metrics
+import vector_tiles
+from idigbio_cache import make_query_key
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Geohash precision that gives cells a few pixels wide at each map zoom level. Deeper zoom levels use the last one.
+ZOOM_PRECISIONS = [2, 2, 2, 3, 3, 3, 4, 4, 4, 5]
+
+GRID_KEY_PREFIX = "map_grid:"
+
+# Pixels around tiles, at the tile extent, whose points are included so that markers on tile edges aren't clipped
+TILE_BUFFER = 64
+
+
+@dataclass
+class GeohashBucket:
+    geohash: str
+    count: int
+    lat: float  # Center of the cell
+    lon: float
+
+
+@dataclass
+class GeohashGrid:
+    precision: int
+    item_count: int  # The number of records with coordinates that were counted
+    buckets: list[GeohashBucket]
+    source: str  # "idigbio" if aggregated by the iDigBio API, "local" if aggregated from downloaded points
+    truncated: bool = False  # Whether only some of the matching records were counted
+
+
+def precision_for_zoom(zoom: int) -> int:
+    return ZOOM_PRECISIONS[max(0, min(zoom, len(ZOOM_PRECISIONS) - 1))]
+
+
+def encode_geohashes(lats: np.ndarray, lons: np.ndarray, precision: int) -> np.ndarray:
+    """
+    :return: Geohashes of the points as integers, 5 bits per character, most significant character first
+    """
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+
+    lon_cells = _to_cells(lons, -180, 180, lon_bits)
+    lat_cells = _to_cells(lats, -90, 90, lat_bits)
+
+    # Interleave the bits, starting with longitude
+    codes = np.zeros(len(lats), dtype=np.int64)
+    for i in range(bits):
+        if i % 2 == 0:
+            bit = (lon_cells >> (lon_bits - 1 - i // 2)) & 1
+        else:
+            bit = (lat_cells >> (lat_bits - 1 - i // 2)) & 1
+        codes = (codes << 1) | bit
+    return codes
+
+
+def decode_geohash_centers(codes: np.ndarray, precision: int) -> (np.ndarray, np.ndarray):
+    """
+    :return: The latitudes and longitudes of the centers of the cells
+    """
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+
+    lon_cells = np.zeros(len(codes), dtype=np.int64)
+    lat_cells = np.zeros(len(codes), dtype=np.int64)
+    for i in range(bits):
+        bit = (codes >> (bits - 1 - i)) & 1
+        if i % 2 == 0:
+            lon_cells = (lon_cells << 1) | bit
+        else:
+            lat_cells = (lat_cells << 1) | bit
+
+    lats = -90 + (lat_cells + 0.5) * (180 / 2 ** lat_bits)
+    lons = -180 + (lon_cells + 0.5) * (360 / 2 ** lon_bits)
+    return lats, lons
+
+
+def geohash_to_string(code: int, precision: int) -> str:
+    return "".join(GEOHASH_ALPHABET[(code >> (5 * (precision - 1 - i))) & 31] for i in range(precision))
+
+
+def geohash_from_string(geohash: str) -> int:
+    code = 0
+    for c in geohash:
+        code = (code << 5) | GEOHASH_ALPHABET.index(c)
+    return code
+
+
+def aggregate_points(lats: np.ndarray, lons: np.ndarray, precision: int) -> list[GeohashBucket]:
+    codes, counts = np.unique(encode_geohashes(lats, lons, precision), return_counts=True)
+    return _make_buckets(codes, counts, precision)
+
+
+def aggregate_geohash_counts(counts: dict[str, int], precision: int) -> list[GeohashBucket]:
+    """
+    Rolls counts for finer geohash cells up into the cells at the given precision that contain them.
+    """
+    prefixes = np.array([geohash_from_string(g[:precision]) for g in counts], dtype=np.int64)
+    totals = np.array(list(counts.values()), dtype=np.int64)
+    codes, inverse = np.unique(prefixes, return_inverse=True)
+    return _make_buckets(codes, np.bincount(inverse, weights=totals).astype(np.int64), precision)
+
+
+def _to_cells(values: np.ndarray, low: float, high: float, bits: int) -> np.ndarray:
+    cells = np.floor((values - low) / (high - low) * 2 ** bits).astype(np.int64)
+    return np.clip(cells, 0, 2 ** bits - 1)
+
+
+def _make_buckets(codes: np.ndarray, counts: np.ndarray, precision: int) -> list[GeohashBucket]:
+    lats, lons = decode_geohash_centers(codes, precision)
+    return [GeohashBucket(geohash=geohash_to_string(int(code), precision), count=int(count), lat=float(lat),
+                          lon=float(lon))
+            for code, count, lat, lon in zip(codes, counts, lats, lons)]
+
+
+def fetch_idigbio_geohash_grid(rq: dict, precision: int) -> Optional[GeohashGrid]:
+    """
+    Asks the iDigBio mapping API to aggregate the records. Its geohash map tiles cover the world at zoom level 0.
+
+    :return: The grid, or None if the API's cells are coarser than the requested precision or it failed to respond
+    """
+    code, success, map_definition = idigbio_util.query_idigbio_api("/v2/mapping/", {"rq": rq, "type": "geohash"})
+    if not success or "shortCode" not in map_definition:
+        return None
+
+    code, success, tile = idigbio_util.client.query("GET", f"/v2/mapping/{map_definition['shortCode']}/0/0/0.json")
+    if not success:
+        return None
+
+    counts = {}
+    for feature in tile.get("features", []):
+        properties = feature.get("properties", {})
+        geohash = properties.get("geohash")
+        count = properties.get("itemCount", properties.get("count"))
+        if isinstance(geohash, str) and isinstance(count, int):
+            counts[geohash] = count
+
+    if len(counts) == 0 or min(len(g) for g in counts) < precision:
+        return None
+
+    buckets = aggregate_geohash_counts(counts, precision)
+    return GeohashGrid(precision=precision, item_count=sum(b.count for b in buckets), buckets=buckets,
+                       source="idigbio")
+
+
+def aggregate_records_locally(rq: dict, precision: int,
+                              max_records: int = idigbio_util.SEARCH_WINDOW) -> GeohashGrid:
+    """
+    Downloads the coordinates of matching records, and only their coordinates, and aggregates them. The search API
+    only pages through the first SEARCH_WINDOW records, so grids of larger searches are truncated.
+
+    :raises IDigBioError: If the API fails to return a page of records
+    """
+    if "geopoint" not in rq:
+        # Keep any geopoint filter the map already has, e.g. a bounding box
+        rq = rq | {"geopoint": {"type": "exists"}}
+    params = {"rq": rq, "fields": ["geopoint"]}
+    lats, lons = [], []
+    item_count = 0
+
+    for page in idigbio_util.paginate_idigbio_search("/v2/search/records", params, page_size=5000,
+                                                     max_records=max_records):
+        item_count = page.item_count
+        for item in page.items:
+            geopoint = item.get("indexTerms", {}).get("geopoint")
+            if geopoint is not None:
+                lats.append(geopoint["lat"])
+                lons.append(geopoint["lon"])
+
+    buckets = aggregate_points(np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64), precision)
+    return GeohashGrid(precision=precision, item_count=len(lats), buckets=buckets, source="local",
+                       truncated=item_count > len(lats))
+
+
+class GeohashGridCache:
+    def __init__(self, redis: Redis, ttl: int):
+        self.redis = redis
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[GeohashGrid]:
+        try:
+            raw = self.redis.get(key)
+        except RedisError as e:
+            print(f"Map grid cache unavailable: {e}")
+            raw = None
+
+        if raw is None:
+            metrics.increment("maps.grid_cache.misses")
+            return None
+
+        metrics.increment("maps.grid_cache.hits")
+        grid = json.loads(raw)
+        grid["buckets"] = [GeohashBucket(**b) for b in grid["buckets"]]
+        return GeohashGrid(**grid)
+
+    def set(self, key: str, grid: GeohashGrid):
+        try:
+            self.redis.set(key, json.dumps(asdict(grid)), ex=self.ttl)
+        except RedisError as e:
+            print(f"Map grid cache unavailable: {e}")
+
+
+def get_geohash_grid(rq: dict, zoom: int, cache: GeohashGridCache = None,
+                     max_records: int = idigbio_util.SEARCH_WINDOW) -> GeohashGrid:
+    """
+    :return: Counts of the records matching rq in geohash cells sized for the zoom level. Grids are aggregated by the
+    iDigBio API when possible, and from downloaded coordinates otherwise.
+    :raises IDigBioError: If neither worked
+    """
+    rq = idigbio_util.sanitize_json(rq)
+    precision = precision_for_zoom(zoom)
+    key = GRID_KEY_PREFIX + make_query_key("geohash", {"rq": rq, "precision": precision})
+
+    grid = cache.get(key) if cache is not None else None
+    if grid is not None:
+        return grid
+
+    try:
+        grid = fetch_idigbio_geohash_grid(rq, precision)
+    except httpx.HTTPError as e:
+        print(f"iDigBio map aggregation unavailable: {e}")
+        grid = None
+
+    if grid is None:
+        grid = aggregate_records_locally(rq, precision, max_records)
+
+    metrics.increment(f"maps.grids.{grid.source}")
+    if cache is not None:
+        cache.set(key, grid)
+    return grid
+
+
+class TileDiskCache:
+    """
+    Stores vector tiles as files, evicting the least recently used ones once they take up more than max_bytes. Files
+    are touched when read, so their modification times order them by use, even across worker processes.
+    """
+
+    def __init__(self, directory: str = None, max_bytes: int = 0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.__size = None
+        self.__lock = threading.Lock()
+
+    def init_app(self, app):
+        config = app.config.get("IDIGBIO", {})
+        self.directory = config.get("TILE_CACHE_DIR") or None
+        self.max_bytes = int(config.get("TILE_CACHE_MAX_MB", 512) * 1024 * 1024)
+        self.__size = None
+
+    def get(self, key: str) -> Optional[bytes]:
+        if self.directory is None:
+            return None
+
+        path = self.__path(key)
+        try:
+            with open(path, "rb") as f:
+                tile = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            metrics.increment("maps.tile_cache.misses")
+            return None
+
+        metrics.increment("maps.tile_cache.hits")
+        return tile
+
+    def set(self, key: str, tile: bytes):
+        if self.directory is None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.__path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(tile)
+        os.replace(temp_path, path)
+
+        with self.__lock:
+            if self.__size is None:
+                self.__size = sum(size for _, _, size in self.__list_files())
+            else:
+                self.__size += len(tile)
+            if self.__size > self.max_bytes:
+                self.__evict()
+
+    def __evict(self):
+        """
+        Deletes the least recently used tiles until they take up at most 90% of max_bytes.
+        """
+        files = sorted(self.__list_files())
+        self.__size = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self.__size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.__size -= size
+                metrics.increment("maps.tile_cache.evictions")
+            except FileNotFoundError:
+                pass
+
+    def __list_files(self) -> list[tuple[float, str, int]]:
+        """
+        :return: The last use time, path and size of every cached tile
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".mvt"):
+                try:
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+                except FileNotFoundError:
+                    pass
+        return files
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mvt")
+
+
+def make_tile_query(rq: dict, z: int, x: int, y: int) -> dict:
+    """
+    :return: A query for the records in rq inside the tile and its buffer. Queries that already filter on geopoint
+    keep their filter, and points outside the tile are dropped after they are fetched instead.
+    """
+    if "geopoint" in rq and rq["geopoint"].get("type") != "exists":
+        return rq
+
+    west, south, east, north = _buffered_tile_bounds(z, x, y)
+    return rq | {"geopoint": {
+        "type": "geo_bounding_box",
+        "top_left": {"lat": north, "lon": west},
+        "bottom_right": {"lat": south, "lon": east}
+    }}
+
+
+def build_occurrence_tile(rq: dict, z: int, x: int, y: int, max_points: int = 5000) -> bytes:
+    """
+    :return: A vector tile with an "occurrences" layer of the records in rq inside the tile, each with its uuid and
+    scientific name
+    """
+    params = {"rq": make_tile_query(rq, z, x, y), "fields": ["uuid", "geopoint", "scientificname"]}
+    west, south, east, north = _buffered_tile_bounds(z, x, y)
+
+    points = []
+    for page in idigbio_util.paginate_idigbio_search("/v2/search/records", params, page_size=5000,
+                                                     max_records=max_points):
+        for item in page.items:
+            index_terms = item.get("indexTerms", {})
+            geopoint = index_terms.get("geopoint")
+            if geopoint is None or not (south <= geopoint["lat"] <= north and west <= geopoint["lon"] <= east):
+                continue
+
+            px, py = vector_tiles.to_tile_coordinates(geopoint["lon"], geopoint["lat"], z, x, y)
+            properties = {"uuid": item.get("uuid", index_terms.get("uuid", ""))}
+            if "scientificname" in index_terms:
+                properties["scientificname"] = index_terms["scientificname"]
+            points.append((px, py, properties))
+
+    return vector_tiles.encode_points("occurrences", points)
+
+
+def get_occurrence_tile(rq: dict, z: int, x: int, y: int, cache: TileDiskCache = None, max_points: int = 5000) -> bytes:
+    """
+    :return: A vector tile of the records matching rq, see build_occurrence_tile
+    """
+    rq = idigbio_util.sanitize_json(rq)
+    key = make_query_key("tile", {"rq": rq, "tile": [z, x, y]})
+
+    tile = cache.get(key) if cache is not None else None
+    if tile is None:
+        tile = build_occurrence_tile(rq, z, x, y, max_points)
+        if cache is not None:
+            cache.set(key, tile)
+    return tile
+
+
+def _buffered_tile_bounds(z: int, x: int, y: int) -> (float, float, float, float):
+    buffer = TILE_BUFFER / vector_tiles.EXTENT
+    west, south, _, _ = vector_tiles.tile_bounds(z, x - buffer, y + buffer)
+    _, _, east, north = vector_tiles.tile_bounds(z, x + buffer, y - buffer)
+    return max(west, -180), max(south, -90), min(east, 180), min(north, 90)
@@ -1,10 +1,16 @@
+import atexit
+from datetime import datetime, timezone
+
 import sqlalchemy as alchemy
+from flask import Flask
 from sqlalchemy import Engine, MetaData, Table, Column, String, ForeignKey, DateTime, \
-    func, JSON, desc, Boolean, select
+    func, JSON, desc, Boolean, select, Integer, Text, Index, Connection
 from sqlalchemy.orm import sessionmaker
 
-from chat.conversation import Conversation
+from chat.conversation import Conversation, ConversationSummary
 from chat.messages import ColdMessage
+from storage.migrations import Migration, migrate, create_index_online
+from storage.write_behind import WriteBehindQueue
 
 metadata = MetaData()
 
@@ -39,15 +45,138 @@ messages = Table(
     Column('created', DateTime, default=func.now()),
 )
 
+conversation_summaries = Table(
+    'conversation_summaries', metadata,
+    Column('conversation_id', String(36), ForeignKey('conversations.id'), primary_key=True),
+    Column('message_count', Integer, nullable=False),
+    Column('content', Text, nullable=False),
+    Column('updated', DateTime, default=func.now(), onupdate=func.now()),
+)
+
+# Messages are read per conversation in the order they were written, and conversations per user, newest first
+messages_by_conversation = Index('ix_messages_conversation_id_created', messages.c.conversation_id, messages.c.created)
+conversations_by_user = Index('ix_conversations_user_id_created', conversations.c.user_id,
+                              conversations.c.created.desc())
+
+
+def _create_tables(connection: Connection):
+    """
+    Creates the tables as they were before migrations were introduced, skipping those that databases created back then
+    already have. The tables are defined anew rather than taken from metadata, so that this migration keeps creating
+    the same schema when later migrations change the tables.
+    """
+    baseline = MetaData()
+    Table(
+        'users', baseline,
+        Column('id', String(36), primary_key=True),
+        Column('name', String, nullable=True),
+        Column('preferred_username', String, nullable=True),
+        Column('given_name', String, nullable=True),
+        Column('family_name', String, nullable=True),
+        Column('email', String, nullable=True),
+        Column('temp', Boolean, default=False),
+        Column('created', DateTime, default=func.now()),
+    )
+    Table(
+        'conversations', baseline,
+        Column('id', String(36), primary_key=True),
+        Column('user_id', String(36), ForeignKey('users.id'), nullable=False),
+        Column('created', DateTime, default=func.now()),
+        Column('title', String(36), nullable=False)
+    )
+    Table(
+        'messages', baseline,
+        Column('id', String(36), primary_key=True),
+        Column('conversation_id', String(36), ForeignKey('conversations.id'), nullable=False),
+        Column('type', String(32), primary_key=True),
+        Column('tool', String(32), primary_key=True),
+        Column('frontend_messages', JSON, nullable=False),
+        Column('openai_messages', JSON, nullable=False),
+        Column('created', DateTime, default=func.now()),
+    )
+    Table(
+        'conversation_summaries', baseline,
+        Column('conversation_id', String(36), ForeignKey('conversations.id'), primary_key=True),
+        Column('message_count', Integer, nullable=False),
+        Column('content', Text, nullable=False),
+        Column('updated', DateTime, default=func.now(), onupdate=func.now()),
+    )
+    baseline.create_all(connection)
+
+
+def _index_messages_and_conversations(connection: Connection):
+    """
+    Indexes the columns that conversations are read by. Like in _create_tables, the indexes are defined anew rather
+    than taken from the tables above, and only name the columns they cover.
+    """
+    indexed = MetaData()
+    messages_v2 = Table(
+        'messages', indexed,
+        Column('conversation_id', String(36)),
+        Column('created', DateTime),
+    )
+    conversations_v2 = Table(
+        'conversations', indexed,
+        Column('user_id', String(36)),
+        Column('created', DateTime),
+    )
+    create_index_online(connection, Index('ix_messages_conversation_id_created',
+                                          messages_v2.c.conversation_id, messages_v2.c.created))
+    create_index_online(connection, Index('ix_conversations_user_id_created',
+                                          conversations_v2.c.user_id, conversations_v2.c.created.desc()))
+
+
+# New migrations go at the end, with the next version. Never change migrations that were already released. Changes to
+# the tables above need a migration that makes them.
+MIGRATIONS = [
+    Migration(1, "Create tables", _create_tables),
+    Migration(2, "Index messages by conversation and conversations by user", _index_messages_and_conversations,
+              transactional=False),
+]
+
 
 class DatabaseEngine:
     engine: Engine
 
+    # Writes messages in batches from a background thread, see the [DATABASE] section of config.toml.template. If
+    # None, each message is written in its own transaction as soon as it is recorded.
+    message_queue: WriteBehindQueue | None = None
+
+    # Rendering settings for the conversations read from the database, see the [CHAT] section of config.toml.template
+    conversation_settings: dict = {}
+
     def __init__(self, engine: Engine) -> None:
         self.engine = engine
         self.sessions = sessionmaker(engine)
 
-        metadata.create_all(self.engine)
+        migrate(self.engine, MIGRATIONS)
+
+    def init_app(self, app: Flask):
+        config = app.config.get("DATABASE", {})
+        chat_config = app.config.get("CHAT", {})
+        self.conversation_settings = {
+            "prefix_stable_prompts": chat_config.get("PREFIX_STABLE_PROMPTS", False),
+            "max_verbatim_turns": chat_config.get("HISTORY_TURNS"),
+            "history_token_budget": chat_config.get("HISTORY_TOKEN_BUDGET")
+        }
+
+        self.close()
+        if config.get("WRITE_BEHIND", False):
+            self.message_queue = WriteBehindQueue(self.write_messages_to_storage,
+                                                  max_batch_size=config.get("WRITE_BATCH_SIZE", 100),
+                                                  interval=config.get("WRITE_INTERVAL", 0.05),
+                                                  max_pending=config.get("WRITE_QUEUE_SIZE", 1000))
+            # Write messages that are still queued when the worker process exits
+            atexit.register(self.close)
+
+    def close(self):
+        """
+        Writes any queued messages and stops writing messages in the background.
+        """
+        if self.message_queue is not None:
+            self.message_queue.close()
+            atexit.unregister(self.close)
+            self.message_queue = None
 
     def user_exists(self, user_id: str):
         with self.sessions.begin() as session:
@@ -87,23 +216,78 @@ class DatabaseEngine:
             return self.user_exists(data['id'])
 
     def write_message_to_storage(self, cold_message: ColdMessage, conversation_id: str):
+        """
+        Writes a message, or queues it to be written if messages are written behind. See flush_messages.
+        """
         new_message = {
             "id": cold_message.read("message_id"),
             "conversation_id": conversation_id,
             "type": cold_message.read("type"),
             "tool": cold_message.read("tool_name"),
             "frontend_messages": cold_message.read("frontend_messages"),
-            "openai_messages": cold_message.read("openai_messages")
+            "openai_messages": cold_message.read("openai_messages"),
+            # Set here rather than by the database so that messages written together still sort in the order they
+            # were recorded in. Timezone-aware, so that the database stores it in the same timezone as func.now().
+            "created": datetime.now(timezone.utc)
         }
 
+        if self.message_queue is not None:
+            self.message_queue.put(new_message, key=conversation_id)
+        else:
+            self.write_messages_to_storage([new_message])
+
+    def write_messages_to_storage(self, new_messages: list[dict]):
+        """
+        Writes rows of the messages table in a single INSERT.
+        """
         with self.sessions.begin() as session:
-            session.execute(messages.insert().values(new_message))
+            session.execute(messages.insert().values(new_messages))
+
+    def flush_messages(self, conversation_id: str = None):
+        """
+        Waits until the recorded messages of a conversation, or of all conversations, have been written.
+
+        :param conversation_id: Only wait for this conversation's messages, and raise the first error from writing
+        them, if any failed
+        """
+        if self.message_queue is not None:
+            self.message_queue.flush(key=conversation_id)
+
+    def wait_for_messages(self, conversation_id: str):
+        """
+        Waits until the recorded messages of a conversation have been written, without waiting on other conversations
+        or reporting errors, which are left to flush_messages.
+        """
+        if self.message_queue is not None:
+            self.message_queue.wait(key=conversation_id)
+
+    def write_summary_to_storage(self, summary: ConversationSummary, conversation_id: str):
+        with self.sessions.begin() as session:
+            session.execute(conversation_summaries.delete()
+                            .where(conversation_summaries.c.conversation_id == conversation_id))
+            session.execute(conversation_summaries.insert().values({
+                "conversation_id": conversation_id,
+                "message_count": summary.message_count,
+                "content": summary.content
+            }))
+
+    def get_conversation_summary(self, conversation_id: str) -> ConversationSummary | None:
+        with self.sessions.begin() as session:
+            query = (select(conversation_summaries.c.message_count, conversation_summaries.c.content)
+                     .where(conversation_summaries.c.conversation_id == conversation_id))
+
+            row = session.execute(query).first()
+            return None if row is None else ConversationSummary(message_count=row[0], content=row[1])
 
     def get_conversation(self, conversation_id: str) -> Conversation:
+        self.wait_for_messages(conversation_id)
         cold_messages = []
+        summary = self.get_conversation_summary(conversation_id)
         with self.sessions.begin() as session:
+            # Summaries cover a number of messages from the start of the conversation, so order matters
             query = (messages.select()
-                     .where(messages.c.conversation_id == conversation_id))
+                     .where(messages.c.conversation_id == conversation_id)
+                     .order_by(messages.c.created))
 
             result = session.execute(query)
             conversation_messages = result.fetchall()
@@ -120,15 +304,21 @@ class DatabaseEngine:
             conversation = Conversation(
                 history=cold_messages,
                 recorder=self.write_message_to_storage,
-                conversation_id=conversation_id
+                conversation_id=conversation_id,
+                summary=summary,
+                summary_recorder=self.write_summary_to_storage,
+                flush_recorder=lambda: self.flush_messages(conversation_id),
+                **self.conversation_settings
             )
 
             return conversation
 
     def stream_conversation_for_frontend(self, conversation_id: str) -> list[dict[str, str]]:
+        self.wait_for_messages(str(conversation_id))
         with self.sessions.begin() as session:
             query = (select(messages.c.frontend_messages)
-                     .where(messages.c.conversation_id == str(conversation_id)))
+                     .where(messages.c.conversation_id == str(conversation_id))
+                     .order_by(messages.c.created))
 
             for message in session.execute(query).yield_per(10):
                 yield message[0]
@@ -0,0 +1,111 @@
+"""
+Versioned changes to the database schema. Pending migrations are applied in order when the app starts, and the
+version of each one is recorded in the schema_version table, so that every migration runs once per database.
+
+Migrations run while other worker processes may be serving requests: they should only make changes that existing code
+copes with, like adding tables or indexes, and build indexes with create_index_online.
+"""
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from attr import dataclass
+from sqlalchemy import Engine, Connection, MetaData, Table, Column, Integer, String, DateTime, Index, func, select, \
+    text
+from sqlalchemy.schema import CreateIndex
+
+# Arbitrary key of the Postgres advisory lock that keeps worker processes from migrating at the same time
+MIGRATION_LOCK_KEY = 8_245_130_771
+
+schema_metadata = MetaData()
+
+schema_version = Table(
+    'schema_version', schema_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied', DateTime, default=func.now()),
+)
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+    # Postgres can't build indexes without blocking writes inside a transaction, so migrations that do run with
+    # autocommit. They must be safe to run again if they fail halfway.
+    transactional: bool = True
+
+
+def migrate(engine: Engine, migrations: list[Migration]) -> list[int]:
+    """
+    Applies the migrations that haven't been applied to the database yet, in order of their versions.
+
+    :return: The versions that were applied
+    """
+    with _migration_lock(engine):
+        schema_metadata.create_all(engine)
+
+        applied = get_applied_versions(engine)
+        pending = sorted((m for m in migrations if m.version not in applied), key=lambda m: m.version)
+        for migration in pending:
+            _apply(engine, migration)
+        return [m.version for m in pending]
+
+
+def get_applied_versions(engine: Engine) -> set[int]:
+    with engine.connect() as connection:
+        return set(connection.execute(select(schema_version.c.version)).scalars())
+
+
+def create_index_online(connection: Connection, index: Index):
+    """
+    Builds an index unless it already exists. On Postgres, the index is built concurrently, which doesn't block
+    writes to the table, and an invalid index left behind by a failed concurrent build is rebuilt.
+    """
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect))
+
+    if connection.dialect.name == "postgresql":
+        invalid = connection.execute(text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+                                     {"name": index.name}).scalar()
+        if invalid:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+        ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+
+    connection.execute(text(ddl))
+
+
+def _apply(engine: Engine, migration: Migration):
+    print(f"MIGRATING to schema version {migration.version}: {migration.description}")
+    if migration.transactional:
+        with engine.begin() as connection:
+            migration.upgrade(connection)
+            _record(connection, migration)
+    else:
+        with engine.connect() as connection:
+            migration.upgrade(connection.execution_options(isolation_level="AUTOCOMMIT"))
+        with engine.begin() as connection:
+            _record(connection, migration)
+
+
+def _record(connection: Connection, migration: Migration):
+    connection.execute(schema_version.insert().values(version=migration.version,
+                                                      description=migration.description))
+
+
+@contextmanager
+def _migration_lock(engine: Engine) -> Iterator[None]:
+    """
+    Keeps worker processes that start at the same time from applying the same migrations. SQLite databases are only
+    used by a single process, so they aren't locked.
+    """
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+
+    # Hold the lock outside of any transaction, which concurrent index builds would otherwise wait on forever
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
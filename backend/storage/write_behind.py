@@ -0,0 +1,173 @@
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Hashable
+
+import metrics
+
+# Bucket upper bounds for histograms of rows per batch
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class WriteBehindQueue:
+    """
+    Writes rows to the database from a background thread, in batches of the rows put within a short time window, so
+    that callers don't wait on a database round trip for every row. Rows are written in the order they were put.
+
+    Callers that need their rows to be stored, e.g. at the end of a chat turn, call flush. When the database falls
+    behind, put blocks until there is room in the queue again.
+
+    Rows can be put with a key, like the ID of the conversation they belong to, so that flushing or waiting for that key
+    only waits for its own rows, and rows that fail to be written are only reported to the flush for that key, rather
+    than to whichever caller flushes next.
+    """
+
+    def __init__(self, write_batch: Callable[[list[dict]], None], max_batch_size: int = 100, interval: float = 0.05,
+                 max_pending: int = 1000):
+        """
+        :param write_batch: Writes rows in a single statement
+        :param interval: Seconds to wait for more rows before writing a batch, unless a flush is waiting
+        :param max_pending: Rows that may wait to be written before put blocks
+        """
+        self.__write_batch = write_batch
+        self.max_batch_size = max_batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+
+        self.__condition = threading.Condition()
+        self.__pending: deque[tuple[dict, Hashable]] = deque()
+        self.__put_count = 0
+        self.__done_count = 0
+        # Number of the last row put with each key that has yet to be written, counting from 1
+        self.__last_put: dict[Hashable, int] = {}
+        self.__flushing = 0
+        # Errors for the rows of each key that have yet to be reported by a flush, oldest keys first
+        self.__errors: dict[Hashable, list[Exception]] = {}
+        self.__closed = False
+
+        self.__thread = threading.Thread(target=self.__run, name="write-behind", daemon=True)
+        self.__thread.start()
+
+    def put(self, row: dict, key: Hashable = None):
+        """
+        :param key: Identifies the rows that a flush or wait for the key waits for, see flush
+        """
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError("Can't write to a closed queue")
+
+            if len(self.__pending) >= self.max_pending:
+                start = time.perf_counter()
+                self.__condition.wait_for(lambda: len(self.__pending) < self.max_pending)
+                metrics.observe("db.write_wait_seconds", time.perf_counter() - start)
+
+            self.__pending.append((row, key))
+            self.__put_count += 1
+            if key is not None:
+                self.__last_put[key] = self.__put_count
+            self.__condition.notify_all()
+
+    def flush(self, key: Hashable = None, timeout: float = None):
+        """
+        Waits until the rows put so far with key, or all rows put so far if key is None, have been written.
+
+        :param key: Report errors for the rows put with this key. Errors for other rows are only logged and counted.
+        :raises TimeoutError: If they weren't written within timeout seconds
+        :raises Exception: The first error raised while writing rows put with key since the last flush for key
+        """
+        with self.__condition:
+            self.__wait(key, timeout)
+            errors = self.__errors.pop(key, []) if key is not None else []
+
+        if errors:
+            raise errors[0]
+
+    def wait(self, key: Hashable = None, timeout: float = None):
+        """
+        Like flush, but leaves errors to be reported by the next flush for key, e.g. so that reading a conversation
+        sees its queued messages without taking their errors from the chat turn that recorded them.
+        """
+        with self.__condition:
+            self.__wait(key, timeout)
+
+    def __wait(self, key: Hashable, timeout: float):
+        # Rows are written in the order they were put, so a key's rows are written once its last row is
+        target = self.__put_count if key is None else self.__last_put.get(key, 0)
+        self.__flushing += 1
+        self.__condition.notify_all()
+        try:
+            if not self.__condition.wait_for(lambda: self.__done_count >= target, timeout):
+                raise TimeoutError(f"{target - self.__done_count} rows were not written within {timeout} seconds")
+        finally:
+            self.__flushing -= 1
+
+    def close(self, timeout: float = None):
+        """
+        Writes the remaining rows and stops the background thread.
+        """
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join(timeout)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__pending or self.__closed)
+                if not self.__pending:
+                    return
+
+                # Give rows put in quick succession, like the messages of a chat turn, a chance to join the batch
+                deadline = time.monotonic() + self.interval
+                while len(self.__pending) < self.max_batch_size and not (self.__flushing or self.__closed):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(remaining)
+
+                batch = [self.__pending.popleft() for _ in range(min(self.max_batch_size, len(self.__pending)))]
+                # Make room for callers waiting in put
+                self.__condition.notify_all()
+
+            errors = self.__write(batch)
+
+            with self.__condition:
+                self.__done_count += len(batch)
+                for _, key in batch:
+                    if self.__last_put.get(key, math.inf) <= self.__done_count:
+                        del self.__last_put[key]
+                for key, error in errors:
+                    if key is not None:
+                        self.__add_error(key, error)
+                self.__condition.notify_all()
+
+    def __add_error(self, key: Hashable, error: Exception):
+        self.__errors.setdefault(key, []).append(error)
+        # Forget the errors of the keys that were flushed longest ago, or never will be
+        while len(self.__errors) > self.max_pending:
+            del self.__errors[next(iter(self.__errors))]
+
+    def __write(self, batch: list[tuple[dict, Hashable]]) -> list[tuple[Hashable, Exception]]:
+        """
+        :return: The keys of the rows that couldn't be written and the errors raised while writing them. If the batch
+        can't be written as a whole, e.g. because one of its rows is invalid, its rows are written one at a time so
+        that only the invalid ones are lost.
+        """
+        metrics.increment("db.write_batches")
+        metrics.observe("db.write_batch_rows", len(batch), BATCH_SIZE_BUCKETS)
+        try:
+            self.__write_batch([row for row, _ in batch])
+            return []
+        except Exception as e:
+            if len(batch) == 1:
+                print(f"Failed to write row: {e}")
+                metrics.increment("db.write_errors")
+                return [(batch[0][1], e)]
+
+        errors = []
+        for row in batch:
+            errors += self.__write([row])
+        return errors
@@ -0,0 +1,97 @@
+"""
+Encodes point features as Mapbox Vector Tiles (https://github.com/mapbox/vector-tile-spec/tree/master/2.1). Only what
+occurrence maps need is supported: a single layer of points with string properties.
+"""
+import math
+from typing import Iterable
+
+EXTENT = 4096
+
+_POINT = 1
+_MOVE_TO = 1
+
+
+def tile_bounds(z: int, x: int, y: int) -> (float, float, float, float):
+    """
+    :return: The west, south, east and north edges of a Web Mercator tile in degrees
+    """
+    n = 2 ** z
+    return _tile_lon(x, n), _tile_lat(y + 1, n), _tile_lon(x + 1, n), _tile_lat(y, n)
+
+
+def to_tile_coordinates(lon: float, lat: float, z: int, x: int, y: int, extent: int = EXTENT) -> (int, int):
+    """
+    :return: The position of a point within a tile, where (0, 0) is the top left corner and (extent, extent) the bottom
+    right one
+    """
+    n = 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    tile_x = (lon + 180) / 360 * n
+    tile_y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n
+    return round((tile_x - x) * extent), round((tile_y - y) * extent)
+
+
+def encode_points(layer_name: str, points: Iterable[tuple[int, int, dict[str, str]]], extent: int = EXTENT) -> bytes:
+    """
+    :param points: Tile coordinates and properties of each point, see to_tile_coordinates
+    :return: A vector tile with a single layer of points
+    """
+    keys, values = {}, {}
+    features = []
+    for px, py, properties in points:
+        tags = []
+        for key, value in properties.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(str(value), len(values)))
+        geometry = [_command(_MOVE_TO, 1), _zigzag(px), _zigzag(py)]
+        features.append(_packed(2, tags) + _field_varint(3, _POINT) + _packed(4, geometry))
+
+    layer = b"".join([
+        _field_varint(15, 2),
+        _field_bytes(1, layer_name.encode("utf-8")),
+        *(_field_bytes(2, f) for f in features),
+        *(_field_bytes(3, k.encode("utf-8")) for k in keys),
+        *(_field_bytes(4, _field_bytes(1, v.encode("utf-8"))) for v in values),
+        _field_varint(5, extent),
+    ])
+    return _field_bytes(3, layer)
+
+
+def _tile_lon(x: int, n: int) -> float:
+    return x / n * 360 - 180
+
+
+def _tile_lat(y: int, n: int) -> float:
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+
+def _command(command_id: int, count: int) -> int:
+    return (command_id & 7) | (count << 3)
+
+
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 31)
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field_varint(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value)
+
+
+def _field_bytes(number: int, value: bytes) -> bytes:
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _packed(number: int, values: list[int]) -> bytes:
+    return _field_bytes(number, b"".join(_varint(v) for v in values))
@@ -0,0 +1,179 @@
+"""
+Compares how many chat responses can be streamed at once by the synchronous pipeline, served from a fixed pool of
+worker threads like under a WSGI server, and by the asynchronous pipeline, served from a single event loop like under
+the ASGI entry point (backend/asgi.py).
+
+The LLM is simulated with fixed latencies, so no API key or network access is needed. Every conversation sends a
+message that is routed to the "converse" tool, which takes one routing call and one streamed response.
+
+Usage, from the repository root:
+
+    python benchmarks/bench_concurrent_streams.py --conversations 50 100 200 --threads 32
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from openai.types.chat import ChatCompletionChunk  # noqa: E402
+
+import chat.api  # noqa: E402
+from chat.conversation import Conversation  # noqa: E402
+from chat.messages import stream_messages, astream_messages  # noqa: E402
+
+USER_MESSAGE = "Hello! What can you do?"
+RESPONSE_TOKENS = [f"token{i} " for i in range(20)]
+
+
+def _routing():
+    return chat.api.RequestRouting(requests=[chat.api.RoutedRequest(request=USER_MESSAGE, tool_name="converse")])
+
+
+def _chunk(token: str) -> ChatCompletionChunk:
+    return ChatCompletionChunk.model_validate({
+        "id": "bench", "object": "chat.completion.chunk", "created": 0, "model": "gpt-4o",
+        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+    })
+
+
+class SimulatedLLM:
+    def __init__(self, latency: float, token_delay: float):
+        """
+        :param latency: Seconds until a response, or the first token of a streamed response, is ready
+        :param token_delay: Seconds between streamed tokens
+        """
+        self.latency = latency
+        self.token_delay = token_delay
+
+    def create(self, **kwargs):
+        time.sleep(self.latency)
+        if kwargs.get("stream"):
+            return self.__stream()
+        return _routing()
+
+    def __stream(self):
+        for token in RESPONSE_TOKENS:
+            yield _chunk(token)
+            time.sleep(self.token_delay)
+
+
+class AsyncSimulatedLLM(SimulatedLLM):
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        if kwargs.get("stream"):
+            return self.__stream()
+        return _routing()
+
+    async def __stream(self):
+        for token in RESPONSE_TOKENS:
+            yield _chunk(token)
+            await asyncio.sleep(self.token_delay)
+
+
+def _make_ai(latency: float, token_delay: float):
+    completions = SimpleNamespace(chat=SimpleNamespace(completions=SimulatedLLM(latency, token_delay)))
+    async_completions = SimpleNamespace(chat=SimpleNamespace(completions=AsyncSimulatedLLM(latency, token_delay)))
+    return SimpleNamespace(client=completions, openai=completions, async_client=async_completions,
+                           async_openai=async_completions)
+
+
+class StreamTracker:
+    """
+    Records when each response streams its first token and how many responses are streaming at once.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__open = 0
+        self.peak_open = 0
+        self.first_token_times = []
+
+    def started(self, elapsed: float):
+        with self.__lock:
+            self.__open += 1
+            self.peak_open = max(self.peak_open, self.__open)
+            self.first_token_times.append(elapsed)
+
+    def finished(self):
+        with self.__lock:
+            self.__open -= 1
+
+
+def run_sync(ai, conversations: int, threads: int) -> (float, StreamTracker):
+    tracker = StreamTracker()
+    start = time.perf_counter()
+
+    def serve():
+        first = True
+        for fragment in stream_messages(chat.api.chat(ai, Conversation(), USER_MESSAGE)):
+            if first and fragment in RESPONSE_TOKENS:
+                tracker.started(time.perf_counter() - start)
+                first = False
+        tracker.finished()
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(serve) for _ in range(conversations)]:
+            future.result()
+
+    return time.perf_counter() - start, tracker
+
+
+def run_async(ai, conversations: int) -> (float, StreamTracker):
+    tracker = StreamTracker()
+
+    async def serve(start: float):
+        first = True
+        async for fragment in astream_messages(chat.api.achat(ai, Conversation(), USER_MESSAGE)):
+            if first and fragment in RESPONSE_TOKENS:
+                tracker.started(time.perf_counter() - start)
+                first = False
+        tracker.finished()
+
+    async def serve_all():
+        start = time.perf_counter()
+        await asyncio.gather(*[serve(start) for _ in range(conversations)])
+        return time.perf_counter() - start
+
+    return asyncio.run(serve_all()), tracker
+
+
+def _report(name: str, conversations: int, elapsed: float, tracker: StreamTracker):
+    ttft = sorted(tracker.first_token_times)
+    p95 = ttft[min(len(ttft) - 1, int(len(ttft) * 0.95))]
+    print(f"{name:>6} {conversations:>13} {elapsed:>9.2f} {conversations / elapsed:>12.1f} {tracker.peak_open:>11} "
+          f"{statistics.median(ttft):>9.2f} {p95:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, nargs="+", default=[50, 100, 200])
+    parser.add_argument("--threads", type=int, default=32, help="Worker threads serving the synchronous pipeline")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds until the LLM starts responding")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="Seconds between streamed tokens")
+    args = parser.parse_args()
+
+    ai = _make_ai(args.latency, args.token_delay)
+
+    print(f"{'path':>6} {'conversations':>13} {'seconds':>9} {'streams/s':>12} {'peak open':>11} "
+          f"{'ttft p50':>9} {'ttft p95':>9}")
+    for conversations in args.conversations:
+        # The pipeline logs every LLM call, which would drown out the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            sync_results = run_sync(ai, conversations, args.threads)
+            async_results = run_async(ai, conversations)
+        _report("wsgi", conversations, *sync_results)
+        _report("asgi", conversations, *async_results)
+
+
+if __name__ == "__main__":
+    main()
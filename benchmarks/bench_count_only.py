@@ -0,0 +1,69 @@
+"""
+Measures how much less data is downloaded and parsed when the number of matching records is fetched from the iDigBio
+summary count endpoints, as the search, map and media tools do, instead of from a page of search results.
+
+Queries are sent to the live iDigBio API, so network access is needed. Responses aren't cached.
+
+Usage, from the repository root:
+
+    python benchmarks/bench_count_only.py --repeats 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import httpx  # noqa: E402
+
+from idigbio_util import COUNT_ENDPOINTS, make_idigbio_api_url  # noqa: E402
+
+QUERIES = [
+    ("/v2/search/records", {"rq": {"genus": "Carex", "stateprovince": "Florida"}}),
+    ("/v2/search/records", {"rq": {"scientificname": "ursus arctos"}}),
+    ("/v2/search/records", {"rq": {"family": "asteraceae", "country": "united states"}, "limit": 100}),
+    ("/v2/search/media", {"rq": {"scientificname": "danaus plexippus"}}),
+]
+
+
+def measure(client: httpx.Client, method: str, url: str, params: dict | None, repeats: int) -> (int, float, float):
+    """
+    :return: Median bytes downloaded, seconds to respond and seconds to parse the response
+    """
+    downloaded, latencies, parse_times = [], [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        response = client.request(method, url, json=params)
+        latencies.append(time.perf_counter() - start)
+        downloaded.append(response.num_bytes_downloaded)
+
+        start = time.perf_counter()
+        response.json()
+        parse_times.append(time.perf_counter() - start)
+
+    return statistics.median(downloaded), statistics.median(latencies), statistics.median(parse_times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'query':<60} {'mode':>6} {'bytes':>10} {'latency ms':>11} {'parse ms':>9}")
+    with httpx.Client(timeout=60) as client:
+        for endpoint, params in QUERIES:
+            query = {k: v for k, v in params.items() if k in ("rq", "mq")}
+            name = f"{endpoint} {query}"[:60]
+
+            full = measure(client, "POST", make_idigbio_api_url(endpoint), params, args.repeats)
+            count = measure(client, "GET", make_idigbio_api_url(COUNT_ENDPOINTS[endpoint], query), None,
+                            args.repeats)
+
+            for mode, (downloaded, latency, parse_time) in [("search", full), ("count", count)]:
+                print(f"{name:<60} {mode:>6} {downloaded:>10.0f} {latency * 1000:>11.0f} {parse_time * 1000:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
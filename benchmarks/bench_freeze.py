@@ -0,0 +1,82 @@
+"""
+Measures how long freezing a message for storage (Message.freeze) takes for each message type, when the frontend
+representation is built directly from the message's values and when it is built by encoding the message as JSON and
+parsing it again, like freeze did before.
+
+Messages are made up locally, with streamed content already generated, as it is when a turn is stored. No network
+access is needed.
+
+Usage, from the repository root:
+
+    python benchmarks/bench_freeze.py --deltas 1000 --records 100
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from chat.content_streams import StreamedString  # noqa: E402
+from chat.messages import Message, ColdMessage, UserMessage, AiChatMessage, AiMapMessage, \
+    AiProcessingMessage  # noqa: E402
+
+
+def make_messages(deltas: int, records: int) -> dict[str, Message]:
+    answer = StreamedString(iter(["Here ", "are ", "the ", "records", ". "] * (deltas // 5)))
+    answer.gobble()
+    notes = StreamedString(iter(["Querying ", "the ", "iDigBio ", "API", "\n"] * (deltas // 5)))
+    notes.gobble()
+    results = {"itemCount": str(records), "items": [{
+        "uuid": f"00000000-0000-0000-0000-{i:012d}", "scientificname": "quercus alba",
+        "geopoint": {"lat": "29.7", "lon": "-82.4"},
+    } for i in range(records)]}
+
+    return {
+        "user_text_message": UserMessage("Show me records of Quercus alba in Florida"),
+        "ai_text_message": AiChatMessage(answer),
+        "ai_processing_message": AiProcessingMessage("Searching iDigBio...", notes),
+        "ai_processing_message (dict)": AiProcessingMessage("Searching iDigBio...", results),
+        "ai_map_message": AiMapMessage({"rq": {"scientificname": "quercus alba", "stateprovince": "florida"}}),
+    }
+
+
+def freeze_with_round_trip(message: Message) -> ColdMessage:
+    """
+    Message.freeze as it was, building the frontend representation by encoding and parsing JSON.
+    """
+    return ColdMessage(
+        message_id=message.message_id,
+        type=message.get_type().value,
+        tool_name=message.tool_name,
+        openai_messages=message.to_openai(),
+        frontend_messages=json.loads("".join(message.stream_to_frontend())),
+    )
+
+
+def time_per_call(f, message: Message, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        f(message)
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--deltas", type=int, default=1000, help="Deltas that streamed text was generated in")
+    parser.add_argument("--records", type=int, default=100, help="Search results in the dict processing message")
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'message type':>28} {'round trip µs':>14} {'direct µs':>10} {'speedup':>8}")
+    for name, message in make_messages(args.deltas, args.records).items():
+        assert freeze_with_round_trip(message).read_all() == message.freeze().read_all()
+
+        before = time_per_call(freeze_with_round_trip, message, args.repeats)
+        after = time_per_call(Message.freeze, message, args.repeats)
+        print(f"{name:>28} {before * 1e6:>14.1f} {after * 1e6:>10.1f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compares recording the messages of chat turns with one transaction per message, as DatabaseEngine did before
+messages were written behind, with batched writes from a background thread (backend/storage/write_behind.py). For
+each, reports the time that appending a turn's messages holds up the response, the time until they are stored, and
+the number of INSERT statements.
+
+Messages are written to a SQLite database file in a temporary directory, so no database server is needed. Round trips
+to a database server, like Postgres in production, make the difference larger.
+
+Usage, from the repository root:
+
+    python benchmarks/bench_message_writes.py --turns 200 --messages 5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from chat.messages import UserMessage, AiChatMessage  # noqa: E402
+from storage.database import DatabaseEngine  # noqa: E402
+
+USER_ID = "0fee2103-7467-47ee-a224-dc739a5eb619"
+CONVERSATION_ID = "03cb9be7-993a-4625-b546-2ab2f63fcfc3"
+
+
+def make_database(path: str, write_behind: bool) -> DatabaseEngine:
+    db = DatabaseEngine(sqlalchemy.create_engine(f"sqlite:///{path}"))
+    app = Flask(__name__)
+    app.config["DATABASE"] = {"WRITE_BEHIND": write_behind}
+    db.init_app(app)
+
+    db.insert_user({"id": USER_ID, "temp": False})
+    db.create_conversation_history(CONVERSATION_ID, USER_ID, "Benchmark")
+    return db
+
+
+def measure(db: DatabaseEngine, turns: int, messages: int) -> (float, float, int):
+    """
+    :return: Seconds spent appending and flushing per turn, and INSERT statements
+    """
+    inserts = []
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute",
+                            lambda conn, cursor, statement, *args: inserts.append(statement)
+                            if statement.startswith("INSERT INTO messages") else None)
+
+    conversation = db.get_conversation(CONVERSATION_ID)
+    appending, flushing = 0.0, 0.0
+    for _ in range(turns):
+        turn = [UserMessage("Show me records of Quercus alba in Florida")]
+        turn += [AiChatMessage("Here are the records. " * 20) for _ in range(messages - 1)]
+
+        start = time.perf_counter()
+        for message in turn:
+            conversation.append(message)
+        appended = time.perf_counter()
+        conversation.flush()
+        appending += appended - start
+        flushing += time.perf_counter() - appended
+
+    return appending / turns, flushing / turns, len(inserts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5, help="Messages recorded per turn")
+    args = parser.parse_args()
+
+    print(f"{'writes':>14} {'append ms/turn':>15} {'flush ms/turn':>14} {'INSERTs':>8}")
+    for name, write_behind in [("per message", False), ("write-behind", True)]:
+        with tempfile.TemporaryDirectory() as directory:
+            db = make_database(os.path.join(directory, "chat.db"), write_behind)
+            appending, flushing, inserts = measure(db, args.turns, args.messages)
+            db.close()
+        print(f"{name:>14} {appending * 1000:>15.2f} {flushing * 1000:>14.2f} {inserts:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Compares streaming chat responses to the frontend fragment by fragment, like stream_messages did before its output
+was coalesced, with coalescing into chunks of several sizes (backend/chat/utils/json.py). For each, reports the number
+of writes, which is the number of chunks Werkzeug writes to the socket, and the throughput of encoding a response and
+writing it to /dev/null with one os.write per chunk.
+
+Responses are made up locally of a user message, a processing message with a large dict of search results and an AI
+message streamed in small deltas, like LLM tokens. No network access is needed.
+
+Usage, from the repository root:
+
+    python benchmarks/bench_stream_encoder.py --chunk-sizes 1024 4096 16384
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import chat.messages  # noqa: E402
+from chat.content_streams import StreamedString  # noqa: E402
+from chat.messages import UserMessage, AiProcessingMessage, AiChatMessage, stream_messages  # noqa: E402
+from chat.utils import json as json_util  # noqa: E402
+
+
+def make_messages(records: int, deltas: int):
+    results = {"itemCount": records, "items": [{
+        "uuid": f"00000000-0000-0000-0000-{i:012d}", "scientificname": "quercus alba", "genus": "quercus",
+        "country": "united states", "stateprovince": "florida", "geopoint": {"lat": 29.7, "lon": -82.4},
+    } for i in range(records)]}
+
+    yield UserMessage("Show me records of Quercus alba in Florida")
+    yield AiProcessingMessage("Searching iDigBio...", {"params": {"rq": {"scientificname": "quercus alba"}},
+                                                       "results": results})
+    yield AiChatMessage(StreamedString(iter(["Here ", "are ", "the ", "records", "."] * (deltas // 5))))
+
+
+def unbuffered_stream_as_json(value, chunk_size=None):
+    """
+    The encoder before coalescing, which yielded every fragment on its own.
+    """
+    return (f for f in json_util._stream_as_json_unsafe(value) if f and f is not json_util._FLUSH)
+
+
+def measure(records: int, deltas: int, chunk_size: int, repeats: int) -> (int, int, float):
+    """
+    :return: Writes and characters per response, and seconds per response
+    """
+    fd = os.open(os.devnull, os.O_WRONLY)
+    writes, characters = 0, 0
+    start = time.perf_counter()
+    try:
+        for _ in range(repeats):
+            writes, characters = 0, 0
+            for chunk in stream_messages(make_messages(records, deltas), chunk_size):
+                os.write(fd, chunk.encode("utf-8"))
+                writes += 1
+                characters += len(chunk)
+    finally:
+        os.close(fd)
+    return writes, characters, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=100, help="Search results in the processing message")
+    parser.add_argument("--deltas", type=int, default=300, help="Deltas the AI message is streamed in")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[1024, 4096, 16384])
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'encoder':>16} {'writes':>8} {'chars/write':>12} {'ms/response':>12} {'MB/s':>8}")
+
+    coalescing_stream_as_json = json_util.stream_as_json
+    encoders = [("unbuffered", json_util.DEFAULT_CHUNK_SIZE, unbuffered_stream_as_json)]
+    encoders += [(f"chunks of {size}", size, coalescing_stream_as_json) for size in args.chunk_sizes]
+
+    for name, chunk_size, encoder in encoders:
+        chat.messages.stream_as_json = encoder
+        writes, characters, seconds = measure(args.records, args.deltas, chunk_size, args.repeats)
+        print(f"{name:>16} {writes:>8} {characters / writes:>12.1f} {seconds * 1000:>12.2f} "
+              f"{characters / seconds / 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
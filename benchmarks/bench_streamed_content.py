@@ -0,0 +1,96 @@
+"""
+Compares accumulating streamed LLM text by concatenating each delta onto the text so far, like StreamedString did
+before, with collecting deltas in a list that is joined when the text is read (backend/chat/content_streams.py).
+
+Streams of token-sized deltas are generated locally and fully consumed, and the text is read once at the end and
+halfway through, like a message that is shown while it is generated and stored once it is complete. No network access
+is needed.
+
+Usage, from the repository root:
+
+    python benchmarks/bench_streamed_content.py --tokens 1000 5000 20000 50000
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from chat.content_streams import StreamedString, StreamedDict  # noqa: E402
+
+
+class ConcatenatedString:
+    """
+    StreamedString as it was, reducing deltas with a + b.
+    """
+
+    def __init__(self, stream):
+        self.content = ""
+        self.stream = self.__cache_content(stream)
+
+    def __iter__(self):
+        return itertools.chain(iter([self.content]), self.stream)
+
+    def __cache_content(self, stream):
+        for delta in stream:
+            self.content = _add_strings(self.content, delta)
+            yield delta
+
+    def get(self) -> str:
+        for _ in self.stream:
+            pass
+        return self.content
+
+
+def _add_strings(a: str, b: str) -> str:
+    return a + b
+
+
+def make_deltas(tokens: int):
+    words = ["The ", "records ", "of ", "Quercus ", "alba ", "were ", "collected ", "in ", "Florida", ".\n"]
+    for i in range(tokens):
+        yield words[i % len(words)]
+
+
+def measure(make_content, tokens: int, repeats: int) -> float:
+    """
+    :return: Seconds to consume a stream of the given number of tokens and read its text
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        content = make_content(make_deltas(tokens))
+        for i, _ in enumerate(content):
+            if i == tokens // 2:
+                next(iter(content))  # The text so far
+        content.get()
+    return (time.perf_counter() - start) / repeats
+
+
+def measure_dict(tokens: int, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        deltas = itertools.chain([{"params": {"rq": {"genus": "quercus"}}}],
+                                 ({"answer": delta} for delta in make_deltas(tokens)))
+        StreamedDict(deltas).get()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1000, 5000, 20000, 50000])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'tokens':>8} {'concatenated ms':>16} {'list ms':>8} {'speedup':>8} {'dict ms':>8}")
+    for tokens in args.tokens:
+        before = measure(ConcatenatedString, tokens, args.repeats)
+        after = measure(StreamedString, tokens, args.repeats)
+        dict_time = measure_dict(tokens, args.repeats)
+        print(f"{tokens:>8} {before * 1000:>16.2f} {after * 1000:>8.2f} {before / after:>7.1f}x "
+              f"{dict_time * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compares the peak memory and time needed to go through the records in a large page of iDigBio search results when the
+whole response is parsed at once, like response.json() does, and when it is parsed as it arrives (backend/json_stream.py).
+
+Responses are generated locally, with records shaped like those returned by /v2/search/records, and are fed to the
+parser in chunks like those read from the network. No network access is needed.
+
+Usage, from the repository root:
+
+    python benchmarks/bench_streaming_json.py --records 1000 5000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from json_stream import iter_object  # noqa: E402
+
+CHUNK_SIZE = 64 * 1024
+
+
+def make_record(i: int) -> dict:
+    terms = {
+        "uuid": f"00000000-0000-0000-0000-{i:012d}", "scientificname": "quercus alba", "genus": "quercus",
+        "family": "fagaceae", "country": "united states", "stateprovince": "florida", "county": "alachua county",
+        "locality": "San Felasco Hammock Preserve State Park, 1.5 mi N of Millhopper Road" * 2,
+        "geopoint": {"lat": 29.7 + i * 1e-5, "lon": -82.4}, "datecollected": "1999-04-12T00:00:00+00:00",
+        "collector": "j. smith; a. jones", "catalognumber": f"FLAS-{i}", "institutioncode": "flas",
+        "basisofrecord": "preservedspecimen", "hasimage": i % 3 == 0, "recordset": "a1b2c3d4" * 4,
+    }
+    data = {f"dwc:{k}": str(v) for k, v in terms.items()}
+    data["dwc:occurrenceRemarks"] = "Growing in mesic hardwood forest on sandy loam, common. " * 4
+    return {"uuid": terms["uuid"], "type": "records", "etag": "0" * 40, "data": data, "indexTerms": terms}
+
+
+def make_response(records: int) -> bytes:
+    page = {"itemCount": records * 10, "lastModified": "2024-06-01T00:00:00", "items": [make_record(i) for i in
+                                                                                         range(records)],
+            "attribution": [{"uuid": "a1b2c3d4", "name": "Florida Museum of Natural History", "itemCount": records}]}
+    return json.dumps(page).encode("utf-8")
+
+
+def chunks(body: bytes):
+    for i in range(0, len(body), CHUNK_SIZE):
+        yield body[i:i + CHUNK_SIZE]
+
+
+def parse_all_at_once(body: bytes) -> int:
+    # Like httpx, which joins the chunks it reads into one body before parsing it
+    document = json.loads(b"".join(chunks(body)))
+    return sum(1 for _ in document["items"])
+
+
+def parse_as_it_arrives(body: bytes) -> int:
+    return sum(1 for key, _ in iter_object(chunks(body)) if key == "items")
+
+
+def measure(parse, body: bytes) -> (float, float):
+    """
+    :return: Peak memory allocated while parsing, in MB, and seconds taken
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    parse(body)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1e6, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, nargs="+", default=[1000, 5000])
+    args = parser.parse_args()
+
+    print(f"{'records':>8} {'body MB':>8} {'mode':>10} {'peak MB':>8} {'seconds':>8}")
+    for records in args.records:
+        body = make_response(records)
+        for name, parse in [("at once", parse_all_at_once), ("streaming", parse_as_it_arrives)]:
+            peak, elapsed = measure(parse, body)
+            print(f"{records:>8} {len(body) / 1e6:>8.1f} {name:>10} {peak:>8.1f} {elapsed:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
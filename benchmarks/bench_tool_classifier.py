@@ -0,0 +1,106 @@
+"""
+Reports how well the local tool classifier (backend/nlp/intent_classifier.py) stands in for the LLM when picking
+tools: cross-validated accuracy, how many requests it would handle on its own at a confidence threshold and how
+accurate it is on those, and how long a prediction takes.
+
+With --llm, the same requests are also sent to the LLM that picks tools in chat.api, which needs an OpenAI API key,
+and the accuracy and latency of both are compared.
+
+Usage, from the repository root:
+
+    python benchmarks/bench_tool_classifier.py backend/resources/tool_examples.jsonl --thresholds 0.6 0.7 0.8
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from nlp.intent_classifier import IntentClassifier, read_examples  # noqa: E402
+
+
+def cross_validate(texts: list[str], labels: list[str], folds: int, seed: int) -> list[tuple[str, str, float]]:
+    """
+    :return: The true label, predicted label and confidence of every example, each predicted by a model that was not
+    trained on it
+    """
+    order = list(range(len(texts)))
+    random.Random(seed).shuffle(order)
+
+    results = []
+    for fold in range(folds):
+        held_out = set(order[fold::folds])
+        model = IntentClassifier.train([t for i, t in enumerate(texts) if i not in held_out],
+                                       [label for i, label in enumerate(labels) if i not in held_out])
+        for i in held_out:
+            predicted, confidence = model.predict(texts[i])
+            results.append((labels[i], predicted, confidence))
+
+    return results
+
+
+def time_predictions(model: IntentClassifier, texts: list[str], repeats: int) -> float:
+    """
+    :return: Mean seconds per prediction
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for text in texts:
+            model.predict(text)
+    return (time.perf_counter() - start) / (repeats * len(texts))
+
+
+def compare_with_llm(texts: list[str], labels: list[str], model: IntentClassifier):
+    from chat.api import _pick_a_tool
+    from chat.conversation import Conversation
+    from nlp.ai import AI
+
+    ai = AI()
+    latencies, llm_correct, agreements = [], 0, 0
+    for text, label in zip(texts, labels):
+        start = time.perf_counter()
+        picked = _pick_a_tool(ai, Conversation(), text)
+        latencies.append(time.perf_counter() - start)
+        llm_correct += picked == label
+        agreements += picked == model.predict(text)[0]
+
+    print(f"LLM accuracy: {llm_correct / len(texts):.1%}, agreement with classifier: {agreements / len(texts):.1%}, "
+          f"latency p50 {statistics.median(latencies) * 1000:.0f} ms, "
+          f"max {max(latencies) * 1000:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("examples", nargs="+", help="JSON Lines files of {\"request\", \"tool_name\"} objects")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.6, 0.7, 0.8, 0.9])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=20, help="Times to predict every example when timing")
+    parser.add_argument("--llm", action="store_true", help="Also measure the LLM, which needs an OpenAI API key")
+    args = parser.parse_args()
+
+    texts, labels = read_examples(*args.examples)
+    results = cross_validate(texts, labels, args.folds, args.seed)
+
+    accuracy = sum(true == predicted for true, predicted, _ in results) / len(results)
+    print(f"{len(texts)} examples, {args.folds}-fold cross-validated accuracy: {accuracy:.1%}")
+
+    print(f"{'threshold':>9} {'coverage':>9} {'accuracy':>9}")
+    for threshold in args.thresholds:
+        confident = [(true, predicted) for true, predicted, confidence in results if confidence >= threshold]
+        coverage = len(confident) / len(results)
+        confident_accuracy = sum(t == p for t, p in confident) / len(confident) if confident else float("nan")
+        print(f"{threshold:>9.2f} {coverage:>9.1%} {confident_accuracy:>9.1%}")
+
+    model = IntentClassifier.train(texts, labels)
+    print(f"Classifier latency: {time_predictions(model, texts, args.repeats) * 1e6:.0f} µs per prediction")
+
+    if args.llm:
+        compare_with_llm(texts, labels, model)
+
+
+if __name__ == "__main__":
+    main()
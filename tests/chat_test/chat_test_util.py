@@ -4,6 +4,7 @@ from typing import Iterable, Optional
 import pytest
 import sqlalchemy
 from pydantic.v1.utils import deep_update
+from sqlalchemy.pool import StaticPool
 
 from app import create_app
 from chat.conversation import Conversation
@@ -24,7 +25,8 @@ def app(request):
     if "config_overrides" in request.param:
         test_config = deep_update(test_config, request.param["config_overrides"])
 
-    engine = sqlalchemy.create_engine("sqlite://")
+    # Streamed chat responses may touch the database from a worker thread, which must see the same in-memory database
+    engine = sqlalchemy.create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
     db = DatabaseEngine(engine)
 
     app = create_app(config_dict=test_config, database=db)
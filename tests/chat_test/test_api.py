@@ -1,5 +1,15 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import cancellation
 import chat.api
-from chat.messages import UserMessage, AiChatMessage
+import metrics
+from chat.content_streams import StreamedString
+from chat.conversation import Conversation
+from chat.messages import UserMessage, AiChatMessage, MessageType
 from chat_test.chat_test_util import make_convo
 from matchers import string_must_contain
 from nlp.ai import AI
@@ -78,3 +88,315 @@ def test_media_search():
     tool = chat.api.create_plan(AI(), conv, request)
 
     assert tool == "search_media_records"
+
+
+def test_route_message():
+    user_message = "How many records are there for polar bears in Florida? Show them on a map."
+    conv = make_convo(UserMessage(user_message))
+    routed = chat.api._route_message(AI(), conv, user_message)
+
+    assert [r.tool_name for r in routed] == ["count_species_occurrence_records", "show_map_of_species_occurrences"]
+    assert string_must_contain(routed[1].request, "polar bears", "Florida", "map")
+
+
+def test_route_off_topic_message():
+    user_message = "How's the weather?"
+    conv = make_convo(UserMessage(user_message))
+    routed = chat.api._route_message(AI(), conv, user_message)
+
+    assert [r.tool_name for r in routed] in ([], ["converse"])
+
+
+def test_fused_routing_makes_one_llm_call():
+    user_message = "Find media for genus Carex and show a map of genus Quercus"
+    conv = make_convo(UserMessage(user_message))
+
+    with metrics.track_turn() as turn:
+        requests = chat.api._plan_requests(AI(), conv, user_message, "fused")
+
+    assert len(requests) == 2
+    assert turn.get("llm.calls") == 1
+
+
+def test_handle_requests_concurrently_in_order(monkeypatch):
+    # Every request has to be running at the same time to get past the barrier
+    all_running = threading.Barrier(3, timeout=5)
+
+    def handle_slowly(ai, conversation, request, tool_name=None):
+        all_running.wait()
+        if request == "first":
+            time.sleep(0.1)
+        yield AiChatMessage(f"{request} one")
+        yield AiChatMessage(f"{request} two")
+
+    monkeypatch.setattr(chat.api, "_handle_individual_request", handle_slowly)
+    requests = [("first", None), ("second", None), ("third", None)]
+
+    messages = list(chat.api._handle_requests(None, Conversation(), requests, max_concurrent_requests=3))
+
+    assert [m.value for m in messages] == ["first one", "first two", "second one", "second two", "third one",
+                                           "third two"]
+
+
+def test_failed_request_stops_running_siblings(monkeypatch):
+    sibling_running = threading.Event()
+    sibling_stopped = threading.Event()
+
+    def handle(ai, conversation, request, tool_name=None):
+        if request == "first":
+            sibling_running.wait(5)
+            raise RuntimeError("The first request failed")
+
+        sibling_running.set()
+        try:
+            while True:
+                cancellation.check_cancelled()
+                time.sleep(0.01)
+                yield AiChatMessage("more")
+        except cancellation.Cancelled:
+            sibling_stopped.set()
+            raise
+
+    monkeypatch.setattr(chat.api, "_handle_individual_request", handle)
+    requests = [("first", None), ("second", None)]
+
+    with pytest.raises(RuntimeError):
+        list(chat.api._handle_requests(None, Conversation(), requests, max_concurrent_requests=2))
+
+    assert sibling_stopped.wait(5)
+
+
+def test_cancelling_the_turn_stops_background_requests(monkeypatch):
+    scope = cancellation.CancelScope()
+    sibling_stopped = threading.Event()
+
+    def handle(ai, conversation, request, tool_name=None):
+        if request == "first":
+            scope.cancel()
+            yield AiChatMessage("first")
+            return
+
+        try:
+            while True:
+                cancellation.check_cancelled()
+                time.sleep(0.01)
+                yield AiChatMessage("more")
+        except cancellation.Cancelled:
+            sibling_stopped.set()
+            raise
+
+    monkeypatch.setattr(chat.api, "_handle_individual_request", handle)
+    requests = [("first", None), ("second", None)]
+
+    with cancellation.activate(scope):
+        response = chat.api._handle_requests(None, Conversation(), requests, max_concurrent_requests=2)
+        assert next(response).value == "first"
+
+    assert sibling_stopped.wait(5)
+    response.close()
+
+
+def test_handle_requests_one_at_a_time(monkeypatch):
+    running = []
+
+    def handle(ai, conversation, request, tool_name=None):
+        running.append(request)
+        assert len(running) == 1
+        yield AiChatMessage(request)
+        running.remove(request)
+
+    monkeypatch.setattr(chat.api, "_handle_individual_request", handle)
+    requests = [("first", None), ("second", None)]
+
+    messages = list(chat.api._handle_requests(None, Conversation(), requests, max_concurrent_requests=1))
+
+    assert [m.value for m in messages] == ["first", "second"]
+
+
+def test_ahandle_requests_concurrently_in_order(monkeypatch):
+    all_running = None
+
+    async def handle_slowly(ai, conversation, request, tool_name=None):
+        await asyncio.wait_for(all_running.wait(), 5)
+        if request == "first":
+            await asyncio.sleep(0.1)
+        yield AiChatMessage(f"{request} one")
+        yield AiChatMessage(f"{request} two")
+
+    monkeypatch.setattr(chat.api, "_ahandle_individual_request", handle_slowly)
+    requests = [("first", None), ("second", None), ("third", None)]
+
+    async def handle_all():
+        nonlocal all_running
+        # Every request has to be running at the same time to get past the barrier
+        all_running = asyncio.Barrier(3)
+        return [m async for m in chat.api._ahandle_requests(None, Conversation(), requests, max_concurrent_requests=3)]
+
+    messages = asyncio.run(handle_all())
+
+    assert [m.value for m in messages] == ["first one", "first two", "second one", "second two", "third one",
+                                           "third two"]
+
+
+def test_closing_the_response_cancels_the_turn(monkeypatch):
+    closed = []
+    scopes = []
+
+    def make_response(ai, conversation, user_message, *args):
+        def tokens():
+            try:
+                yield "Hello"
+                yield " world"
+            finally:
+                closed.append(True)
+
+        scopes.append(cancellation.current_scope())
+        yield AiChatMessage("first")
+        yield AiChatMessage(StreamedString(tokens()))
+        yield AiChatMessage("never sent")
+
+    monkeypatch.setattr(chat.api, "_make_response", make_response)
+    conversation = Conversation()
+
+    response = chat.api.chat(None, conversation, "hi")
+    next(response)
+    partial = next(response)
+    fragments = iter(partial.value)
+    assert [next(fragments), next(fragments)] == ["", "Hello"]
+    response.close()
+
+    assert scopes[0].cancelled
+    assert closed == [True]
+    assert [m.read("type") for m in conversation.history] == [
+        "user_text_message", "ai_text_message", "ai_text_message", MessageType.cancelled.value]
+    assert conversation.history[2].read("frontend_messages")["value"] == "Hello"
+
+
+def test_cancelled_work_ends_the_turn_quietly(monkeypatch):
+    scope = cancellation.CancelScope()
+
+    def make_response(ai, conversation, user_message, *args):
+        yield AiChatMessage("first")
+        scope.cancel()
+        cancellation.check_cancelled()
+        yield AiChatMessage("never sent")
+
+    monkeypatch.setattr(chat.api, "_make_response", make_response)
+    conversation = Conversation()
+
+    messages = list(chat.api.chat(None, conversation, "hi", cancel_scope=scope))
+
+    assert [m.value for m in messages] == ["first"]
+    assert conversation.history[-1].read("type") == MessageType.cancelled.value
+
+
+def test_cancelling_the_task_cancels_the_async_turn(monkeypatch):
+    async def make_response(ai, conversation, user_message, *args):
+        yield AiChatMessage("first")
+        await asyncio.sleep(10)
+        yield AiChatMessage("never sent")
+
+    monkeypatch.setattr(chat.api, "_amake_response", make_response)
+    conversation = Conversation()
+
+    async def respond():
+        received = []
+
+        async def consume():
+            async for message in chat.api.achat(None, conversation, "hi"):
+                received.append(message)
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return received
+
+    received = asyncio.run(respond())
+
+    assert [m.value for m in received] == ["first"]
+    assert [m.read("type") for m in conversation.history] == [
+        "user_text_message", "ai_text_message", MessageType.cancelled.value]
+
+
+def test_cancelling_the_turn_stops_async_tools(monkeypatch):
+    steps = []
+    scope = cancellation.CancelScope()
+
+    class SlowTool:
+        async def acall(self, ai, request, conversation, state):
+            steps.append("first")
+            yield AiChatMessage("first")
+            steps.append("second")
+            yield AiChatMessage("second")
+
+    monkeypatch.setitem(chat.api.tool_lookup, "slow_tool", SlowTool)
+
+    async def handle():
+        received = []
+        with cancellation.activate(scope), pytest.raises(cancellation.Cancelled):
+            async for message in chat.api._ahandle_individual_request(None, Conversation(), "hi", "slow_tool"):
+                received.append(message)
+                scope.cancel()
+        return received
+
+    received = asyncio.run(handle())
+
+    assert [m.value for m in received] == ["first"]
+    assert steps == ["first"]
+
+
+def test_fast_path_skips_routing_llm_calls():
+    user_message = "Show a map of Quercus alba"
+    conv = make_convo(UserMessage(user_message))
+
+    with metrics.track_turn() as turn:
+        requests = chat.api._plan_requests(None, conv, user_message, "fused", fast_path_threshold=0.9)
+
+    assert requests == [(user_message, "show_map_of_species_occurrences")]
+    assert turn.get("llm.calls") == 0
+    assert turn.get("fast_path.hits") == 1
+
+
+def test_fast_path_falls_back_below_threshold():
+    with metrics.track_turn() as turn:
+        assert chat.api._take_fast_path("Show a map of polar bears", 0.9) is None
+        assert chat.api._take_fast_path("Show a map of polar bears", 0.7) is not None
+
+    assert turn.get("fast_path.fallbacks") == 1
+    assert turn.get("fast_path.hits") == 1
+
+
+def _make_classifier():
+    from nlp.intent_classifier import IntentClassifier
+    return IntentClassifier.train(
+        ["Count records of Ursus", "How many records of Carex are there", "Map of Quercus", "Show a map of Acer"],
+        ["count_species_occurrence_records", "count_species_occurrence_records",
+         "show_map_of_species_occurrences", "show_map_of_species_occurrences"])
+
+
+def test_create_plan_uses_confident_tool_classifier(tmp_path):
+    ai = AI()
+    ai.tool_classifier = _make_classifier()
+    ai.tool_classifier_threshold = 0.6
+    ai.tool_choice_log = str(tmp_path / "tool_choices.jsonl")
+
+    with metrics.track_turn() as turn:
+        tool_name = chat.api.create_plan(ai, Conversation(), "How many records of Acer are there?")
+
+    assert tool_name == "count_species_occurrence_records"
+    assert turn.get("llm.calls") == 0
+    assert turn.get("tool_classifier.hits") == 1
+    assert not (tmp_path / "tool_choices.jsonl").exists()
+
+
+def test_log_tool_choice(tmp_path):
+    ai = AI()
+    ai.tool_choice_log = str(tmp_path / "tool_choices.jsonl")
+
+    chat.api._log_tool_choice(ai, "Map of Ursus", "show_map_of_species_occurrences")
+    chat.api._log_tool_choice(ai, "Hello", "converse")
+
+    from nlp.intent_classifier import read_examples
+    assert read_examples(ai.tool_choice_log) == (["Map of Ursus", "Hello"],
+                                                 ["show_map_of_species_occurrences", "converse"])
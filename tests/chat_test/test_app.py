@@ -1,7 +1,13 @@
+import json
+
 import pytest
 
+import idigbio_util
+import occurrence_maps
 from chat.api import HELP_MESSAGE
 from chat_test_util import app, client, chat
+from idigbio_util import RecordPage
+from occurrence_maps import GeohashGrid, GeohashBucket
 from matchers import string_must_contain
 
 
@@ -66,6 +72,18 @@ def test_ping(client):
     assert messages[0]["value"] == "pong"
 
 
+def test_ping_as_ndjson(client):
+    result = client.post("/chat", json={"type": "user_text_message", "value": "ping"},
+                         headers={"Accept": "application/x-ndjson"})
+    events = [json.loads(line) for line in result.get_data(as_text=True).splitlines()]
+
+    assert result.mimetype == "application/x-ndjson"
+    assert result.headers["X-Accel-Buffering"] == "no"
+    assert events[0]["type"] == "ai_text_message"
+    assert events[0]["value"] == "pong"
+    assert events[-1] == {"event": "done"}
+
+
 @pytest.mark.parametrize("app", [{"config_overrides": {"CHAT": {"SAFE_MODE": True}}}], indirect=True)
 def test_remember_robo_check(app, client):
     chat(client, "not a robot")
@@ -286,3 +304,103 @@ def test_explain_difference_between_data_and_index_fields():
     messages = chat(
         "I want to use iDigBio's records API. What fields will return location information for collection events?")
     assert False
+
+
+def test_stream_records(client, monkeypatch):
+    def paginate(endpoint, params, page_size, max_records, prefetch):
+        assert params == {"rq": {"genus": "carex"}}
+        assert page_size == 2
+        yield RecordPage(offset=0, item_count=3, items=[{"uuid": "a"}, {"uuid": "b"}])
+        yield RecordPage(offset=2, item_count=3, items=[{"uuid": "c"}])
+
+    monkeypatch.setattr(idigbio_util, "paginate_idigbio_search", paginate)
+
+    result = client.post("/records", json={"rq": {"genus": "carex"}, "page_size": 2, "limit": 5000,
+                                           "unknown": True})
+    lines = [json.loads(line) for line in result.get_data(as_text=True).splitlines()]
+
+    assert result.mimetype == "application/x-ndjson"
+    assert lines == [{"itemCount": 3, "offset": 0, "items": [{"uuid": "a"}, {"uuid": "b"}]},
+                     {"itemCount": 3, "offset": 2, "items": [{"uuid": "c"}]}]
+
+
+@pytest.mark.parametrize("params", [{"page_size": "lots"}, {"page_size": 0}, {"max_records": -5},
+                                    {"max_records": None}, {"page_size": True}])
+def test_stream_records_with_invalid_limits(client, params):
+    result = client.post("/records", json={"rq": {"genus": "carex"}} | params)
+
+    assert result.status_code == 400
+
+
+@pytest.mark.parametrize("body", [[{"genus": "carex"}], "carex", 5, {"rq": "carex"}, {"rq": ["carex"]}])
+def test_stream_records_with_invalid_body(client, body):
+    assert client.post("/records", json=body).status_code == 400
+
+
+def test_geohash_grid(client, monkeypatch):
+    def get_geohash_grid(rq, zoom, cache, max_records):
+        assert rq == {"genus": "carex"}
+        assert zoom == 3
+        return GeohashGrid(precision=3, item_count=5, source="local",
+                           buckets=[GeohashBucket(geohash="ezs", count=5, lat=42.9, lon=-4.9)])
+
+    monkeypatch.setattr(occurrence_maps, "get_geohash_grid", get_geohash_grid)
+
+    result = client.post("/map/geohash", json={"rq": {"genus": "carex"}, "zoom": 3})
+
+    assert result.json == {"precision": 3, "itemCount": 5, "truncated": False, "source": "local",
+                           "buckets": [{"geohash": "ezs", "count": 5, "lat": 42.9, "lon": -4.9}]}
+
+
+def test_geohash_grid_when_idigbio_fails(client, monkeypatch):
+    def get_geohash_grid(rq, zoom, cache, max_records):
+        raise idigbio_util.IDigBioError("503 Service Unavailable")
+
+    monkeypatch.setattr(occurrence_maps, "get_geohash_grid", get_geohash_grid)
+
+    result = client.post("/map/geohash", json={"rq": {"genus": "quercus"}, "zoom": 3})
+
+    assert result.status_code == 502
+    assert "503" in result.json["error"]
+
+
+@pytest.mark.parametrize("body", [{"rq": {"genus": "carex"}, "zoom": "abc"}, {"rq": {"genus": "carex"}, "zoom": None},
+                                  {"rq": {"genus": "carex"}, "zoom": [3]}, {"rq": {"genus": "carex"}, "zoom": -1},
+                                  [{"genus": "carex"}], "carex"])
+def test_geohash_grid_with_invalid_request(client, body):
+    assert client.post("/map/geohash", json=body).status_code == 400
+
+
+def test_occurrence_tile(client, monkeypatch):
+    def get_occurrence_tile(rq, z, x, y, cache, max_points):
+        assert rq == {"genus": "carex"}
+        assert (z, x, y) == (3, 2, 1)
+        return b"tile"
+
+    monkeypatch.setattr(occurrence_maps, "get_occurrence_tile", get_occurrence_tile)
+
+    result = client.get("/map/tiles/3/2/1.mvt", query_string={"rq": json.dumps({"genus": "carex"})})
+
+    assert result.mimetype == "application/vnd.mapbox-vector-tile"
+    assert result.data == b"tile"
+    assert client.get("/map/tiles/1/2/0.mvt").status_code == 404
+
+
+@pytest.mark.parametrize("rq", ["{not json", "[]", json.dumps({"genus": "carex", "geopoint": "florida"})])
+def test_occurrence_tile_with_invalid_query(client, rq):
+    assert client.get("/map/tiles/3/2/1.mvt", query_string={"rq": rq}).status_code == 400
+
+
+def test_occurrence_tile_when_idigbio_fails(client, monkeypatch):
+    def get_occurrence_tile(rq, z, x, y, cache, max_points):
+        raise idigbio_util.IDigBioError("503 Service Unavailable")
+
+    monkeypatch.setattr(occurrence_maps, "get_occurrence_tile", get_occurrence_tile)
+
+    result = client.get("/map/tiles/3/2/1.mvt", query_string={"rq": json.dumps({"genus": "carex"})})
+
+    assert result.status_code == 502
+
+
+def test_metrics_are_disabled_without_token(client):
+    assert client.get("/metrics").status_code == 404
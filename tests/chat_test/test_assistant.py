@@ -0,0 +1,107 @@
+import asyncio
+from types import SimpleNamespace
+
+from openai.types.chat import ChatCompletionChunk
+
+from chat.conversation import Conversation
+from chat.messages import UserMessage
+from chat.tools.converse import Converse
+from chat.utils.assistant import present_results, apresent_results
+
+
+def _chunk(content: str):
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-123", "object": "chat.completion.chunk", "created": 0, "model": "gpt-4o",
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    })
+
+
+class FakeLLM:
+    def __init__(self, *tokens: str):
+        self.tokens = tokens
+        self.generated = []
+
+    def create(self, **kwargs):
+        assert kwargs["stream"]
+        for token in self.tokens:
+            self.generated.append(token)
+            yield _chunk(token)
+
+    def as_ai(self):
+        return SimpleNamespace(openai=SimpleNamespace(chat=SimpleNamespace(completions=self)))
+
+
+class FakeAsyncLLM(FakeLLM):
+    async def create(self, **kwargs):
+        return self.__stream(**kwargs)
+
+    async def __stream(self, **kwargs):
+        for chunk in super().create(**kwargs):
+            yield chunk
+
+    def as_ai(self):
+        return SimpleNamespace(async_openai=SimpleNamespace(chat=SimpleNamespace(completions=self)))
+
+
+def test_present_results_streams_tokens():
+    llm = FakeLLM("There ", "are ", "42 ", "records.")
+    conv = Conversation([UserMessage("How many records of Carex are there?").freeze()])
+
+    message = present_results(llm.as_ai(), conv, "count Carex", "42 records")
+    assert llm.generated == []
+
+    fragments = []
+    for fragment in message.stream_to_frontend():
+        fragments.append(fragment)
+        if fragment == "There ":
+            # The first token is sent before the rest are generated
+            assert llm.generated == ["There "]
+
+    assert "There " in fragments
+    assert message.freeze().read("openai_messages") == [{"role": "assistant", "content": "There are 42 records."}]
+    assert message.freeze().read("frontend_messages")["value"] == "There are 42 records."
+
+
+def test_converse_streams_tokens():
+    llm = FakeLLM("Hi", "!")
+    conv = Conversation([UserMessage("Hello").freeze()])
+
+    message = next(Converse().call(llm.as_ai(), conv, "Hello", {}))
+    assert llm.generated == []
+
+    conv.append(message)
+    assert conv.history[-1].read("openai_messages") == [{"role": "assistant", "content": "Hi!"}]
+
+
+def test_apresent_results_streams_tokens():
+    llm = FakeAsyncLLM("There ", "are ", "42 ", "records.")
+    conv = Conversation([UserMessage("How many records of Carex are there?").freeze()])
+
+    async def present():
+        message = await apresent_results(llm.as_ai(), conv, "count Carex", "42 records")
+        assert llm.generated == []
+
+        fragments = []
+        async for fragment in message.astream_to_frontend():
+            fragments.append(fragment)
+            if fragment == "There ":
+                assert llm.generated == ["There "]
+
+        assert "There " in fragments
+        return message
+
+    message = asyncio.run(present())
+    assert message.freeze().read("openai_messages") == [{"role": "assistant", "content": "There are 42 records."}]
+
+
+def test_aconverse_completes_before_freezing():
+    llm = FakeAsyncLLM("Hi", "!")
+    conv = Conversation([UserMessage("Hello").freeze()])
+
+    async def converse():
+        message = await anext(Converse().acall(llm.as_ai(), conv, "Hello", {}))
+        await message.complete()
+        return message
+
+    conv.append(asyncio.run(converse()))
+    assert conv.history[-1].read("openai_messages") == [{"role": "assistant", "content": "Hi!"}]
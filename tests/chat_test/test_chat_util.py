@@ -1,5 +1,11 @@
-from chat.utils.json import stream_as_json, make_pretty_json_string
-from chat.messages import UserMessage, AiChatMessage, AiProcessingMessage, stream_messages
+import asyncio
+import json
+import time
+
+from chat.content_streams import StreamedString, AsyncStreamedString
+from chat.utils.json import stream_as_json, astream_as_json, make_pretty_json_string
+from chat.messages import UserMessage, AiChatMessage, AiProcessingMessage, AiMapMessage, stream_messages, stream_message_events, \
+    astream_message_events, with_heartbeats, awith_heartbeats, format_event, NDJSON, SSE
 
 
 def test_stream_response_as_json():
@@ -49,6 +55,90 @@ def test_stream_another_stream_as_json():
     assert text == """{"type":"hotdog","value":{"dog":"Ball Park Frank","condiment":"ketchup"}}"""
 
 
+def test_stream_as_json_coalesces_fragments():
+    d = {"dogs": [{"name": f"dog {i}", "age": "1"} for i in range(100)]}
+
+    chunks = list(stream_as_json(d, chunk_size=512))
+
+    assert "".join(chunks) == "".join(stream_as_json(d, chunk_size=1))
+    assert all(len(c) >= 512 for c in chunks[:-1])
+
+
+def test_stream_messages_with_chunk_size():
+    messages = [
+        AiChatMessage("Hello " * 100),
+        AiProcessingMessage("Saying goodbye...", "Goodbye " * 100),
+        AiChatMessage("Goodbye")
+    ]
+
+    small = list(stream_messages(iter(messages), chunk_size=16))
+    large = list(stream_messages(iter(messages), chunk_size=4096))
+
+    assert "".join(small) == "".join(large)
+    assert len(small) > len(large)
+
+
+def test_stream_as_json_flushes_before_streamed_content():
+    pulled = []
+
+    def deltas():
+        for delta in ["ket", "chup"]:
+            pulled.append(delta)
+            yield delta
+
+    chunks = stream_as_json({"dog": "Ball Park Frank", "condiment": deltas()}, chunk_size=4096)
+
+    assert next(chunks) == '{"dog":"Ball Park Frank","condiment":"'
+    assert pulled == []
+    assert next(chunks) == "ket"
+    assert pulled == ["ket"]
+    assert list(chunks) == ["chup", '"}']
+
+
+def test_astream_as_json_flushes_before_streamed_content():
+    async def deltas():
+        yield "ket"
+        yield "chup"
+
+    async def collect():
+        return [c async for c in astream_as_json({"dog": "Ball Park Frank", "condiment": deltas()}, chunk_size=4096)]
+
+    assert asyncio.run(collect()) == ['{"dog":"Ball Park Frank","condiment":"', "ket", "chup", '"}']
+
+
+def test_to_frontend_matches_streamed_json():
+    async def fragments():
+        yield "Hurri"
+        yield "cane"
+
+    async_text = AsyncStreamedString(fragments())
+    asyncio.run(async_text.gobble())
+    streamed_text = StreamedString(iter(["You don't ", "wanna \"know\"\n"]))
+    streamed_text.gobble()
+
+    messages = [
+        UserMessage("What's the weather tomorrow?"),
+        AiChatMessage(streamed_text),
+        AiChatMessage(async_text),
+        AiProcessingMessage("Fetching the weather...", {"rq": {"genus": "carex"}, "limit": 10, "tags": ["a", "b"]}),
+        AiProcessingMessage("Thinking...", "Hidden", show_user=False),
+        AiMapMessage({"rq": {"genus": "carex"}}),
+    ]
+
+    for message in messages:
+        assert message.to_frontend() == json.loads("".join(message.stream_to_frontend()))
+
+
+def test_freeze_streamed_text():
+    message = AiChatMessage(StreamedString(iter(["Hurri", "cane"])))
+    message.value.gobble()
+
+    frozen = message.freeze().read_all()
+
+    assert frozen["openai_messages"] == [{"role": "assistant", "content": "Hurricane"}]
+    assert frozen["frontend_messages"]["value"] == "Hurricane"
+
+
 def test_stream_containing_quotes():
     pass
 
@@ -75,3 +165,78 @@ def test_json_to_markdown():
     "limit": 10
 }\
 """
+
+
+def test_stream_message_events():
+    def weather_forecast():
+        yield UserMessage("What's the weather tomorrow?")
+        yield AiProcessingMessage("Fetching the weather...", StreamedString(iter(["Hurri", "cane"])))
+        yield AiProcessingMessage("Thinking...", "Hidden", show_user=False)
+
+    events = list(stream_message_events(weather_forecast()))
+    for event in events:
+        event.pop("id", None)
+
+    assert events == [
+        {"event": "message", "type": "user_text_message", "value": "What's the weather tomorrow?"},
+        {"event": "message_start", "type": "ai_processing_message",
+         "value": {"summary": "Fetching the weather...", "content": ""}},
+        {"event": "delta", "path": ["content"], "text": "Hurri"},
+        {"event": "delta", "path": ["content"], "text": "cane"},
+        {"event": "message_end"},
+        {"event": "done"},
+    ]
+
+
+def test_astream_message_events():
+    async def fragments():
+        yield "Hurri"
+        yield "cane"
+
+    async def weather_forecast():
+        yield AiChatMessage(AsyncStreamedString(fragments()))
+
+    async def collect():
+        return [event async for event in astream_message_events(weather_forecast())]
+
+    events = asyncio.run(collect())
+
+    assert [e["event"] for e in events] == ["message_start", "delta", "delta", "message_end", "done"]
+    assert events[0]["value"] == ""
+    assert [e["path"] for e in events[1:3]] == [[], []]
+
+
+def test_format_event():
+    event = {"event": "delta", "id": "1", "path": [], "text": "hi\n"}
+
+    assert format_event(event, NDJSON) == '{"event": "delta", "id": "1", "path": [], "text": "hi\\n"}\n'
+    assert format_event(event, SSE) == 'event: delta\ndata: {"event": "delta", "id": "1", "path": [], "text": "hi\\n"}\n\n'
+
+
+def test_heartbeats_while_waiting():
+    def slow_events():
+        yield {"event": "message"}
+        time.sleep(0.35)
+        yield {"event": "done"}
+
+    events = [e["event"] for e in with_heartbeats(slow_events(), 0.1)]
+
+    assert events[0] == "message"
+    assert events[-1] == "done"
+    assert 2 <= events.count("heartbeat") <= 4
+
+
+def test_aheartbeats_while_waiting():
+    async def slow_events():
+        yield {"event": "message"}
+        await asyncio.sleep(0.35)
+        yield {"event": "done"}
+
+    async def collect():
+        return [e["event"] async for e in awith_heartbeats(slow_events(), 0.1)]
+
+    events = asyncio.run(collect())
+
+    assert events[0] == "message"
+    assert events[-1] == "done"
+    assert 2 <= events.count("heartbeat") <= 4
@@ -4,7 +4,6 @@ from chat.messages import AiProcessingMessage, AiChatMessage, UserMessage
 from chat.messages import stream_messages
 from chat.conversation import Conversation
 from chat_test.chat_test_util import make_convo
-from idigbio_util import url_encode_params
 from nlp.ai import AI
 
 
@@ -57,9 +56,7 @@ def test_get_record_counts_as_markdown_table():
         "count": 5
     }
 
-    url_params = url_encode_params(params)
-    total, counts = _query_summary_api(
-        f"https://search.idigbio.org/v2/summary/top/records?{url_params}")
+    total, counts = _query_summary_api(params)
 
     table = "".join(_stream_record_counts_as_markdown_table(counts))
 
@@ -78,3 +75,97 @@ def test_generate_records_summary_parameters():
         "family": "Ursidae",
         "country": "Costa Rica"
     }
+
+
+def test_render_for_openai_with_stable_prefix():
+    conv = make_convo(
+        AiChatMessage("a1"),
+        UserMessage("u1")
+    )
+
+    texts = conv.render_to_openai("This is the system message", "r1", system_header="(header)\n\n",
+                                  prefix_stable=True)
+
+    assert texts == [
+        {'role': 'system', 'content': 'This is the system message\n\n(header)'},
+        {'role': 'assistant', 'content': 'a1'},
+        {'role': 'user', 'content': 'u1'},
+        {'role': 'user', 'content': 'First address the following request: r1'}
+    ]
+
+
+def test_render_for_openai_with_stable_prefix_and_datetime():
+    conv = make_convo(AiChatMessage("a1"))
+    texts = conv.render_to_openai("This is the system message", prefix_stable=True)
+    assert texts[0]["content"].startswith("This is the system message\n\nToday's date is")
+
+
+def _make_long_convo(turns: int, **settings) -> Conversation:
+    conv = Conversation(**settings)
+    for i in range(turns):
+        conv.append(UserMessage(f"u{i}"))
+        conv.append(AiChatMessage(f"a{i}"))
+    return conv
+
+
+def test_render_recent_turns_with_summary():
+    conv = _make_long_convo(4, max_verbatim_turns=2)
+
+    # Until a summary is available, older turns are still rendered verbatim
+    assert len(conv.render_to_openai("s", system_header="")) == 9
+    assert conv.needs_summary_update()
+
+    summarized = []
+
+    def summarize(previous, messages):
+        summarized.append((previous, [m.read("openai_messages")[0]["content"] for m in messages]))
+        return "The user said u0 and u1"
+
+    conv.update_summary(summarize)
+
+    assert summarized == [(None, ["u0", "a0", "u1", "a1"])]
+    assert not conv.needs_summary_update()
+    assert conv.render_to_openai("s", system_header="") == [
+        {"role": "system", "content": "s"},
+        {"role": "system", "content": "Here is a summary of the earlier part of the conversation:\n\n"
+                                      "The user said u0 and u1"},
+        {"role": "user", "content": "u2"},
+        {"role": "assistant", "content": "a2"},
+        {"role": "user", "content": "u3"},
+        {"role": "assistant", "content": "a3"}
+    ]
+
+
+def test_update_summary_incrementally():
+    recorded = []
+    conv = _make_long_convo(2, max_verbatim_turns=1)
+    conv.summary_recorder = lambda summary, conversation_id: recorded.append(summary)
+
+    conv.update_summary(lambda previous, messages: "first")
+    conv.append(UserMessage("u2"))
+    conv.update_summary(lambda previous, messages: f"{previous}, then {messages[0].read('openai_messages')[0]['content']}")
+
+    assert [(s.message_count, s.content) for s in recorded] == [(2, "first"), (4, "first, then u1")]
+
+
+def test_history_token_budget():
+    conv = Conversation(history_token_budget=40)
+    conv.append(UserMessage("long " * 100))
+    conv.append(AiChatMessage("a0"))
+    conv.append(UserMessage("u1"))
+    conv.append(AiChatMessage("a1"))
+    conv.append(UserMessage("u2"))
+
+    conv.update_summary(lambda previous, messages: "A long message")
+    rendered = conv.render_to_openai("s", system_header="")
+
+    assert conv.summary.message_count == 2
+    assert [m["content"] for m in rendered[2:]] == ["u1", "a1", "u2"]
+
+
+def test_latest_turn_is_always_rendered():
+    conv = _make_long_convo(2, history_token_budget=1)
+
+    conv.update_summary(lambda previous, messages: "Earlier messages")
+
+    assert [m["content"] for m in conv.render_to_openai("s", system_header="")[2:]] == ["u1", "a1"]
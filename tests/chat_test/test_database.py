@@ -1,8 +1,16 @@
+import threading
+import time
+
 import pytest
 import sqlalchemy
+from flask import Flask
+from sqlalchemy.pool import StaticPool
 
+from chat.conversation import ConversationSummary
 from chat.messages import UserMessage, AiProcessingMessage, AiChatMessage
-from storage.database import DatabaseEngine
+from storage import migrations
+from storage.database import DatabaseEngine, MIGRATIONS, metadata, messages_by_conversation, conversations_by_user
+from storage.write_behind import WriteBehindQueue
 
 
 @pytest.fixture
@@ -96,3 +104,258 @@ def test_frontend_conversation_messaages(db: DatabaseEngine):
         {"id": message_ids[0], "type": "user_text_message", "value": "Hi!"},
         {"id": message_ids[1], "type": "ai_text_message", "value": "01010111001"}
     ]
+
+
+def test_conversation_summary(db: DatabaseEngine):
+    user_id = "0fee2103-7467-47ee-a224-dc739a5eb619"
+    conv_id = "03cb9be7-993a-4625-b546-2ab2f63fcfc3"
+
+    db.insert_user({"id": user_id, "temp": False})
+    db.create_conversation_history(conv_id, user_id, "A friendly chat")
+    assert db.get_conversation(conv_id).summary is None
+
+    db.write_summary_to_storage(ConversationSummary(message_count=2, content="They said hi"), conv_id)
+    db.write_summary_to_storage(ConversationSummary(message_count=4, content="They said hi twice"), conv_id)
+
+    summary = db.get_conversation(conv_id).summary
+    assert (summary.message_count, summary.content) == (4, "They said hi twice")
+
+
+def test_conversations_use_the_chat_settings_of_their_app():
+    user_id = "0fee2103-7467-47ee-a224-dc739a5eb619"
+    conv_id = "03cb9be7-993a-4625-b546-2ab2f63fcfc3"
+
+    def make_db(chat_config: dict) -> DatabaseEngine:
+        db = DatabaseEngine(sqlalchemy.create_engine("sqlite://"))
+        app = Flask(__name__)
+        app.config["CHAT"] = chat_config
+        db.init_app(app)
+        db.insert_user({"id": user_id, "temp": False})
+        db.create_conversation_history(conv_id, user_id, "A friendly chat")
+        return db
+
+    configured = make_db({"PREFIX_STABLE_PROMPTS": True, "HISTORY_TURNS": 3, "HISTORY_TOKEN_BUDGET": 1000})
+    default = make_db({})
+
+    conv = configured.get_conversation(conv_id)
+    assert (conv.prefix_stable_prompts, conv.max_verbatim_turns, conv.history_token_budget) == (True, 3, 1000)
+    fork = conv.fork()
+    assert (fork.prefix_stable_prompts, fork.max_verbatim_turns, fork.history_token_budget) == (True, 3, 1000)
+
+    conv = default.get_conversation(conv_id)
+    assert (conv.prefix_stable_prompts, conv.max_verbatim_turns, conv.history_token_budget) == (False, None, None)
+
+
+@pytest.fixture
+def write_behind_db():
+    # Messages are written from a background thread, which must see the same in-memory database
+    engine = sqlalchemy.create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    db = DatabaseEngine(engine)
+    app = Flask(__name__)
+    app.config["DATABASE"] = {"WRITE_BEHIND": True, "WRITE_INTERVAL": 10}
+    db.init_app(app)
+    yield db
+    db.close()
+
+
+def test_write_behind_batches_messages(write_behind_db: DatabaseEngine):
+    db = write_behind_db
+    user_id = "0fee2103-7467-47ee-a224-dc739a5eb619"
+    conv_id = "03cb9be7-993a-4625-b546-2ab2f63fcfc3"
+    db.insert_user({"id": user_id, "temp": False})
+    db.create_conversation_history(conv_id, user_id, "A friendly chat")
+
+    inserts = []
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute",
+                            lambda conn, cursor, statement, *args: inserts.append(statement)
+                            if statement.startswith("INSERT INTO messages") else None)
+
+    conv = db.get_conversation(conv_id)
+    conv.append([UserMessage("Hi!"), AiChatMessage("Hello"), UserMessage("Bye!")])
+    conv.flush()
+
+    assert len(inserts) == 1
+    assert [m.read("frontend_messages")["value"] for m in db.get_conversation(conv_id).history] == [
+        "Hi!", "Hello", "Bye!"]
+
+
+def test_conversations_are_read_with_queued_messages(write_behind_db: DatabaseEngine):
+    db = write_behind_db
+    user_id = "0fee2103-7467-47ee-a224-dc739a5eb619"
+    conv_id = "03cb9be7-993a-4625-b546-2ab2f63fcfc3"
+    db.insert_user({"id": user_id, "temp": False})
+    db.create_conversation_history(conv_id, user_id, "A friendly chat")
+
+    db.write_message_to_storage(UserMessage("Hi!").freeze(), conv_id)
+
+    assert [m["value"] for m in db.stream_conversation_for_frontend(conv_id)] == ["Hi!"]
+
+
+def test_write_behind_queue_writes_remaining_rows_when_closed():
+    written = []
+    queue = WriteBehindQueue(written.extend, interval=10)
+
+    queue.put({"n": 1})
+    queue.put({"n": 2})
+    queue.close()
+
+    assert written == [{"n": 1}, {"n": 2}]
+
+
+def test_write_behind_queue_blocks_when_full():
+    unblocked = threading.Event()
+    written = []
+
+    def write_slowly(rows):
+        unblocked.wait()
+        written.extend(rows)
+
+    queue = WriteBehindQueue(write_slowly, max_batch_size=1, interval=0, max_pending=1)
+    queue.put({"n": 1})
+    time.sleep(0.05)  # Let the first row be taken off the queue
+    queue.put({"n": 2})
+
+    third = threading.Thread(target=queue.put, args=({"n": 3},))
+    third.start()
+    third.join(0.1)
+    assert third.is_alive()
+
+    unblocked.set()
+    third.join(1)
+    queue.flush()
+    assert written == [{"n": 1}, {"n": 2}, {"n": 3}]
+    queue.close()
+
+
+def test_write_behind_queue_reports_rows_that_could_not_be_written():
+    written = []
+
+    def write(rows):
+        if any(row.get("invalid") for row in rows):
+            raise ValueError("Invalid row")
+        written.extend(rows)
+
+    queue = WriteBehindQueue(write, interval=10)
+    queue.put({"n": 1}, key="a")
+    queue.put({"n": 2, "invalid": True}, key="b")
+    queue.put({"n": 3}, key="a")
+
+    # Only the flush for the rows that failed reports it
+    queue.flush()
+    queue.flush(key="a")
+    assert written == [{"n": 1}, {"n": 3}]
+
+    with pytest.raises(ValueError):
+        queue.flush(key="b")
+    queue.flush(key="b")
+    queue.close()
+
+
+def test_write_behind_queue_waits_only_for_rows_of_key():
+    unblocked = threading.Event()
+    written = []
+
+    def write(rows):
+        if any(row.get("slow") for row in rows):
+            unblocked.wait()
+        written.extend(rows)
+
+    queue = WriteBehindQueue(write, max_batch_size=1, interval=10)
+    queue.put({"n": 1}, key="a")
+    queue.put({"n": 2, "slow": True}, key="b")
+
+    queue.wait(key="a", timeout=1)
+    queue.flush(key="a", timeout=1)
+    assert written == [{"n": 1}]
+    with pytest.raises(TimeoutError):
+        queue.wait(key="b", timeout=0.05)
+
+    unblocked.set()
+    queue.flush(key="b", timeout=1)
+    assert written == [{"n": 1}, {"n": 2, "slow": True}]
+    queue.close()
+
+
+def test_failed_messages_are_only_reported_to_their_conversation(write_behind_db: DatabaseEngine):
+    db = write_behind_db
+    db.insert_user({"id": "0fee2103-7467-47ee-a224-dc739a5eb619", "temp": False})
+    failing = db.get_or_create_conversation("03cb9be7-993a-4625-b546-2ab2f63fcfc3",
+                                            "0fee2103-7467-47ee-a224-dc739a5eb619")
+    other = db.get_or_create_conversation("b6e4a2a8-4f5e-4b8e-9d1e-3f2c5a7d9e10",
+                                          "0fee2103-7467-47ee-a224-dc739a5eb619")
+
+    message = UserMessage("Hi!")
+    failing.append(message)
+    # Writing the same message twice breaks the primary key
+    db.write_message_to_storage(message.freeze(), failing.conversation_id)
+    other.append(UserMessage("Hello!"))
+
+    other.flush()
+    db.get_conversation(failing.conversation_id)
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        failing.flush()
+
+
+def test_migrations_are_applied_once(db: DatabaseEngine):
+    assert migrations.get_applied_versions(db.engine) == {m.version for m in MIGRATIONS}
+    assert migrations.migrate(db.engine, MIGRATIONS) == []
+
+
+def test_migrations_create_the_current_schema(db: DatabaseEngine):
+    inspector = sqlalchemy.inspect(db.engine)
+    for table in metadata.sorted_tables:
+        assert [c["name"] for c in inspector.get_columns(table.name)] == [c.name for c in table.columns]
+        assert {i["name"] for i in inspector.get_indexes(table.name)} == {i.name for i in table.indexes}
+
+
+def test_migrate_database_that_predates_migrations():
+    engine = sqlalchemy.create_engine("sqlite://")
+    DatabaseEngine(engine)
+    with engine.begin() as connection:
+        messages_by_conversation.drop(connection)
+        conversations_by_user.drop(connection)
+        migrations.schema_version.drop(connection)
+
+    DatabaseEngine(engine)
+
+    inspector = sqlalchemy.inspect(engine)
+    assert "ix_messages_conversation_id_created" in [i["name"] for i in inspector.get_indexes("messages")]
+    assert "ix_conversations_user_id_created" in [i["name"] for i in inspector.get_indexes("conversations")]
+    assert migrations.get_applied_versions(engine) == {m.version for m in MIGRATIONS}
+
+
+def _query_plans(db: DatabaseEngine, table: str, read) -> list[str]:
+    """
+    :return: How SQLite runs the queries of a table that read makes
+    """
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, *args):
+        if statement.startswith("SELECT") and f"FROM {table}" in statement:
+            statements.append((statement, parameters))
+
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", capture)
+    read()
+    sqlalchemy.event.remove(db.engine, "before_cursor_execute", capture)
+
+    assert len(statements) > 0
+    with db.engine.connect() as connection:
+        return [row[-1] for statement, parameters in statements
+                for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+
+
+def test_conversation_queries_use_indexes(db: DatabaseEngine):
+    user_id = "0fee2103-7467-47ee-a224-dc739a5eb619"
+    conv_id = "03cb9be7-993a-4625-b546-2ab2f63fcfc3"
+    db.insert_user({"id": user_id, "temp": False})
+    db.create_conversation_history(conv_id, user_id, "A friendly chat")
+    db.write_message_to_storage(UserMessage("Hi!").freeze(), conv_id)
+
+    for read in [lambda: db.get_conversation(conv_id), lambda: list(db.stream_conversation_for_frontend(conv_id))]:
+        plans = _query_plans(db, "messages", read)
+        assert any("USING INDEX ix_messages_conversation_id_created" in plan for plan in plans), plans
+        assert not any("TEMP B-TREE" in plan for plan in plans), plans
+
+    plans = _query_plans(db, "conversations", lambda: db.get_user_conversations(user_id))
+    assert any("USING INDEX ix_conversations_user_id_created" in plan for plan in plans), plans
+    assert not any("TEMP B-TREE" in plan for plan in plans), plans
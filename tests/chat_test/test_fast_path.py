@@ -0,0 +1,53 @@
+import pytest
+
+from chat.fast_path import classify, looks_like_taxon, get_subject
+
+
+@pytest.mark.parametrize("message,tool_name", [
+    ("Show a map of Ursus arctos", "show_map_of_species_occurrences"),
+    ("Please show me a map of genus Carex in Florida", "show_map_of_species_occurrences"),
+    ("map of Quercus alba", "show_map_of_species_occurrences"),
+    ("How many records of Carex are there in Florida?", "count_species_occurrence_records"),
+    ("Count records of family Asteraceae collected since 2000", "count_species_occurrence_records"),
+    ("How many records of Canis lupus and Canis latrans", "count_species_occurrence_records"),
+    ("Find records of *Acer saccharum* that have images in iDigBio", "search_species_occurrence_records"),
+    ("Find media for genus Carex", "search_media_records"),
+    ("Download records of Quercus alba to someone@example.org", "download_species_occurrence_records"),
+])
+def test_unambiguous_requests(message, tool_name):
+    match = classify(message)
+
+    assert match is not None
+    assert match.tool_name == tool_name
+    assert match.confidence >= 0.9
+
+
+@pytest.mark.parametrize("message", [
+    "Hello!",
+    "What do porcupines eat?",
+    "What species has the most reported occurrences in Okinawa, Japan?",
+    "Find media for genus Carex and show a map of genus Quercus",
+    "How many records are there for polar bears in Florida? Show them on a map.",
+])
+def test_ambiguous_requests(message):
+    assert classify(message) is None
+
+
+def test_common_names_are_less_certain():
+    match = classify("Show a map of polar bears")
+
+    assert match.tool_name == "show_map_of_species_occurrences"
+    assert match.confidence < 0.9
+
+
+def test_looks_like_taxon():
+    assert looks_like_taxon("Quercus alba")
+    assert looks_like_taxon("Asteraceae")
+    assert looks_like_taxon("genus Carex")
+    assert not looks_like_taxon("polar bears")
+    assert not looks_like_taxon("the museum")
+
+
+def test_get_subject():
+    assert get_subject("the genus Carex in Florida since 2000") == "genus Carex"
+    assert get_subject("*Acer saccharum* that have images") == "Acer saccharum"
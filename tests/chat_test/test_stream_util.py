@@ -1,4 +1,7 @@
-from chat.content_streams import StreamedString
+import asyncio
+
+from chat.content_streams import StreamedString, StreamedDict, AsyncStreamedDict, TextAccumulator, DictAccumulator
+from chat.utils.json import stream_as_json, astream_as_json, to_json_value
 
 
 def test_streamed_string_from_string():
@@ -11,3 +14,67 @@ def test_streamed_string_from_stream():
     ss = StreamedString(iter("Just another string"))
     ss.get()  # Empty the stream
     assert ss.get() == "Just another string"
+
+
+def test_streamed_string_so_far():
+    ss = StreamedString(iter(["Just ", "another ", "string"]))
+    deltas = iter(ss)
+    assert next(deltas) == ""
+    assert next(deltas) == "Just "
+    assert next(deltas) == "another "
+    assert next(iter(ss)) == "Just another "
+    assert ss.get() == "Just another string"
+
+
+def test_text_accumulator():
+    text = TextAccumulator()
+    assert text.get() == ""
+    for delta in ["a", "b", "c"]:
+        text.add(delta)
+    assert text.get() == "abc"
+    text.add("d")
+    assert text.get() == "abcd"
+
+
+def test_dict_accumulator():
+    d = DictAccumulator()
+    d.add({"answer": "Quer", "params": {"rq": {"genus": "quercus"}}})
+    d.add({"answer": "cus", "params": {"limit": 10}})
+    d.add({"params": {"limit": 20}})
+    assert d.get() == {"answer": "Quercus", "params": {"rq": {"genus": "quercus"}, "limit": 20}}
+
+
+def test_streamed_dict():
+    sd = StreamedDict(iter([{"answer": "Quer"}, {"answer": "cus"}]))
+    assert list(sd) == [{"answer": "Quercus"}]
+    assert sd.get() == {"answer": "Quercus"}
+
+
+def test_async_streamed_dict():
+    async def deltas():
+        yield {"answer": "Quer"}
+        yield {"answer": "cus"}
+
+    assert asyncio.run(AsyncStreamedDict(deltas()).get()) == {"answer": "Quercus"}
+
+
+def test_streamed_dicts_are_rendered_as_json_objects():
+    value = {"answer": StreamedDict(iter([{"text": "Quer", "count": 1}, {"text": "cus", "count": 2}]))}
+
+    assert "".join(stream_as_json(value)) == '{"answer":{"text":"Quercus","count":"2"}}'
+    assert to_json_value(value) == {"answer": {"text": "Quercus", "count": "2"}}
+
+
+def test_async_streamed_dicts_are_rendered_as_json_objects():
+    async def deltas():
+        yield {"text": "Quer"}
+        yield {"text": "cus"}
+
+    value = {"answer": AsyncStreamedDict(deltas())}
+
+    async def render():
+        return "".join([chunk async for chunk in astream_as_json(value)])
+
+    assert asyncio.run(render()) == '{"answer":{"text":"Quercus"}}'
+    assert to_json_value(value) == {"answer": {"text": "Quercus"}}
+
@@ -0,0 +1,26 @@
+from typing import Callable
+
+import httpx
+
+from idigbio_util import IDigBioClient
+
+
+def make_client(respond: Callable[[httpx.Request], httpx.Response], **kwargs) -> (IDigBioClient, list[httpx.Request]):
+    """
+    :param respond: Makes the response to each request sent by the client, or raises an exception to fail it
+    :param kwargs: Passed on to IDigBioClient, e.g. max_retries
+    :return: A client that answers its requests, synchronous and asynchronous, with respond instead of the iDigBio API,
+    and the requests it sent so far
+    """
+    requests = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return respond(request)
+
+    async def ahandle(request: httpx.Request) -> httpx.Response:
+        return handle(request)
+
+    client = IDigBioClient(**({"retry_backoff": 0} | kwargs), transport=httpx.MockTransport(handle),
+                           async_transport=httpx.MockTransport(ahandle))
+    return client, requests
@@ -0,0 +1,110 @@
+import pytest
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+import cancellation
+import metrics
+from nlp.ai import _instrument
+
+USAGE = {"prompt_tokens": 1200, "completion_tokens": 10, "total_tokens": 1210,
+         "prompt_tokens_details": {"cached_tokens": 1024}}
+
+
+def _completion():
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-123", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Hi"}}],
+        "usage": USAGE
+    })
+
+
+def _chunk(content: str = None, usage: dict = None):
+    choices = [] if content is None else [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-123", "object": "chat.completion.chunk", "created": 0, "model": "gpt-4o",
+        "choices": choices, "usage": usage
+    })
+
+
+def test_count_llm_calls():
+    create = _instrument(lambda **kwargs: kwargs["model"])
+
+    with metrics.track_turn() as turn:
+        assert create(model="gpt-4o") == "gpt-4o"
+        create(model="gpt-4o")
+
+    assert turn.get("llm.calls") == 2
+
+
+def test_record_cached_prompt_tokens():
+    create = _instrument(lambda **kwargs: _completion())
+
+    with metrics.track_turn() as turn:
+        create(model="gpt-4o")
+
+    assert turn.get("llm.prompt_tokens") == 1200
+    assert turn.get("llm.cached_prompt_tokens") == 1024
+    assert turn.get("llm.completion_tokens") == 10
+
+
+def test_record_usage_of_streams():
+    requests = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return iter([_chunk("Hello"), _chunk(" world"), _chunk(usage=USAGE)])
+
+    with metrics.track_turn() as turn:
+        chunks = list(_instrument(create)(model="gpt-4o", stream=True))
+
+    assert requests[0]["stream_options"] == {"include_usage": True}
+    assert [c.choices[0].delta.content for c in chunks] == ["Hello", " world"]
+    assert turn.get("llm.cached_prompt_tokens") == 1024
+    assert metrics.get_histogram("llm.time_to_first_token_seconds")["count"] >= 1
+
+
+class _Stream:
+    def __init__(self, chunks: list):
+        self.chunks = iter(chunks)
+        self.closed = False
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        self.closed = True
+
+
+def test_cancelling_closes_streams():
+    stream = _Stream([_chunk("Hello"), _chunk(" world")])
+    scope = cancellation.CancelScope()
+
+    with metrics.track_turn() as turn, cancellation.activate(scope):
+        chunks = _instrument(lambda **kwargs: stream)(model="gpt-4o", stream=True)
+        next(chunks)
+        scope.cancel()
+        chunks.close()
+
+    assert stream.closed
+    assert turn.get("llm.cancelled_streams") == 1
+
+
+def test_cancelling_closes_streams_that_were_not_read_yet():
+    stream = _Stream([_chunk("Hello")])
+    scope = cancellation.CancelScope()
+
+    with cancellation.activate(scope):
+        _instrument(lambda **kwargs: stream)(model="gpt-4o", stream=True)
+    scope.cancel()
+
+    assert stream.closed
+
+
+def test_no_calls_are_made_for_cancelled_turns():
+    scope = cancellation.CancelScope()
+    scope.cancel()
+
+    with metrics.track_turn() as turn, cancellation.activate(scope), pytest.raises(cancellation.Cancelled):
+        _instrument(lambda **kwargs: _completion())(model="gpt-4o")
+
+    assert turn.get("llm.calls") == 0
+    assert turn.get("llm.cancelled_calls") == 1
@@ -0,0 +1,159 @@
+import asyncio
+import json
+
+import pytest
+import sqlalchemy
+from sqlalchemy.pool import StaticPool
+
+import cancellation
+import chat.api
+import metrics
+from app import create_app
+from asgi import ChatServer
+from chat.api import HELP_MESSAGE
+from chat.messages import AiChatMessage
+from storage.database import DatabaseEngine
+
+
+@pytest.fixture(params=[{"SAFE_MODE": False}])
+def server(request):
+    # Chat requests touch the database from worker threads, which must all see the same in-memory database
+    engine = sqlalchemy.create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    app = create_app(config_dict={"CHAT": {"SHOW_INTRO_MESSAGE": True} | request.param, "METRICS_TOKEN": "secret"},
+                     database=DatabaseEngine(engine))
+    return ChatServer(app)
+
+
+def _request(server, method: str, path: str, body: dict = None, headers: list = (),
+             disconnect_on: bytes = None) -> (int, dict, bytes):
+    """
+    :param disconnect_on: Disconnect once the body sent so far contains this instead of after the whole response
+    """
+    data = b"" if body is None else json.dumps(body).encode("utf-8")
+    scope = {
+        "type": "http", "http_version": "1.1", "method": method, "scheme": "http", "path": path, "root_path": "",
+        "query_string": b"", "server": ("localhost", 80), "client": ("127.0.0.1", 1234),
+        "headers": [(b"host", b"localhost"), (b"content-type", b"application/json"),
+                    (b"content-length", str(len(data)).encode()), *headers]
+    }
+    received = [{"type": "http.request", "body": data, "more_body": False}]
+    sent = []
+    disconnected = asyncio.Event()
+
+    async def receive():
+        if received:
+            return received.pop(0)
+        # Like ASGI servers, only report a disconnect once the response was sent or the client went away
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if message["type"] != "http.response.body":
+            return
+        body_messages = [m for m in sent if m["type"] == "http.response.body"]
+        if not message.get("more_body", False) or \
+                (disconnect_on is not None and disconnect_on in b"".join(m.get("body", b"") for m in body_messages)):
+            disconnected.set()
+
+    # Fail rather than hang if the server never returns
+    asyncio.run(asyncio.wait_for(server(scope, receive, send), 5))
+
+    start = next(m for m in sent if m["type"] == "http.response.start")
+    headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    body = b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+    return start["status"], headers, body
+
+
+@pytest.mark.parametrize("server", [{"SAFE_MODE": True}], indirect=True)
+def test_chat_intro_and_robot_check(server):
+    status, headers, body = _request(server, "POST", "/chat", {"type": "user_text_message", "value": ""})
+
+    assert status == 200
+    assert headers["content-type"] == "application/json"
+    messages = json.loads(body)
+    assert messages[0]["value"] == HELP_MESSAGE
+    assert "please confirm you are a real person" in messages[1]["value"]
+
+
+def test_chat_ping(server):
+    status, headers, body = _request(server, "POST", "/chat", {"type": "user_text_message", "value": "ping"})
+
+    assert status == 200
+    assert "set-cookie" in headers
+    assert [m["value"] for m in json.loads(body)] == ["pong"]
+
+
+def test_chat_ping_as_server_sent_events(server):
+    status, headers, body = _request(server, "POST", "/chat", {"type": "user_text_message", "value": "ping"},
+                                     headers=[(b"accept", b"text/event-stream")])
+
+    assert status == 200
+    assert headers["content-type"].startswith("text/event-stream")
+    events = [json.loads(line[len("data: "):]) for line in body.decode().splitlines() if line.startswith("data: ")]
+    assert [e["value"] for e in events if e["event"] == "message"] == ["pong"]
+    assert events[-1] == {"event": "done"}
+
+
+@pytest.mark.parametrize("server", [{"SAFE_MODE": False, "HEARTBEAT": 0.01}], indirect=True)
+@pytest.mark.parametrize("accept", [b"application/x-ndjson", b"text/event-stream"])
+def test_turn_context_lasts_across_heartbeats(server, monkeypatch, accept):
+    contexts = []
+
+    async def make_response(ai, conversation, user_message, *args):
+        for text in ["first", "second", "third"]:
+            contexts.append((metrics.current_turn(), cancellation.current_scope()))
+            await asyncio.sleep(0.03)
+            yield AiChatMessage(text)
+
+    monkeypatch.setattr(chat.api, "_amake_response", make_response)
+
+    status, _, body = _request(server, "POST", "/chat", {"type": "user_text_message", "value": "hi"},
+                               headers=[(b"accept", accept)])
+
+    assert status == 200
+    assert b"heartbeat" in body and b"third" in body
+    assert len(contexts) == 3
+    assert all(turn is contexts[0][0] and scope is contexts[0][1] for turn, scope in contexts)
+    assert None not in contexts[0]
+
+
+@pytest.mark.parametrize("server", [{"SAFE_MODE": False, "HEARTBEAT": 0.01}], indirect=True)
+@pytest.mark.parametrize("accept", [b"application/json", b"application/x-ndjson", b"text/event-stream"])
+def test_disconnecting_cancels_the_turn(server, monkeypatch, accept):
+    responded = []
+
+    async def make_response(ai, conversation, user_message, *args):
+        yield AiChatMessage("first")
+        await asyncio.sleep(10)
+        responded.append(True)
+        yield AiChatMessage("never sent")
+
+    monkeypatch.setattr(chat.api, "_amake_response", make_response)
+
+    status, _, body = _request(server, "POST", "/chat", {"type": "user_text_message", "value": "hi"},
+                               headers=[(b"accept", accept)], disconnect_on=b"first")
+
+    assert status == 200
+    assert b"first" in body
+    assert b"never sent" not in body
+    assert responded == []
+
+
+def test_chat_unauthorized(server):
+    status, _, _ = _request(server, "POST", "/chat-protected", {"type": "user_text_message", "value": "LET ME IN!!!"})
+
+    assert status == 401
+
+
+def test_other_routes_are_served_by_flask(server):
+    status, _, body = _request(server, "GET", "/metrics", headers=[(b"authorization", b"Bearer secret")])
+
+    assert status == 200
+    assert "counters" in json.loads(body)
+
+
+def test_metrics_need_token(server):
+    status, _, _ = _request(server, "GET", "/metrics")
+
+    assert status == 401
@@ -0,0 +1,141 @@
+import asyncio
+import contextvars
+import threading
+
+import pytest
+
+import cancellation
+import metrics
+from cancellation import CancelScope, Cancelled
+
+
+class Stream:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_cancel_closes_registered_resources():
+    scope = CancelScope()
+    registered, discarded = Stream(), Stream()
+    scope.add(registered)
+    scope.add(discarded)
+    scope.discard(discarded)
+
+    scope.cancel()
+
+    assert scope.cancelled
+    assert registered.closed
+    assert not discarded.closed
+
+
+def test_resources_added_after_cancelling_are_closed():
+    scope = CancelScope()
+    scope.cancel()
+
+    stream = Stream()
+    scope.add(stream)
+
+    assert stream.closed
+
+
+def test_check_counts_skipped_work():
+    scope = CancelScope()
+    scope.check("test.skipped")
+    scope.cancel()
+
+    with metrics.track_turn() as turn, pytest.raises(Cancelled):
+        scope.check("test.skipped")
+
+    assert turn.get("test.skipped") == 1
+
+
+def test_scope_is_seen_by_threads_with_a_copy_of_the_context():
+    scope = CancelScope()
+    seen = []
+
+    def run():
+        seen.append(cancellation.current_scope())
+
+    with cancellation.activate(scope):
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(run,))
+        thread.start()
+        thread.join()
+
+    assert seen == [scope]
+    assert cancellation.current_scope() is None
+
+
+def test_cancellable_stops_between_items():
+    closed = []
+
+    def items():
+        try:
+            yield 1
+            yield 2
+        finally:
+            closed.append(True)
+
+    scope = CancelScope()
+    with cancellation.activate(scope):
+        stream = cancellation.cancellable(items())
+
+    assert next(stream) == 1
+    scope.cancel()
+    with pytest.raises(Cancelled):
+        next(stream)
+    assert closed == [True]
+
+
+def test_acancellable_stops_between_items():
+    closed = []
+
+    async def items():
+        try:
+            yield 1
+            yield 2
+        finally:
+            closed.append(True)
+
+    async def consume():
+        scope = CancelScope()
+        with cancellation.activate(scope):
+            stream = cancellation.acancellable(items())
+
+        assert await anext(stream) == 1
+        scope.cancel()
+        with pytest.raises(Cancelled):
+            await anext(stream)
+
+    asyncio.run(consume())
+    assert closed == [True]
+
+
+def test_cancel_on_close():
+    scope = CancelScope()
+    stream = cancellation.cancel_on_close(iter("abc"), scope)
+
+    assert next(stream) == "a"
+    stream.close()
+
+    assert scope.cancelled
+
+
+def test_cancel_on_close_ignores_exhausted_streams():
+    scope = CancelScope()
+    assert list(cancellation.cancel_on_close(iter("abc"), scope)) == ["a", "b", "c"]
+    assert not scope.cancelled
+
+
+def test_child_scopes_are_cancelled_with_their_parent():
+    parent = CancelScope()
+    child = parent.child()
+    sibling = parent.child()
+
+    child.cancel()
+    assert child.cancelled and not parent.cancelled and not sibling.cancelled
+
+    parent.cancel()
+    assert sibling.cancelled
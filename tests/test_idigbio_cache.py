@@ -0,0 +1,131 @@
+import asyncio
+import json
+import threading
+import time
+
+import fakeredis
+import httpx
+import pytest
+
+import idigbio_cache
+import metrics
+from idigbio_cache import IDigBioResponseCache
+from idigbio_test_util import make_client
+from idigbio_util import IDigBioClient, RedisFlightLocks, sanitize_json
+
+
+@pytest.fixture
+def cache():
+    return IDigBioResponseCache(fakeredis.FakeRedis(), stale_ttl=600)
+
+
+def _make_client(cache: IDigBioResponseCache, status_code: int = 200) -> (IDigBioClient, list):
+    def respond(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(status_code, json={"itemCount": len(requests)})
+
+    client, requests = make_client(respond, max_retries=0)
+    client.cache = cache
+    return client, requests
+
+
+def test_equivalent_queries_share_a_key(cache):
+    a = cache.make_key("/v2/search/records", sanitize_json({"rq": {"genus": "carex", "country": ""}, "limit": 10}))
+    b = cache.make_key("/v2/search/records", sanitize_json({"limit": 10, "rq": {"genus": "carex"}}))
+    c = cache.make_key("/v2/search/media", sanitize_json({"limit": 10, "rq": {"genus": "carex"}}))
+
+    assert a == b
+    assert a != c
+
+
+def test_downloads_are_never_cached(cache):
+    assert cache.make_key("/v2/download", {"rq": {"genus": "carex"}, "email": "a@b.c"}) is None
+
+
+def test_repeated_searches_skip_the_api(cache):
+    client, requests = _make_client(cache)
+    saved = metrics.get("idigbio_cache.saved_seconds")
+    hits = metrics.get("idigbio_cache.hits")
+
+    first = client.query("POST", "/v2/search/records", {"rq": {"genus": "carex"}})
+    second = client.query("POST", "/v2/search/records", {"rq": {"genus": "carex"}})
+
+    assert first == second == ("200 OK", True, {"itemCount": 1})
+    assert len(requests) == 1
+    assert metrics.get("idigbio_cache.hits") == hits + 1
+    assert metrics.get("idigbio_cache.saved_seconds") > saved
+
+
+def test_summary_queries_are_cached(cache):
+    client, requests = _make_client(cache)
+    params = {"rq": {"family": "ursidae"}, "top_fields": "genus"}
+
+    client.query("GET", "/v2/summary/top/records", params)
+    client.query("GET", "/v2/summary/top/records", params)
+
+    assert len(requests) == 1
+    assert dict(requests[0].url.params) == {"rq": '{"family":"ursidae"}', "top_fields": '"genus"'}
+
+
+def test_queries_that_differ_after_special_characters_have_their_own_keys(cache):
+    client, requests = _make_client(cache)
+
+    first = client.query("GET", "/v2/summary/top/records", {"rq": {"locality": "Smith & Sons #1"}})
+    second = client.query("GET", "/v2/summary/top/records", {"rq": {"locality": "Smith & Sons #2"}})
+
+    assert first != second
+    assert [json.loads(r.url.params["rq"]) for r in requests] == [{"locality": "Smith & Sons #1"},
+                                                                  {"locality": "Smith & Sons #2"}]
+
+
+def test_failed_responses_are_not_cached(cache):
+    client, requests = _make_client(cache, status_code=400)
+
+    client.query("POST", "/v2/search/records", {"rq": {"genus": "carex"}})
+    client.query("POST", "/v2/search/records", {"rq": {"genus": "carex"}})
+
+    assert len(requests) == 2
+
+
+def test_serve_stale_while_revalidating(cache, monkeypatch):
+    client, requests = _make_client(cache)
+    client.query("POST", "/v2/search/media", {"rq": {"genus": "carex"}})
+
+    now = time.time()
+    monkeypatch.setattr(idigbio_cache.time, "time", lambda: now + 3700)
+    stale = client.query("POST", "/v2/search/media", {"rq": {"genus": "carex"}})
+
+    assert stale == ("200 OK", True, {"itemCount": 1})
+    for _ in range(100):
+        if len(requests) == 2:
+            break
+        time.sleep(0.01)
+    assert len(requests) == 2
+
+
+def test_async_queries_use_the_cache(cache):
+    client, requests = _make_client(cache)
+
+    async def query_twice():
+        await client.aquery("POST", "/v2/search/records", {"rq": {"genus": "carex"}})
+        return await client.aquery("POST", "/v2/search/records", {"rq": {"genus": "carex"}})
+
+    assert asyncio.run(query_twice()) == ("200 OK", True, {"itemCount": 1})
+    assert len(requests) == 1
+
+
+def test_wait_for_other_processes_to_fetch_the_same_query(cache):
+    client, requests = _make_client(cache)
+    client.flight_locks = RedisFlightLocks(cache.redis, timeout=5, poll_interval=0.01)
+
+    params = {"rq": {"genus": "carex"}}
+    key = cache.make_key("/v2/search/records", params)
+    token = client.flight_locks.acquire(key)
+
+    def finish_fetching_elsewhere():
+        cache.set(key, "/v2/search/records", "200 OK", {"itemCount": 99}, 0.5)
+        client.flight_locks.release(key, token)
+
+    threading.Timer(0.05, finish_fetching_elsewhere).start()
+
+    assert client.query("POST", "/v2/search/records", params) == ("200 OK", True, {"itemCount": 99})
+    assert len(requests) == 0
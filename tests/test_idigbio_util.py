@@ -1,6 +1,19 @@
+import asyncio
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from idigbio_util import url_encode_params, percent_decode, percent_encode
+import fakeredis
+import httpx
+import pytest
+
+import cancellation
+import idigbio_util
+import metrics
+from idigbio_test_util import make_client
+from idigbio_util import url_encode_params, percent_decode, percent_encode, IDigBioClient, SingleFlight, \
+    RedisFlightLocks
 
 
 def test_encode_url_with_nested():
@@ -25,3 +38,353 @@ def test_percent_decode_json():
     s = "%7B%22rq%22:%20%7B%22name%22:%20%22bob%22,%20%22amount%22:%203.5%7D,%20%22limit%22:%205%7D"
     d = json.loads(percent_decode(s))
     assert d == {"rq": {"name": "bob", "amount": 3.5}, "limit": 5}
+
+
+def _make_client(responses: list, **kwargs) -> (IDigBioClient, list):
+    """
+    :param responses: Status codes, or exceptions to raise, for the client to receive in order
+    """
+    responses = iter(responses)
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        response = next(responses)
+        if isinstance(response, Exception):
+            raise response
+        return httpx.Response(response, json={"itemCount": 1})
+
+    return make_client(respond, **kwargs)
+
+
+def test_retry_server_errors():
+    client, requests = _make_client([503, 429, 200])
+
+    response = client.request("POST", "/v2/search/records", json={"rq": {"genus": "acer"}})
+
+    assert response.status_code == 200
+    assert len(requests) == 3
+    assert all(r.url == "https://search.idigbio.org/v2/search/records" for r in requests)
+
+
+def test_no_requests_are_sent_for_cancelled_turns():
+    client, requests = _make_client([200])
+    scope = cancellation.CancelScope()
+    scope.cancel()
+
+    with metrics.track_turn() as turn, cancellation.activate(scope), pytest.raises(cancellation.Cancelled):
+        client.request("POST", "/v2/search/records", json={"rq": {"genus": "acer"}})
+
+    assert len(requests) == 0
+    assert turn.get("idigbio.cancelled_requests") == 1
+
+
+def test_no_async_requests_are_sent_for_cancelled_turns():
+    client, requests = _make_client([200])
+    scope = cancellation.CancelScope()
+    scope.cancel()
+
+    with metrics.track_turn() as turn, cancellation.activate(scope), pytest.raises(cancellation.Cancelled):
+        asyncio.run(client.arequest("POST", "/v2/search/records", json={"rq": {"genus": "acer"}}))
+
+    assert len(requests) == 0
+    assert turn.get("idigbio.cancelled_requests") == 1
+
+
+def test_retries_stop_once_the_turn_is_cancelled():
+    scope = cancellation.CancelScope()
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        scope.cancel()
+        return httpx.Response(503)
+
+    client, requests = make_client(respond, max_retries=3)
+
+    with cancellation.activate(scope), pytest.raises(cancellation.Cancelled):
+        asyncio.run(client.arequest("POST", "/v2/search/records", json={}))
+
+    assert len(requests) == 1
+
+
+def test_give_up_after_max_retries():
+    client, requests = _make_client([500, 500, 500], max_retries=2)
+
+    response = client.request("GET", "/v2/summary/top/records")
+
+    assert response.status_code == 500
+    assert len(requests) == 3
+
+
+def test_only_retry_unsent_requests_that_are_not_idempotent():
+    client, requests = _make_client([httpx.ConnectError("refused"), 503, 200])
+
+    response = client.request("POST", "/v2/download", json={}, idempotent=False)
+
+    assert response.status_code == 503
+    assert len(requests) == 2
+
+
+def test_raise_transport_errors_after_max_retries():
+    client, requests = _make_client([httpx.ReadTimeout("slow")] * 2, max_retries=1)
+
+    with pytest.raises(httpx.ReadTimeout):
+        client.request("POST", "/v2/search/media", json={})
+    assert len(requests) == 2
+
+
+def test_record_latency_per_endpoint():
+    client, _ = _make_client([200])
+    before = (metrics.get_histogram("idigbio.latency_seconds.v2.search.records") or {"count": 0})["count"]
+
+    client.request("POST", "https://search.idigbio.org/v2/search/records", json={})
+
+    assert metrics.get_histogram("idigbio.latency_seconds.v2.search.records")["count"] == before + 1
+
+
+def test_retry_async():
+    client, requests = _make_client([502, 200])
+
+    response = asyncio.run(client.arequest("POST", "/v2/search/records", json={}))
+
+    assert response.json() == {"itemCount": 1}
+    assert len(requests) == 2
+
+
+def test_count_records_without_downloading_them(monkeypatch):
+    client, requests = _make_client([200])
+    monkeypatch.setattr(idigbio_util, "client", client)
+
+    code, success, count = idigbio_util.count_idigbio_records("/v2/search/records",
+                                                              {"rq": {"genus": "carex"}, "limit": 100})
+
+    assert (code, success, count) == ("200 OK", True, 1)
+    assert requests[0].url.path == "/v2/summary/count/records"
+    assert json.loads(requests[0].content) == {"rq": {"genus": "carex"}}
+
+
+def test_count_records_with_special_characters(monkeypatch):
+    client, requests = _make_client([200])
+    monkeypatch.setattr(idigbio_util, "client", client)
+    rq = {"locality": "Smith & Sons #2 + co", "hasImage": True, "maxelevation": {"type": "range", "gte": 10.5}}
+
+    asyncio.run(idigbio_util.count_idigbio_records_async("/v2/search/media", {"rq": rq, "mq": {"hasSpecimen": False}}))
+
+    assert requests[0].url.path == "/v2/summary/count/media"
+    assert json.loads(requests[0].content) == {"rq": rq, "mq": {"hasSpecimen": False}}
+
+
+def test_identical_concurrent_queries_are_sent_once():
+    release = threading.Event()
+    requests = []
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        release.wait(5)
+        return httpx.Response(200, json={"itemCount": 7})
+
+    client = IDigBioClient(transport=httpx.MockTransport(respond))
+    collapsed = metrics.get("idigbio.single_flight.collapsed")
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(client.query, "POST", "/v2/search/records", {"rq": {"genus": "carex"}})
+                   for _ in range(5)]
+        while metrics.get("idigbio.single_flight.collapsed") < collapsed + 4:
+            time.sleep(0.01)
+        release.set()
+        results = [f.result() for f in futures]
+
+    assert len(requests) == 1
+    assert results == [("200 OK", True, {"itemCount": 7})] * 5
+
+
+def test_queries_that_are_not_idempotent_are_never_collapsed():
+    client, requests = _make_client([200, 200])
+
+    client.query("POST", "/v2/download", {"rq": {"genus": "carex"}}, idempotent=False)
+    client.query("POST", "/v2/download", {"rq": {"genus": "carex"}}, idempotent=False)
+
+    assert len(requests) == 2
+
+
+def test_single_flight_shares_errors():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("nope")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    assert flight.do("key", lambda: 1) == 1
+
+
+def test_async_single_flight():
+    flight = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def run():
+        return await asyncio.gather(*[flight.ado("key", work) for _ in range(3)])
+
+    assert asyncio.run(run()) == ["done"] * 3
+    assert len(calls) == 1
+
+
+def test_cancelled_queries_are_not_shared_with_other_turns():
+    first_request, release = threading.Event(), threading.Event()
+    requests = []
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if len(requests) == 1:
+            first_request.set()
+            release.wait(5)
+            return httpx.Response(503)
+        return httpx.Response(200, json={"itemCount": 7})
+
+    client = IDigBioClient(retry_backoff=0, transport=httpx.MockTransport(respond))
+    cancelled, other = cancellation.CancelScope(), cancellation.CancelScope()
+    collapsed = metrics.get("idigbio.single_flight.collapsed")
+
+    def query(scope):
+        with cancellation.activate(scope):
+            return client.query("POST", "/v2/search/records", {"rq": {"genus": "quercus"}})
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(query, cancelled)
+        first_request.wait(5)
+        follower = executor.submit(query, other)
+        while metrics.get("idigbio.single_flight.collapsed") < collapsed + 1:
+            time.sleep(0.01)
+
+        cancelled.cancel()
+        release.set()
+
+        with pytest.raises(cancellation.Cancelled):
+            leader.result(5)
+        assert follower.result(5) == ("200 OK", True, {"itemCount": 7})
+    assert len(requests) == 2
+
+
+def test_cancelled_async_queries_are_not_shared_with_other_tasks():
+    requests = []
+
+    async def respond(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if len(requests) == 1:
+            await asyncio.sleep(5)
+        return httpx.Response(200, json={"itemCount": 7})
+
+    client = IDigBioClient(async_transport=httpx.MockTransport(respond))
+
+    async def run():
+        query = lambda: client.aquery("POST", "/v2/search/records", {"rq": {"genus": "quercus"}})
+        leader = asyncio.create_task(query())
+        while not requests:
+            await asyncio.sleep(0.01)
+        follower = asyncio.create_task(query())
+        await asyncio.sleep(0.01)
+
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.wait_for(follower, 5)
+
+    assert asyncio.run(run()) == ("200 OK", True, {"itemCount": 7})
+    assert len(requests) == 2
+
+
+def test_redis_flight_locks():
+    locks = RedisFlightLocks(fakeredis.FakeRedis(), timeout=1, poll_interval=0.01)
+
+    token = locks.acquire("key")
+    assert token is not None
+    assert locks.acquire("key") is None
+
+    threading.Timer(0.05, locks.release, args=("key", token)).start()
+    locks.wait("key")
+    assert locks.acquire("key") is not None
+
+
+def test_stream_search_results(monkeypatch):
+    def respond(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=json.dumps({"itemCount": 5000, "items": [{"uuid": "a"}, {"uuid": "b"}]}))
+
+    monkeypatch.setattr(idigbio_util, "client", IDigBioClient(transport=httpx.MockTransport(respond)))
+
+    with idigbio_util.stream_idigbio_search("/v2/search/records", {"rq": {"genus": "carex"}}) as search:
+        assert search.success
+        assert search.item_count == 5000
+        assert list(search.items()) == [{"uuid": "a"}, {"uuid": "b"}]
+
+
+@pytest.mark.parametrize("body", [{"itemCount": 2, "items": [{"uuid": "a"}, {"uuid": "b"}]},
+                                  {"itemCount": 0, "items": []}])
+def test_query_parses_search_results_in_chunks(body):
+    raw = json.dumps(body).encode("utf-8")
+    client, _ = make_client(lambda request: httpx.Response(200, content=(raw[i:i + 3] for i in range(0, len(raw), 3))))
+
+    assert client.query("POST", "/v2/search/records", {"rq": {"genus": "carex"}}) == ("200 OK", True, body)
+
+
+def test_query_error_pages_that_are_not_json():
+    client, _ = make_client(lambda request: httpx.Response(502, content=b"<html>Bad Gateway</html>"), max_retries=0)
+
+    assert asyncio.run(client.aquery("POST", "/v2/search/records", {})) == ("502 Bad Gateway", False, {})
+
+
+def _make_records_client(total: int) -> (IDigBioClient, list):
+    def respond(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        offset, limit = body["offset"], body["limit"]
+        items = [{"uuid": str(i)} for i in range(offset, min(offset + limit, total))]
+        return httpx.Response(200, content=json.dumps({"itemCount": total, "items": items}))
+
+    return make_client(respond)
+
+
+def test_paginate_search(monkeypatch):
+    client, requests = _make_records_client(total=25)
+    monkeypatch.setattr(idigbio_util, "client", client)
+
+    pages = list(idigbio_util.paginate_idigbio_search("/v2/search/records", {"rq": {"genus": "carex"}},
+                                                      page_size=10))
+
+    assert [p.offset for p in pages] == [0, 10, 20]
+    assert [len(p.items) for p in pages] == [10, 10, 5]
+    assert [json.loads(r.content)["offset"] for r in requests] == [0, 10, 20]
+
+
+def test_paginate_search_stops_at_max_records(monkeypatch):
+    client, requests = _make_records_client(total=1000)
+    monkeypatch.setattr(idigbio_util, "client", client)
+
+    pages = list(idigbio_util.paginate_idigbio_search("/v2/search/records", {}, page_size=10, max_records=15))
+
+    assert sum(len(p.items) for p in pages) == 15
+    assert [json.loads(r.content)["limit"] for r in requests] == [10, 5]
+
+
+def test_paginate_search_prefetches_a_bounded_number_of_pages(monkeypatch):
+    client, requests = _make_records_client(total=1000)
+    monkeypatch.setattr(idigbio_util, "client", client)
+
+    pages = idigbio_util.paginate_idigbio_search("/v2/search/records", {}, page_size=10, prefetch=2)
+    next(pages)
+    time.sleep(0.2)
+
+    # One page consumed, two queued and one waiting for room in the queue
+    assert len(requests) == 4
+
+    pages.close()
+    time.sleep(0.2)
+    assert len(requests) == 4
+
+
+def test_paginate_search_raises_api_errors(monkeypatch):
+    client, _ = _make_client([400])
+    monkeypatch.setattr(idigbio_util, "client", client)
+
+    with pytest.raises(idigbio_util.IDigBioError):
+        list(idigbio_util.paginate_idigbio_search("/v2/search/records", {}))
@@ -0,0 +1,39 @@
+import os
+
+from nlp.intent_classifier import IntentClassifier, extract_features, read_examples
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), "..", "backend", "resources", "tool_examples.jsonl")
+MODEL = os.path.join(os.path.dirname(__file__), "..", "backend", "resources", "tool_classifier.npz")
+
+
+def test_extract_features():
+    assert extract_features("Map of Map of") == {"map": 2, "of": 2, "map of": 2, "of map": 1}
+
+
+def test_train_save_and_load(tmp_path):
+    texts, labels = read_examples(EXAMPLES)
+    model = IntentClassifier.train(texts, labels)
+
+    path = str(tmp_path / "model.npz")
+    model.save(path)
+    loaded = IntentClassifier.load(path)
+
+    assert loaded.labels == model.labels
+    for text in texts[:10]:
+        assert loaded.predict(text) == model.predict(text)
+
+
+def test_shipped_model_picks_tools():
+    model = IntentClassifier.load(MODEL)
+
+    assert model.predict("How many occurrence records of Acer rubrum are there?")[0] == \
+           "count_species_occurrence_records"
+    assert model.predict("Show me a map of Ursus arctos in Alaska")[0] == "show_map_of_species_occurrences"
+    assert model.predict("Find photos of Danaus plexippus")[0] == "search_media_records"
+
+
+def test_unknown_words_are_not_confident():
+    model = IntentClassifier.load(MODEL)
+
+    label, confidence = model.predict("zzz qqq")
+    assert confidence < 0.5
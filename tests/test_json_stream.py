@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from json_stream import iter_object, IncrementalObjectParser
+
+DOCUMENT = {
+    "itemCount": 1234,
+    "items": [{"uuid": str(i), "data": {"dwc:genus": "Carex é", "n": i, "x": [1.5, None, True]}} for i in range(20)],
+    "attribution": [{"name": "FLMNH", "note": "a \\\"quoted\\\" {[brace]} \\\\"}],
+    "score": -12.5e3
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 100000])
+def test_stream_items_from_any_chunking(chunk_size):
+    raw = json.dumps(DOCUMENT).encode("utf-8")
+    chunks = [raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size)]
+
+    events = list(iter_object(chunks))
+
+    assert [v for k, v in events if k == "items"] == DOCUMENT["items"]
+    assert {k: v for k, v in events if k != "items"} == {k: v for k, v in DOCUMENT.items() if k != "items"}
+
+
+def test_emit_fields_before_the_rest_arrives():
+    parser = IncrementalObjectParser()
+
+    assert parser.feed(b'{"itemCount": 2, "items": [{"a"') == [("itemCount", 2)]
+    assert parser.feed(b': 1}, {"a": 2}') == [("items", {"a": 1}), ("items", {"a": 2})]
+    assert parser.feed(b"]}") == []
+    assert parser.close() == []
+
+
+def test_decode_each_item_once():
+    parser = IncrementalObjectParser()
+    decoded = []
+    decoder = parser._IncrementalObjectParser__decoder
+    parser._IncrementalObjectParser__decoder = type("Decoder", (), {
+        "raw_decode": lambda self, s, idx: decoded.append(idx) or decoder.raw_decode(s, idx)})()
+    raw = json.dumps({"items": [{"text": "x" * 1000, "nested": [{"a": "}"}]}]}).encode("utf-8")
+
+    events = [event for i in range(len(raw)) for event in parser.feed(raw[i:i + 1])] + parser.close()
+
+    assert events == [("items", {"text": "x" * 1000, "nested": [{"a": "}"}]})]
+    assert len(decoded) == 2  # The "items" key and the item
+
+
+def test_empty():
+    assert list(iter_object([b'{"items": [], "itemCount": 0}'])) == [("itemCount", 0)]
+    assert list(iter_object([b" {} "])) == []
+
+
+def test_remember_empty_streamed_arrays():
+    parser = IncrementalObjectParser(stream_keys=["items", "media"])
+    parser.feed(b'{"items": [], "itemCount": 0}')
+    parser.close()
+    assert parser.streamed_keys == {"items"}
+
+
+@pytest.mark.parametrize("raw", [b'{"a": 1', b"[1]", b'{"a" 1}', b'{"items": {"a": 1}}', b'{"a": 1}x', b'{"a": tru'])
+def test_invalid(raw):
+    with pytest.raises(ValueError):
+        list(iter_object([raw]))
@@ -0,0 +1,116 @@
+import fakeredis
+import pytest
+from openai.types.chat import ChatCompletion
+
+import metrics
+from chat.api import RequestBreakdown
+from nlp.llm_cache import LLMResponseCache, CachedClient
+from schema.idigbio.api import IDigBioRecordsApiParameters
+
+
+class FakeInstructor:
+    def __init__(self, response):
+        self.response = response
+        self.calls = 0
+
+    @property
+    def chat(self):
+        return self
+
+    @property
+    def completions(self):
+        return self
+
+    def create(self, response_model=None, **kwargs):
+        self.calls += 1
+        return self.response
+
+
+@pytest.fixture
+def cache():
+    return LLMResponseCache(fakeredis.FakeRedis(), ttl=60)
+
+
+def _ask(client, response_model, temperature=0, content="Find records of Carex"):
+    return client.chat.completions.create(
+        model="gpt-4o",
+        temperature=temperature,
+        response_model=response_model,
+        max_retries=3,
+        messages=[{"role": "user", "content": content}]
+    )
+
+
+def test_identical_requests_skip_the_llm(cache):
+    instructor = FakeInstructor(RequestBreakdown(requests=["Find records of Carex"]))
+    client = CachedClient(instructor, cache)
+    hits = metrics.get("llm_cache.hits")
+
+    first = _ask(client, RequestBreakdown)
+    second = _ask(client, RequestBreakdown)
+
+    assert instructor.calls == 1
+    assert second == first
+    assert metrics.get("llm_cache.hits") == hits + 1
+
+
+def test_different_requests_are_not_shared(cache):
+    instructor = FakeInstructor(RequestBreakdown(requests=["Find records of Carex"]))
+    client = CachedClient(instructor, cache)
+
+    _ask(client, RequestBreakdown)
+    _ask(client, RequestBreakdown, content="Find records of Quercus")
+    _ask(client, IDigBioRecordsApiParameters)
+
+    assert instructor.calls == 3
+
+
+def test_nonzero_temperature_is_not_cached(cache):
+    instructor = FakeInstructor(RequestBreakdown(requests=["Find records of Carex"]))
+    client = CachedClient(instructor, cache)
+
+    _ask(client, RequestBreakdown, temperature=1)
+    _ask(client, RequestBreakdown, temperature=1)
+
+    assert instructor.calls == 2
+
+
+def test_cached_response_is_revalidated(cache):
+    params = IDigBioRecordsApiParameters.model_validate({"rq": {"class": "Aves", "datecollected": "2001-02-03"}})
+    client = CachedClient(FakeInstructor(params), cache)
+
+    _ask(client, IDigBioRecordsApiParameters)
+    cached = _ask(client, IDigBioRecordsApiParameters)
+
+    assert cached.model_dump(exclude_none=True, by_alias=True) == params.model_dump(exclude_none=True, by_alias=True)
+
+
+def test_invalid_cached_response_is_a_miss(cache):
+    instructor = FakeInstructor(RequestBreakdown(requests=["Find records of Carex"]))
+    client = CachedClient(instructor, cache)
+    key = cache.make_key(RequestBreakdown, {"model": "gpt-4o", "temperature": 0,
+                                            "messages": [{"role": "user", "content": "Find records of Carex"}]})
+    cache.redis.set(key, '{"requests": "not a list"}')
+
+    response = _ask(client, RequestBreakdown)
+
+    assert instructor.calls == 1
+    assert response.requests == ["Find records of Carex"]
+    assert RequestBreakdown.model_validate_json(cache.redis.get(key)) == response
+
+
+def test_cache_raw_completions(cache):
+    completion = ChatCompletion.model_validate({
+        "id": "chatcmpl-123", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {
+            "role": "assistant", "content": None, "function_call": {"name": "converse", "arguments": "{}"}
+        }}]
+    })
+    instructor = FakeInstructor(completion)
+    client = CachedClient(instructor, cache)
+
+    _ask(client, None)
+    cached = _ask(client, None)
+
+    assert instructor.calls == 1
+    assert cached.choices[0].message.function_call.name == "converse"
@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import zipfile
+
+import pytest
+
+import local_occurrences
+from chat.processes import idigbio_records_summary
+from local_occurrences import LocalOccurrenceStore, LocalOccurrenceStores, UnsupportedQuery
+
+META_XML = """<?xml version="1.0" encoding="utf-8"?>
+<archive xmlns="http://rs.tdwg.org/dwc/text/">
+  <core encoding="UTF-8" fieldsTerminatedBy="\\t" linesTerminatedBy="\\n" fieldsEnclosedBy="" ignoreHeaderLines="1"
+        rowType="http://rs.tdwg.org/dwc/terms/Occurrence">
+    <files><location>occurrence.txt</location></files>
+    <id index="0"/>
+    <field index="1" term="http://rs.tdwg.org/dwc/terms/scientificName"/>
+    <field index="2" term="http://rs.tdwg.org/dwc/terms/stateProvince"/>
+    <field index="3" term="http://rs.tdwg.org/dwc/terms/eventDate"/>
+    <field index="4" term="http://rs.tdwg.org/dwc/terms/decimalLatitude"/>
+    <field index="5" term="http://rs.tdwg.org/dwc/terms/decimalLongitude"/>
+    <field index="6" term="http://rs.tdwg.org/dwc/terms/minimumElevationInMeters"/>
+  </core>
+</archive>
+"""
+
+ROWS = [
+    ["a", "Carex lurida", "Florida", "1950-06-01T00:00:00", "29.65", "-82.32", "10"],
+    ["b", "Carex lurida", "Florida", "2001-04-12", "30.44", "-84.28", ""],
+    ["c", "Quercus virginiana", "Florida", "", "", "", "120"],
+]
+
+
+@pytest.fixture
+def store(tmp_path) -> LocalOccurrenceStore:
+    archive_path = tmp_path / "archive.zip"
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        archive.writestr("meta.xml", META_XML)
+        lines = ["id\tscientificName\tstateProvince\teventDate\tlat\tlon\televation"] + ["\t".join(r) for r in ROWS]
+        archive.writestr("occurrence.txt", "\n".join(lines) + "\n")
+
+    store_path = str(tmp_path / "florida.sqlite")
+    assert local_occurrences.ingest_dwca(str(archive_path), store_path, {"stateprovince": "florida"},
+                                         batch_size=2) == 3
+    return LocalOccurrenceStore(store_path)
+
+
+def test_ingest_archive_without_meta(tmp_path):
+    archive_path = tmp_path / "archive.zip"
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        archive.writestr("occurrence.txt", 'idigbio:uuid,dwc:genus,idigbio:geoPoint\n'
+                                           'a,Carex,"{""lat"": 29.6, ""lon"": -82.3}"\n')
+
+    store_path = str(tmp_path / "store.sqlite")
+    local_occurrences.ingest_dwca(str(archive_path), store_path)
+
+    assert LocalOccurrenceStore(store_path).search({}) == [
+        {"uuid": "a", "genus": "carex", "geopoint": {"lat": 29.6, "lon": -82.3}}]
+
+
+def test_search(store):
+    assert store.search({"scientificname": "carex lurida", "datecollected": {"type": "range", "gte": "2000-01-01"}}) \
+           == [{"uuid": "b", "scientificname": "carex lurida", "stateprovince": "florida", "datecollected": "2001-04-12",
+                "eventdate": "2001-04-12", "geopoint": {"lat": 30.44, "lon": -84.28}}]
+
+
+def test_count(store):
+    assert store.count({}) == 3
+    assert store.count({"scientificname": ["carex lurida", "quercus virginiana"]}) == 3
+    assert store.count({"geopoint": {"type": "exists"}}) == 2
+    assert store.count({"minelevation": {"type": "range", "gte": 100}}) == 1
+    assert store.count({"geopoint": {"type": "geo_distance", "distance": "10km", "lat": 29.6, "lon": -82.3}}) == 1
+    assert store.count({"geopoint": {"type": "geo_bounding_box", "top_left": {"lat": 31, "lon": -85},
+                                     "bottom_right": {"lat": 30, "lon": -84}}}) == 1
+
+
+def test_top_counts(store):
+    assert store.top_counts({"stateprovince": "Florida"}, "scientificname", 1) == {
+        "itemCount": 3,
+        "scientificname": {"carex lurida": {"itemCount": 2}}
+    }
+
+
+def test_unsupported_queries(store):
+    with pytest.raises(UnsupportedQuery):
+        store.count({"data.dwc:habitat": "swamp"})
+    with pytest.raises(UnsupportedQuery):
+        store.top_counts({}, "geopoint")
+    with pytest.raises(UnsupportedQuery):
+        store.count({"datecollected": {"type": "range", "gte": "2020"}})
+    with pytest.raises(UnsupportedQuery):
+        store.count({"minelevation": {"type": "range", "lte": "high"}})
+    with pytest.raises(UnsupportedQuery):
+        store.count({"datecollected": "2020-06"})
+    with pytest.raises(UnsupportedQuery):
+        store.count({"minelevation": ["10", "high"]})
+
+
+def test_store_covers_narrower_queries(store):
+    assert store.covers({"stateprovince": "Florida", "genus": "carex"})
+    assert not store.covers({"genus": "carex"})
+    assert not store.covers({"stateprovince": "georgia"})
+
+
+def test_summary_uses_local_store(store, monkeypatch):
+    stores = LocalOccurrenceStores()
+    stores.stores = [store]
+    monkeypatch.setattr(local_occurrences, "stores", stores)
+
+    class Process:
+        def note(self, text):
+            pass
+
+    params = {"rq": {"stateprovince": "florida"}, "top_fields": "scientificname", "count": 5}
+    total, counts = idigbio_records_summary._query_local_store(Process(), params)
+
+    assert total == 3
+    assert counts["scientificname"] == {"carex lurida": {"itemCount": 2}, "quercus virginiana": {"itemCount": 1}}
+    assert idigbio_records_summary._query_local_store(Process(), params | {"rq": {"genus": "carex"}}) is None
+
+
+def test_async_summary_counts_local_records_off_the_event_loop(store, monkeypatch):
+    stores = LocalOccurrenceStores()
+    stores.stores = [store]
+    monkeypatch.setattr(local_occurrences, "stores", stores)
+
+    async def generate_parameters(ai, conversation, request):
+        return {"rq": {"stateprovince": "florida"}, "top_fields": "scientificname", "count": 5}
+
+    monkeypatch.setattr(idigbio_records_summary, "_agenerate_records_summary_parameters", generate_parameters)
+
+    query_local_store = idigbio_records_summary._query_local_store
+    threads = []
+
+    def query_local_store_in_thread(process, params):
+        threads.append(threading.current_thread())
+        return query_local_store(process, params)
+
+    monkeypatch.setattr(idigbio_records_summary, "_query_local_store", query_local_store_in_thread)
+
+    async def run():
+        process = idigbio_records_summary.AsyncIDigBioRecordsSummary(None, None, "Count records in Florida")
+        return await process.results()
+
+    results = asyncio.run(run())
+
+    assert results.total_count == 3
+    assert [t is threading.main_thread() for t in threads] == [False]
@@ -0,0 +1,27 @@
+import metrics
+
+
+def test_track_turn():
+    before = metrics.get("test.things")
+
+    with metrics.track_turn() as turn:
+        metrics.increment("test.things")
+        metrics.increment("test.things", 2)
+
+    metrics.increment("test.things")
+
+    assert turn.get("test.things") == 3
+    assert turn.get("test.other_things") == 0
+    assert metrics.get("test.things") == before + 4
+
+
+def test_nested_turns():
+    with metrics.track_turn() as outer:
+        with metrics.track_turn() as inner:
+            metrics.increment("test.nested")
+        metrics.increment("test.nested")
+
+    assert inner.get("test.nested") == 1
+    assert outer.get("test.nested") == 1
+    assert metrics.current_turn() is None
+
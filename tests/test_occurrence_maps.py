@@ -0,0 +1,167 @@
+import json
+import os
+import time
+
+import fakeredis
+import httpx
+import numpy as np
+
+import idigbio_util
+import occurrence_maps
+import vector_tiles
+from idigbio_test_util import make_client
+from idigbio_util import IDigBioClient
+from occurrence_maps import GeohashGridCache, TileDiskCache
+
+
+def _make_client(mapping_status: int = 404, tile: dict = None, points: list = ()) -> (IDigBioClient, list):
+    def respond(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/v2/mapping/":
+            return httpx.Response(mapping_status, json={"shortCode": "abc"})
+        if request.url.path.startswith("/v2/mapping/abc/"):
+            return httpx.Response(200, json=tile)
+
+        params = json.loads(request.content)
+        page = points[params["offset"]:params["offset"] + params["limit"]]
+        return httpx.Response(200, json={
+            "itemCount": len(points),
+            "items": [{"indexTerms": {"geopoint": {"lat": lat, "lon": lon}}} for lat, lon in page]
+        })
+
+    return make_client(respond, max_retries=0)
+
+
+def test_encode_geohashes():
+    codes = occurrence_maps.encode_geohashes(np.array([57.64911, 42.6]), np.array([10.40744, -5.6]), 5)
+    assert [occurrence_maps.geohash_to_string(int(c), 5) for c in codes] == ["u4pru", "ezs42"]
+
+
+def test_decode_geohash_centers():
+    lats, lons = occurrence_maps.decode_geohash_centers(np.array([occurrence_maps.geohash_from_string("ezs42")]), 5)
+    assert abs(lats[0] - 42.605) < 0.01
+    assert abs(lons[0] + 5.603) < 0.01
+
+
+def test_aggregate_geohash_counts_rolls_up_finer_cells():
+    buckets = occurrence_maps.aggregate_geohash_counts({"ezs42": 3, "ezs4b": 2, "u4pru": 1}, 3)
+    assert [(b.geohash, b.count) for b in buckets] == [("ezs", 5), ("u4p", 1)]
+
+
+def test_grid_falls_back_to_local_aggregation(monkeypatch):
+    client, _ = _make_client(points=[(42.6, -5.6), (42.61, -5.61), (-10, 20)])
+    monkeypatch.setattr(idigbio_util, "client", client)
+
+    grid = occurrence_maps.get_geohash_grid({"genus": "carex"}, zoom=0)
+
+    assert grid.source == "local"
+    assert grid.item_count == 3
+    assert [(b.geohash, b.count) for b in grid.buckets] == [("ez", 2), ("kq", 1)]
+
+
+def test_local_aggregation_stops_at_the_search_window(monkeypatch):
+    client, requests = _make_client(points=[(42.6, -5.6), (42.61, -5.61), (-10, 20)])
+    monkeypatch.setattr(idigbio_util, "client", client)
+    monkeypatch.setattr(idigbio_util, "SEARCH_WINDOW", 2)
+
+    grid = occurrence_maps.get_geohash_grid({"genus": "carex"}, zoom=0, max_records=100000)
+
+    assert grid.item_count == 2
+    assert grid.truncated
+    assert all(params["offset"] + params["limit"] <= 2 for params in
+               [json.loads(r.content) for r in requests if r.url.path == "/v2/search/records"])
+
+
+def test_local_aggregation_keeps_geopoint_filters(monkeypatch):
+    client, requests = _make_client(points=[(42.6, -5.6)])
+    monkeypatch.setattr(idigbio_util, "client", client)
+    box = {"type": "geo_bounding_box", "top_left": {"lat": 50, "lon": -10}, "bottom_right": {"lat": 40, "lon": 0}}
+
+    occurrence_maps.aggregate_records_locally({"genus": "carex", "geopoint": box}, 2)
+
+    assert [json.loads(r.content)["rq"] for r in requests if r.url.path == "/v2/search/records"] == \
+           [{"genus": "carex", "geopoint": box}]
+
+
+def test_grid_uses_idigbio_aggregation(monkeypatch):
+    tile = {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {"geohash": "ezs", "itemCount": 4}},
+        {"type": "Feature", "properties": {"geohash": "ezt", "itemCount": 1}},
+    ]}
+    client, requests = _make_client(mapping_status=200, tile=tile)
+    monkeypatch.setattr(idigbio_util, "client", client)
+
+    grid = occurrence_maps.get_geohash_grid({"genus": "carex"}, zoom=0)
+
+    assert grid.source == "idigbio"
+    assert [(b.geohash, b.count) for b in grid.buckets] == [("ez", 5)]
+    assert not any(r.url.path == "/v2/search/records" for r in requests)
+
+
+def test_grid_is_cached_per_query_and_precision(monkeypatch):
+    client, requests = _make_client(points=[(42.6, -5.6)])
+    monkeypatch.setattr(idigbio_util, "client", client)
+    cache = GeohashGridCache(fakeredis.FakeRedis(), ttl=60)
+
+    first = occurrence_maps.get_geohash_grid({"genus": "carex"}, zoom=0, cache=cache)
+    request_count = len(requests)
+    second = occurrence_maps.get_geohash_grid({"genus": "carex"}, zoom=1, cache=cache)
+
+    assert second == first
+    assert len(requests) == request_count
+
+    occurrence_maps.get_geohash_grid({"genus": "carex"}, zoom=8, cache=cache)
+    assert len(requests) > request_count
+
+
+def test_tile_query_adds_bounding_box():
+    query = occurrence_maps.make_tile_query({"genus": "carex"}, 1, 1, 0)
+    box = query["geopoint"]
+
+    assert query["genus"] == "carex"
+    assert box["type"] == "geo_bounding_box"
+    assert box["top_left"]["lon"] < 0 < box["bottom_right"]["lon"] == 180
+    assert box["bottom_right"]["lat"] < 0 < box["top_left"]["lat"]
+
+
+def test_tile_query_keeps_geopoint_filters():
+    rq = {"geopoint": {"type": "geo_distance", "distance": "100km", "lat": 10, "lon": 10}}
+    assert occurrence_maps.make_tile_query(rq, 1, 1, 0) == rq
+
+
+def test_tile_drops_points_outside_it(monkeypatch):
+    client, _ = _make_client(points=[(10, 10), (-10, -10)])
+    monkeypatch.setattr(idigbio_util, "client", client)
+
+    encoded = []
+    monkeypatch.setattr(vector_tiles, "encode_points", lambda name, points: encoded.extend(points))
+
+    occurrence_maps.build_occurrence_tile({"geopoint": {"type": "geo_distance"}}, 1, 1, 0)
+
+    assert encoded == [(*vector_tiles.to_tile_coordinates(10, 10, 1, 1, 0), {"uuid": ""})]
+
+
+def test_tile_is_cached_on_disk(monkeypatch, tmp_path):
+    client, requests = _make_client(points=[(10, 10)])
+    monkeypatch.setattr(idigbio_util, "client", client)
+    cache = TileDiskCache(str(tmp_path), max_bytes=1024 * 1024)
+
+    first = occurrence_maps.get_occurrence_tile({"genus": "carex"}, 1, 1, 0, cache)
+    request_count = len(requests)
+    second = occurrence_maps.get_occurrence_tile({"genus": "carex"}, 1, 1, 0, cache)
+
+    assert second == first
+    assert len(requests) == request_count
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_tile_cache_evicts_least_recently_used(tmp_path):
+    cache = TileDiskCache(str(tmp_path), max_bytes=250)
+    cache.set("a", b"a" * 100)
+    cache.set("b", b"b" * 100)
+    time.sleep(0.01)
+    cache.get("a")
+    cache.set("c", b"c" * 100)
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
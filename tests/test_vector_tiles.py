@@ -0,0 +1,64 @@
+import vector_tiles
+
+
+def _read_varint(data: bytes, pos: int) -> (int, int):
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        value |= (byte & 0x7F) << shift
+        pos += 1
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _read_message(data: bytes) -> list[tuple[int, int | bytes]]:
+    fields, pos = [], 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        if key & 7 == 0:
+            value, pos = _read_varint(data, pos)
+        else:
+            length, pos = _read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        fields.append((key >> 3, value))
+    return fields
+
+
+def _read_packed(data: bytes) -> list[int]:
+    values, pos = [], 0
+    while pos < len(data):
+        value, pos = _read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def test_tile_bounds():
+    assert vector_tiles.tile_bounds(0, 0, 0) == (-180, -85.0511287798066, 180, 85.0511287798066)
+    west, south, east, north = vector_tiles.tile_bounds(1, 1, 0)
+    assert (west, south, east) == (0, 0, 180)
+
+
+def test_to_tile_coordinates():
+    assert vector_tiles.to_tile_coordinates(0, 0, 0, 0, 0) == (2048, 2048)
+    assert vector_tiles.to_tile_coordinates(-90, 45, 1, 0, 0) == (2048, 2947)
+
+
+def test_encode_points():
+    tile = vector_tiles.encode_points("occurrences", [(10, -5, {"uuid": "a"}),
+                                                      (100, 200, {"uuid": "b", "scientificname": "carex"})])
+
+    [(field, layer)] = _read_message(tile)
+    layer = _read_message(layer)
+    assert field == 3
+    assert (15, 2) in layer
+    assert (1, b"occurrences") in layer
+    assert (5, 4096) in layer
+    assert [v for f, v in layer if f == 3] == [b"uuid", b"scientificname"]
+    assert [_read_message(v) for f, v in layer if f == 4] == [[(1, b"a")], [(1, b"b")], [(1, b"carex")]]
+
+    features = [dict(_read_message(v)) for f, v in layer if f == 2]
+    assert [_read_packed(f[2]) for f in features] == [[0, 0], [0, 1, 1, 2]]
+    assert all(f[3] == 1 for f in features)
+    # MoveTo one point, then zigzag-encoded coordinates
+    assert [_read_packed(f[4]) for f in features] == [[9, 20, 9], [9, 200, 400]]